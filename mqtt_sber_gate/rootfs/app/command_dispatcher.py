@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import deque
+from logger import log_debug, log_error, log_warning
+
+
+class CommandDispatcher(object):
+    """
+    Выполнение команд Сбера (запросов к HA) в пуле рабочих потоков.
+    Команды одного устройства (key) выполняются строго по очереди в порядке поступления,
+    команды разных устройств — параллельно. Устройства обслуживаются по кругу, поэтому
+    поток команд одному устройству не задерживает остальные.
+    Очередь ограничена max_pending командами: сверх этого команды отклоняются,
+    а не накапливаются (поток paho не должен блокироваться).
+    При workers = 0 команды выполняются сразу в вызывающем потоке.
+    """
+
+    def __init__(self, workers=4, max_pending=1000):
+        """
+        :param workers: количество рабочих потоков
+        :param max_pending: максимальное число ожидающих выполнения команд
+        """
+        self.workers = max(0, workers)
+        self.max_pending = max_pending
+        self._cond = threading.Condition(threading.Lock())
+        self._lanes = {}  # {key: deque[(функция, время постановки, on_done)]}, пока устройство в очереди или выполняется
+        self._ready = deque()  # устройства с командами, которые сейчас никто не выполняет
+        self._pending = 0
+        self._in_flight = 0
+        self._closing = False
+
+        # Статистика
+        self.submitted = 0
+        self.executed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.wait_time_last = 0.0
+        self.wait_time_max = 0.0
+        self.wait_time_total = 0.0
+        self.exec_time_last = 0.0
+        self.exec_time_max = 0.0
+        self.exec_time_total = 0.0
+
+        self._threads = []
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"sber-command-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, on_done=None):
+        """
+        Поставить команду в очередь устройства key. Возвращает False, если очередь переполнена.
+        on_done вызывается после выполнения команды (в том числе с ошибкой) или сразу, если она отклонена.
+        """
+        enqueued = time.monotonic()
+        with self._cond:
+            rejected = self._closing or self._pending >= self.max_pending
+            if rejected:
+                self.rejected += 1
+            elif self._threads:
+                self.submitted += 1
+                lane = self._lanes.get(key)
+                if lane is None:
+                    lane = self._lanes[key] = deque()
+                    self._ready.append(key)
+                    self._cond.notify()
+                lane.append((func, enqueued, on_done))
+                self._pending += 1
+                self.max_depth = max(self.max_depth, self._pending)
+            else:
+                self.submitted += 1
+                self._in_flight += 1
+        if rejected:
+            log_warning(f"Очередь команд переполнена, команда для {key} отклонена")
+            if on_done:
+                on_done()
+            return False
+        if not self._threads:
+            self._execute(key, func, enqueued, on_done)
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closing:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                func, enqueued, on_done = self._lanes[key].popleft()
+                self._pending -= 1
+                self._in_flight += 1
+            self._execute(key, func, enqueued, on_done)
+            with self._cond:
+                lane = self._lanes[key]
+                if lane:
+                    # Следующая команда устройства — в конец очереди, после других устройств
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._lanes[key]
+
+    def _execute(self, key, func, enqueued, on_done=None):
+        started = time.monotonic()
+        try:
+            func()
+            failed = False
+        except Exception as e:
+            failed = True
+            log_error(f"Ошибка выполнения команды для {key}: {e}")
+        finished = time.monotonic()
+        with self._cond:
+            self._in_flight -= 1
+            self.executed += 1
+            self.errors += failed
+            wait_time, exec_time = started - enqueued, finished - started
+            self.wait_time_last = wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            self.wait_time_total += wait_time
+            self.exec_time_last = exec_time
+            self.exec_time_max = max(self.exec_time_max, exec_time)
+            self.exec_time_total += exec_time
+        log_debug(f"Команда для {key} выполнена за {exec_time * 1000:.1f} мс (ожидание {wait_time * 1000:.1f} мс)")
+        if on_done:
+            try:
+                on_done()
+            except Exception as e:
+                log_error(f"Ошибка обработки завершения команды для {key}: {e}")
+
+    def close(self, timeout=5.0):
+        """Выполнение оставшихся команд и остановка потоков (не дольше timeout сек)."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def get_stats(self):
+        """Статистика очереди команд."""
+        with self._cond:
+            executed = self.executed or 1
+            return {
+                'workers': self.workers,
+                'queue_depth': self._pending,
+                'queue_depth_max': self.max_depth,
+                'max_pending': self.max_pending,
+                'in_flight': self._in_flight,
+                'submitted': self.submitted,
+                'executed': self.executed,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'wait_ms_last': round(self.wait_time_last * 1000, 2),
+                'wait_ms_avg': round(self.wait_time_total / executed * 1000, 2),
+                'wait_ms_max': round(self.wait_time_max * 1000, 2),
+                'exec_ms_last': round(self.exec_time_last * 1000, 2),
+                'exec_ms_avg': round(self.exec_time_total / executed * 1000, 2),
+                'exec_ms_max': round(self.exec_time_max * 1000, 2),
+            }
@@ -0,0 +1,154 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+# Этапы прохождения команды Сбера (время отсчитывается от получения сообщения — 'received')
+# ack_deferred / ack_held — подтверждение отложено ограничением частоты / сохранено в буфер без связи;
+# ack_published — сообщение с подтверждением передано брокеру
+STAGES = ('received', 'parsed', 'db_updated', 'ha_call_start', 'ha_call_end', 'ha_echo',
+          'ack_deferred', 'ack_held', 'ack_published')
+
+# Интервалы, для которых строятся гистограммы: (имя, начальный этап, конечный этап).
+# ha_call (длительность каждого REST запроса к HA) измеряется отдельно — см. CommandTrace.observe
+INTERVALS = (
+    ('parse', 'received', 'parsed'),                  # Сбер -> агент: разбор команды
+    ('db_update', 'parsed', 'db_updated'),            # агент: применение состояний в базе
+    ('dispatch_wait', 'db_updated', 'ha_call_start'), # агент: ожидание в очереди команд
+    ('ha_echo', 'ha_call_start', 'ha_echo'),          # HA: от запроса до state_changed
+    ('ack', 'received', 'ack_published'),             # получение -> подтверждение передано брокеру
+    ('end_to_end', 'received', 'ha_echo'),            # получение -> устройство переключено в HA
+)
+
+# Границы корзин гистограмм (мс)
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram(object):
+    """Гистограмма задержек с фиксированными корзинами (HISTOGRAM_BUCKETS_MS) и оценкой перцентилей."""
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        index = 0
+        for bound in HISTOGRAM_BUCKETS_MS:
+            if ms <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """Верхняя граница корзины, в которую попадает перцентиль (не больше максимума)."""
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                if index < len(HISTOGRAM_BUCKETS_MS):
+                    return min(float(HISTOGRAM_BUCKETS_MS[index]), self.max)
+                break
+        return self.max
+
+    def to_dict(self):
+        buckets = {str(bound): count for bound, count in zip(HISTOGRAM_BUCKETS_MS, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 2) if self.count else 0.0,
+            'max_ms': round(self.max, 2),
+            'p50_ms': round(self.percentile(0.5), 2),
+            'p95_ms': round(self.percentile(0.95), 2),
+            'p99_ms': round(self.percentile(0.99), 2),
+            'buckets': buckets,
+        }
+
+
+class CommandTrace(object):
+    """
+    Трассировка одной команды Сбера. Передаётся по цепочке обработки (в том числе через
+    служебное значение устройства '_command_trace' до эха state_changed от HA).
+    """
+
+    __slots__ = ('tracer', 'trace_id', 'devices', 'stages')
+
+    def __init__(self, tracer, trace_id):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.devices = []
+        self.stages = {'received': time.monotonic()}
+
+    def mark(self, stage):
+        """Отметить этап (учитывается первое наступление этапа)."""
+        self.tracer.mark(self, stage)
+
+    def observe(self, interval, seconds):
+        """Добавить длительность в гистограмму интервала (например, одного запроса к HA)."""
+        self.tracer.observe(interval, seconds)
+
+    def to_dict(self):
+        started = self.stages['received']
+        return {
+            'trace_id': self.trace_id,
+            'devices': self.devices,
+            'stages_ms': {stage: round((self.stages[stage] - started) * 1000, 2)
+                          for stage in STAGES if stage in self.stages},
+        }
+
+
+class CommandTracer(object):
+    """
+    Сквозная трассировка команд Сбера: Сбер -> агент -> HA -> Сбер.
+    Для каждой команды запоминаются моменты этапов (STAGES); по ним строятся гистограммы
+    задержек интервалов (INTERVALS), по которым видно, где теряется время: в разборе команды,
+    в очереди агента, в HA или при отправке подтверждения. Последние recent_size трассировок
+    хранятся целиком.
+    """
+
+    def __init__(self, recent_size=50):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=recent_size)
+        self._histograms = {name: LatencyHistogram() for name, _, _ in INTERVALS}
+        self._histograms['ha_call'] = LatencyHistogram()
+        self._ends = {}
+        for name, start, end in INTERVALS:
+            self._ends.setdefault(end, []).append((name, start))
+
+    def start(self):
+        """Новая трассировка (момент получения команды)."""
+        trace = CommandTrace(self, next(self._ids))
+        with self._lock:
+            self._recent.append(trace)
+        return trace
+
+    def mark(self, trace, stage):
+        now = time.monotonic()
+        with self._lock:
+            if stage in trace.stages:
+                return
+            trace.stages[stage] = now
+            for name, start in self._ends.get(stage, ()):
+                started = trace.stages.get(start)
+                if started is not None:
+                    self._histograms[name].add((now - started) * 1000)
+
+    def observe(self, interval, seconds):
+        with self._lock:
+            self._histograms[interval].add(seconds * 1000)
+
+    def get_stats(self):
+        """Гистограммы по интервалам и последние трассировки."""
+        with self._lock:
+            return {
+                'stages': {name: histogram.to_dict() for name, histogram in self._histograms.items()},
+                'recent': [trace.to_dict() for trace in reversed(self._recent)],
+            }
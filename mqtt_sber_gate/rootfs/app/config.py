@@ -29,6 +29,7 @@ else:
 OPTIONS_FILE_PATH = os.path.join(DATA_DIR, 'options.json')
 DEVICES_DB_FILE_PATH = os.path.join(DATA_DIR, 'devices.json')
 CATEGORIES_FILE_PATH = os.path.join(DATA_DIR, 'categories.json')
+MQTT_STATE_FILE_PATH = os.path.join(DATA_DIR, 'mqtt_state.json')
 
 OPTIONS = {}
 
@@ -43,8 +44,17 @@ def read_json_file(file_path):
     return result
 
 def write_json_file(file_path, data):
-    with open(file_path, "w", encoding='utf-8') as out_file:
+    """
+    Атомарная запись JSON: сначала во временный файл рядом с целевым,
+    затем fsync и переименование. При сбое питания на диске остаётся
+    либо старая, либо новая версия файла, но не обрезанная.
+    """
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding='utf-8') as out_file:
         json.dump(data, out_file, ensure_ascii=False, indent=4)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, file_path)
 
 def load_options():
     global OPTIONS
@@ -0,0 +1,203 @@
+import random
+import threading
+import time
+from collections import deque
+import paho.mqtt
+import paho.mqtt.client as mqtt
+from logger import log_info, log_warning, log_error
+
+# SupervisedClient переопределяет внутренний метод paho _reconnect_wait, который loop_forever
+# вызывает перед каждой повторной попыткой подключения. paho не устанавливается через pip,
+# а вложен в аддон (каталог paho/) — это и есть фиксация версии. При обновлении вложенной
+# копии нужно проверить, что loop_forever по-прежнему вызывает _reconnect_wait, и изменить
+# PAHO_VERSION (это проверяет тест test_connection_supervisor). Если метод всё же не будет
+# вызываться, паузы задаст встроенная задержка paho (reconnect_delay_set в ConnectionSupervisor).
+PAHO_VERSION = '1.6.1'
+
+# Состояния здоровья соединения с брокером
+HEALTH_CONNECTING = 'connecting'
+HEALTH_ONLINE = 'online'
+HEALTH_DEGRADED = 'degraded'
+HEALTH_OFFLINE = 'offline'
+
+
+class SupervisedClient(mqtt.Client):
+    """
+    paho-клиент для работы под ConnectionSupervisor.
+    Сокетом владеет только сетевой поток paho (loop_start): publish() из других потоков
+    лишь ставит пакет в очередь. Переподключается сам paho, а паузу между попытками
+    и учёт ошибок подключения выполняет супервизор.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.supervisor = None
+        if paho.mqtt.__version__ != PAHO_VERSION or not hasattr(mqtt.Client, '_reconnect_wait'):
+            log_warning(f"Версия paho-mqtt {paho.mqtt.__version__} не проверялась с ConnectionSupervisor "
+                        f"(ожидается {PAHO_VERSION}): паузы между переподключениями могут не соблюдаться")
+
+    def reconnect(self):
+        try:
+            return super().reconnect()
+        except Exception as e:
+            if self.supervisor is not None:
+                self.supervisor.on_connect_failed(e)
+            raise
+
+    def _reconnect_wait(self):
+        # Вызывается сетевым потоком paho перед каждой повторной попыткой подключения
+        if self.supervisor is None:
+            return super()._reconnect_wait()
+        self.supervisor.wait_before_retry()
+
+
+class ConnectionSupervisor(object):
+    """
+    Поддержание соединения paho-клиента (SupervisedClient) с брокером.
+    Сетевой обмен и переподключение выполняет поток paho (loop_start), а супервизор
+    задаёт паузы между попытками: задержка растёт экспоненциально (min_delay, 2 * min_delay, ...
+    до max_delay) со случайным разбросом, поэтому при «мигающем» брокере число
+    переподключений ограничено. Задержка сбрасывается, только если соединение
+    продержалось stable_after секунд.
+
+    Здоровье соединения:
+      connecting — подключения ещё не было, идут попытки;
+      online     — подключено;
+      degraded   — подключено, но соединение часто рвётся (flap_threshold разрывов
+                   за flap_window сек), либо связь потеряна недавно (меньше offline_after сек);
+      offline    — связи нет дольше offline_after сек.
+    """
+
+    def __init__(self, client, min_delay=1.0, max_delay=60.0, stable_after=60.0, offline_after=60.0,
+                 flap_window=300.0, flap_threshold=3):
+        self.client = client
+        client.supervisor = self
+        # Запасной вариант: встроенная задержка paho (без разброса) на случай, если
+        # переопределённый _reconnect_wait не вызывается (см. PAHO_VERSION)
+        client.reconnect_delay_set(min_delay=max(1, int(min_delay)), max_delay=max(1, int(max_delay)))
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.stable_after = stable_after
+        self.offline_after = offline_after
+        self.flap_window = flap_window
+        self.flap_threshold = flap_threshold
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self.state = 'stopped'  # stopped / connecting / connected / waiting
+        self.connected = False
+        self._failures = 0  # попытки подряд без стабильного соединения
+        self._started_at = time.monotonic()
+        self._connected_at = None
+        self._disconnected_at = None
+        self._disconnects = deque(maxlen=64)
+        self._retry_at = None
+
+        # Статистика
+        self.attempts = 0
+        self.connect_count = 0
+        self.last_error = ''
+
+    def start(self, host, port, keepalive=60):
+        """Запуск сетевого потока paho с подключением к брокеру (не блокирует)."""
+        self.client.connect_async(host, port, keepalive=keepalive)
+        self._started_at = time.monotonic()
+        self.state = 'connecting'
+        self.attempts += 1
+        self.client.loop_start()
+
+    def stop(self):
+        """Отключение от брокера и остановка сетевого потока paho."""
+        self._stop.set()
+        try:
+            self.client.disconnect()
+        except Exception as e:
+            log_warning(f"Ошибка отключения от Sber MQTT: {e}")
+        self.client.loop_stop()
+        self.state = 'stopped'
+
+    def on_connected(self):
+        """Брокер подтвердил подключение (on_connect, rc = 0)."""
+        with self._lock:
+            self.connected = True
+            self.state = 'connected'
+            self.connect_count += 1
+            self._connected_at = time.monotonic()
+            self.last_error = ''
+
+    def on_connect_refused(self, reason):
+        """Брокер отклонил подключение (on_connect, rc != 0)."""
+        with self._lock:
+            self.last_error = reason
+
+    def on_connect_failed(self, error):
+        """Не удалось установить соединение (исключение при подключении)."""
+        with self._lock:
+            self.last_error = str(error)
+        log_error(f"Не удалось подключиться к Sber MQTT: {error}")
+
+    def on_connection_lost(self):
+        """Соединение закрыто (on_disconnect)."""
+        now = time.monotonic()
+        with self._lock:
+            if self.connected and now - self._connected_at >= self.stable_after:
+                # Соединение было стабильным — отсчёт задержек начинается заново
+                self._failures = 0
+            if self.connected:
+                self._disconnects.append(now)
+                self._disconnected_at = now
+            self.connected = False
+
+    def next_delay(self):
+        """Задержка перед следующей попыткой: экспонента с ограничением и случайным разбросом."""
+        with self._lock:
+            step = min(self._failures, 16)
+            self._failures += 1
+        delay = min(self.max_delay, self.min_delay * (2 ** step))
+        return random.uniform(delay / 2, delay)
+
+    def wait_before_retry(self):
+        """Пауза перед повторной попыткой подключения (в сетевом потоке paho); прерывается stop()."""
+        if self._stop.is_set():
+            return
+        if self.connected:
+            # on_disconnect не был вызван (например, исключение в цикле paho)
+            self.on_connection_lost()
+        delay = self.next_delay()
+        self.state = 'waiting'
+        self._retry_at = time.monotonic() + delay
+        log_info(f"Повторное подключение к Sber MQTT через {delay:.1f} с")
+        self._stop.wait(delay)
+        self._retry_at = None
+        if not self._stop.is_set():
+            self.state = 'connecting'
+            self.attempts += 1
+
+    def health(self):
+        """Текущее состояние здоровья соединения (см. описание класса)."""
+        now = time.monotonic()
+        with self._lock:
+            if self.connected:
+                recent = sum(1 for moment in self._disconnects if now - moment < self.flap_window)
+                return HEALTH_DEGRADED if recent >= self.flap_threshold else HEALTH_ONLINE
+            if self._disconnected_at is not None:
+                return HEALTH_DEGRADED if now - self._disconnected_at < self.offline_after else HEALTH_OFFLINE
+            return HEALTH_CONNECTING if now - self._started_at < self.offline_after else HEALTH_OFFLINE
+
+    def get_stats(self):
+        """Состояние и статистика подключения."""
+        health = self.health()
+        now = time.monotonic()
+        with self._lock:
+            retry_at = self._retry_at
+            return {
+                'health': health,
+                'state': self.state,
+                'connected_for_s': round(now - self._connected_at, 1) if self.connected else 0.0,
+                'attempts': self.attempts,
+                'connect_count': self.connect_count,
+                'consecutive_failures': self._failures,
+                'disconnects_recent': sum(1 for moment in self._disconnects if now - moment < self.flap_window),
+                'next_retry_in_s': round(max(0.0, retry_at - now), 1) if retry_at else None,
+                'last_error': self.last_error,
+            }
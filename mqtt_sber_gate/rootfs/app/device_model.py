@@ -0,0 +1,160 @@
+import sys
+
+_MISSING = object()
+
+
+class Device(object):
+    """
+    Компактная запись устройства в базе.
+    Известные атрибуты хранятся в слотах, а не в словаре, что заметно экономит память
+    на установках с тысячами сущностей. Остальные (редкие) ключи — в словаре extra.
+    Поддерживает словарный интерфейс (get, [], in, items...), поэтому остальной код
+    работает с устройством как со словарём, а JSON-представление не меняется.
+    """
+
+    FIELDS = (
+        'enabled', 'name', 'default_name', 'nicknames', 'home', 'room', 'groups',
+        'model_id', 'category', 'hw_version', 'sw_version', 'entity_ha', 'entity_type',
+        'friendly_name', 'device_id', 'device_class',
+    )
+    # Поля с небольшим набором повторяющихся значений — интернируются
+    INTERNED_FIELDS = frozenset(('category', 'entity_type', 'device_class', 'room', 'home'))
+
+    # seq — номер последнего изменения конфигурации (см. DevicesDB.changes_since), в JSON не попадает
+    __slots__ = FIELDS + ('extra', 'seq')
+
+    def __init__(self, data=None):
+        self.extra = None
+        self.seq = 0
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data)
+
+    def to_dict(self):
+        """Обычный словарь для записи в JSON."""
+        result = {}
+        for field in self.FIELDS:
+            value = getattr(self, field, _MISSING)
+            if value is not _MISSING:
+                result[field] = value
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    # ------------------------------------------------------------------ #
+    #  Словарный интерфейс                                                 #
+    # ------------------------------------------------------------------ #
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.INTERNED_FIELDS and type(value) is str:
+            value = sys.intern(value)
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        # Без этого `if device:` вызывал бы __len__ и собирал весь словарь
+        if self.extra:
+            return True
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                return True
+        return False
+
+    def __eq__(self, other):
+        if isinstance(other, Device):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"Device({self.to_dict()!r})"
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            return getattr(self, key, default)
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def pop(self, key, default=_MISSING):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        if key in _FIELD_SET:
+            delattr(self, key)
+        else:
+            del self.extra[key]
+        return value
+
+    def keys(self):
+        return list(self.to_dict().keys())
+
+    def items(self):
+        return self.to_dict().items()
+
+
+_FIELD_SET = frozenset(Device.FIELDS)
+
+
+class DeviceState(object):
+    """
+    Текущие состояния одного устройства {функция Сбера: значение}.
+    Имена функций интернируются: у тысяч устройств одни и те же ключи
+    ('on_off', 'online', ...) хранятся в памяти в одном экземпляре.
+    Для каждой функции хранится номер последнего изменения (feature_seq),
+    seq — максимальный из них.
+    """
+
+    __slots__ = ('values', 'seq', 'feature_seq')
+
+    def __init__(self, values=None, seq=0):
+        self.values = {}
+        self.feature_seq = {}
+        self.seq = seq
+        if values:
+            for key, value in values.items():
+                self.set(key, value, seq)
+
+    def set(self, key, value, seq=0):
+        """Установка значения. Возвращает False, если значение не изменилось."""
+        key = sys.intern(key)
+        if key in self.values and self.values[key] == value:
+            return False
+        self.values[key] = value
+        self.feature_seq[key] = seq
+        self.seq = max(self.seq, seq)
+        return True
+
+    def changed_since(self, seq):
+        """Функции, изменённые после seq: {функция: значение}."""
+        return {key: self.values[key] for key, key_seq in self.feature_seq.items() if key_seq > seq}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.values
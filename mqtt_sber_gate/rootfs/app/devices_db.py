@@ -1,5 +1,9 @@
 import json
-from config import read_json_file, write_json_file, VERSION
+import time
+from config import VERSION
+from devices_storage import JsonStorage
+from device_model import Device, DeviceState
+from rwlock import ReadWriteLock
 from logger import log_info, log_debug, log_trace, log_deeptrace, log_warning, log_error
 
 
@@ -7,41 +11,325 @@ class DevicesDB(object):
     """
     Менеджер локальной базы данных устройств.
     Отвечает только за хранение данных и CRUD операции.
+
+    База используется одновременно из потоков paho (команды Сбера), WebSocket-клиента HA
+    и HTTP-сервера. Все изменения выполняются под блокировкой записи self.lock, а код,
+    перебирающий реестр (сериализаторы), работает внутри read_lock() и видит
+    согласованное состояние. Одиночные чтения (get_device, get_state) блокировку не берут:
+    поиск в dict атомарен.
+
+    Каждое изменение конфигурации или состояния увеличивает глобальный номер seq и
+    помечает им изменённое устройство (Device.seq) и функцию (DeviceState.feature_seq).
+    changes_since(seq) возвращает только то, что изменилось после seq.
     """
 
-    def __init__(self, db_file_path):
-        """Инициализация базы данных из файла."""
+    # Поля, по которым поддерживаются вторичные индексы {поле: {значение: {entity_id: None}}}
+    INDEXED_FIELDS = ('device_id', 'category', 'enabled', 'room')
+
+    def __init__(self, db_file_path, storage=None, persist_states=False):
+        """
+        Инициализация базы данных из хранилища.
+        :param db_file_path: путь к devices.json
+        :param storage: хранилище базы (по умолчанию — JsonStorage без отложенной записи)
+        :param persist_states: сохранять ли состояния устройств на диск вместе с конфигурацией
+        """
         self.db_file_path = db_file_path
-        self.devices_registry = read_json_file(db_file_path)
+        self.lock = ReadWriteLock()
+        self.storage = storage or JsonStorage(db_file_path)
+        self.persist_states = persist_states
+        started = time.monotonic()
+        self.devices_registry = {
+            entity_id: Device.from_dict(data) for entity_id, data in self.storage.load().items()
+        }
+
+        # Состояния устройств (States) хранятся отдельно от конфигурации: {entity_id: DeviceState}.
+        # Они часто меняются и актуализируются из HA при запуске, поэтому на диск попадают
+        # только при persist_states. Служебные ключи (_expected_mqtt_state и т.п.) — в runtime.
+        self.states = {}
+        self.runtime = {}
+
+        # Журнал изменений: {entity_id: seq последнего изменения}, упорядочен по seq
+        # (изменённое устройство переносится в конец). Удалённые устройства остаются
+        # в журнале как «надгробия». epoch отличает номера текущего запуска от прошлых.
+        self.seq = 0
+        self.epoch = int(time.time() * 1000)
+        self._reset_seq = 0
+        self._changes = {}
+
+        stripped = {}  # {entity_id: None} — устройства, которые нужно переписать на диске
+        for entity_id, device in self.devices_registry.items():
+            # Убеждаемся, что у всех устройств есть флаг 'enabled'
+            if device.get('enabled') is None:
+                device['enabled'] = False
+
+            # Перенос состояний и служебных ключей из старого формата devices.json
+            # (они не входят в Device.FIELDS, поэтому могут быть только в extra)
+            if not device.extra:
+                continue
+            if 'States' in device.extra:
+                self.states[entity_id] = DeviceState(device.pop('States'))
+                if not persist_states:
+                    stripped[entity_id] = None
+            for key in [k for k in device.extra if k.startswith('_')]:
+                device.pop(key)
+                stripped[entity_id] = None
+
+        self._rebuild_indexes()
+        self._init_id_counters()
+        log_info(f"База устройств загружена за {(time.monotonic() - started) * 1000:.1f} мс, "
+                 f"устройств: {len(self.devices_registry)}")
+
+        self.storage.bind(self._persisted_registry, self._persisted_device, self.lock)
+        if stripped:
+            log_info(f"Состояния и служебные поля удалены из сохраняемой конфигурации устройств: {len(stripped)}")
+            self.storage.record_rewrite(list(stripped))
+
+    def _persisted_device(self, entity_id):
+        """Устройство в том виде, в котором оно записывается на диск."""
+        device = self.devices_registry.get(entity_id)
+        if device is None:
+            return None
+        data = device.to_dict()
+        if self.persist_states:
+            data['States'] = self.get_states(entity_id)
+        return data
+
+    def _persisted_registry(self):
+        """Вся база в том виде, в котором она записывается на диск."""
+        return {entity_id: self._persisted_device(entity_id) for entity_id in self.devices_registry}
+
+    # ------------------------------------------------------------------ #
+    #  Номера изменений                                                    #
+    # ------------------------------------------------------------------ #
+
+    def _touch(self, entity_id):
+        """Новый номер изменения для устройства (вызывается под блокировкой записи)."""
+        self.seq += 1
+        self._changes.pop(entity_id, None)
+        self._changes[entity_id] = self.seq
+        return self.seq
+
+    def current_seq(self):
+        """Номер последнего изменения базы."""
+        return self.seq
+
+    def changes_since(self, seq, epoch=None):
+        """
+        Изменения базы после номера seq.
+        Если seq относится к другому запуску (epoch) или база с тех пор очищалась,
+        возвращается полный снимок (full=True).
+        :return: {'epoch', 'seq', 'full',
+                  'devices': {id: {'config': конфигурация (если менялась), 'states': {функция: значение}}},
+                  'deleted': [id удалённых устройств]}
+        """
+        with self.lock.read_locked():
+            full = (
+                seq <= 0
+                or seq > self.seq
+                or seq < self._reset_seq
+                or (epoch is not None and epoch != self.epoch)
+            )
+            if full:
+                seq = 0
+                changed_ids = list(self.devices_registry)
+            else:
+                changed_ids = []
+                for entity_id, entity_seq in reversed(self._changes.items()):
+                    if entity_seq <= seq:
+                        break
+                    changed_ids.append(entity_id)
+                changed_ids.reverse()
+
+            devices = {}
+            deleted = []
+            for entity_id in changed_ids:
+                device = self.devices_registry.get(entity_id)
+                if device is None:
+                    deleted.append(entity_id)
+                    continue
+                entry = {}
+                if device.seq > seq or full:
+                    entry['config'] = device.to_dict()
+                states = self.states.get(entity_id)
+                if states is not None and (states.seq > seq or full):
+                    entry['states'] = dict(states.values) if full else states.changed_since(seq)
+                if entry:
+                    devices[entity_id] = entry
+
+            return {
+                'epoch': self.epoch,
+                'seq': self.seq,
+                'full': full,
+                'devices': devices,
+                'deleted': deleted,
+            }
+
+    def read_lock(self):
+        """Контекст для согласованного чтения нескольких устройств: with db.read_lock(): ..."""
+        return self.lock.read_locked()
+
+    def export_device(self, entity_id):
+        """Устройство вместе с текущими состояниями (формат /api/v2/devices)."""
+        with self.lock.read_locked():
+            data = self.devices_registry[entity_id].to_dict()
+            data['States'] = self.get_states(entity_id)
+            return data
+
+    # ------------------------------------------------------------------ #
+    #  Вторичные индексы                                                   #
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _index_key(field, value):
+        return bool(value) if field == 'enabled' else value
+
+    def _rebuild_indexes(self):
+        self.indexes = {field: {} for field in self.INDEXED_FIELDS}
+        # Порядковый номер устройства в реестре (назначается при добавлении и не меняется):
+        # по нему выборки из индексов упорядочиваются как реестр
+        self._ordinals = {}
+        self._next_ordinal = 0
+        for entity_id, device in self.devices_registry.items():
+            self._assign_ordinal(entity_id)
+            for field in self.INDEXED_FIELDS:
+                self._index_add(field, device.get(field), entity_id)
+
+    def _assign_ordinal(self, entity_id):
+        self._ordinals[entity_id] = self._next_ordinal
+        self._next_ordinal += 1
+
+    def _index_add(self, field, value, entity_id):
+        self.indexes[field].setdefault(self._index_key(field, value), {})[entity_id] = None
+
+    def _index_remove(self, field, value, entity_id):
+        key = self._index_key(field, value)
+        bucket = self.indexes[field].get(key)
+        if bucket is not None:
+            bucket.pop(entity_id, None)
+            if not bucket:
+                del self.indexes[field][key]
+
+    def _find(self, field, value):
+        with self.lock.read_locked():
+            return list(self.indexes[field].get(self._index_key(field, value), ()))
+
+    def find_by_device_id(self, device_id):
+        """ID сущностей HA, принадлежащих одному физическому устройству."""
+        return self._find('device_id', device_id) if device_id else []
 
-        # Убеждаемся, что у всех устройств есть флаг 'enabled'
+    def find_by_category(self, category):
+        """ID устройств заданной категории Сбера."""
+        return self._find('category', category)
+
+    def find_by_room(self, room):
+        """ID устройств в заданной комнате."""
+        return self._find('room', room)
+
+    def get_enabled_ids(self):
+        """
+        ID всех включённых (передаваемых в Сбер) устройств в порядке реестра, а не индекса:
+        порядок индекса зависит от истории включения/отключения, а конфигурация для Сбера
+        при том же наборе устройств должна собираться одинаково. Сортируются только
+        включённые устройства (по порядковому номеру), весь реестр не просматривается.
+        """
+        with self.lock.read_locked():
+            return sorted(self.indexes['enabled'].get(True, ()), key=self._ordinals.__getitem__)
+
+    def get_siblings(self, entity_id, category=None):
+        """Другие сущности того же физического устройства (опционально — только заданной категории)."""
+        with self.lock.read_locked():
+            device = self.devices_registry.get(entity_id)
+            if not device:
+                return []
+            return [
+                other_id for other_id in self.find_by_device_id(device.get('device_id'))
+                if other_id != entity_id
+                and (category is None or self.devices_registry[other_id].get('category') == category)
+            ]
+
+    # ------------------------------------------------------------------ #
+    #  Генерация ID                                                        #
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _split_generated_id(entity_id):
+        """'light_07' -> ('light', 7); None, если ID не в формате префикс_номер."""
+        prefix, sep, number = entity_id.rpartition('_')
+        if not sep or not prefix or not number.isdigit():
+            return None
+        return prefix, int(number)
+
+    def _init_id_counters(self):
+        """
+        Счётчики ID по префиксам {префикс: последний выданный номер}.
+        Сохраняются вместе с базой; при запуске не меньше максимального номера
+        среди существующих устройств, поэтому ID удалённых устройств не переиспользуются.
+        """
+        self.id_counters = dict(self.storage.load_meta().get('id_counters', {}))
         for entity_id in self.devices_registry:
-            if self.devices_registry[entity_id].get('enabled') is None:
-                self.devices_registry[entity_id]['enabled'] = False
+            parsed = self._split_generated_id(entity_id)
+            if parsed and parsed[1] > self.id_counters.get(parsed[0], 0):
+                self.id_counters[parsed[0]] = parsed[1]
 
     def generate_new_id(self, prefix):
-        """Генерация уникального ID с заданным префиксом."""
-        for i in range(1, 99):
-            new_id = f"{prefix}_{str(i).zfill(2)}"
-            if self.devices_registry.get(new_id) is None:
-                return new_id
-        return None
+        """Генерация уникального ID с заданным префиксом (prefix_01, prefix_02, ..., prefix_100, ...)."""
+        with self.lock.write_locked():
+            number = self.id_counters.get(prefix, 0)
+            while True:
+                number += 1
+                new_id = f"{prefix}_{str(number).zfill(2)}"
+                if new_id not in self.devices_registry:
+                    break
+            self.id_counters[prefix] = number
+            self.storage.save_meta({'id_counters': self.id_counters})
+            return new_id
 
     def save_db(self):
-        """Сохранение текущей базы данных на диск."""
-        write_json_file(self.db_file_path, self.devices_registry)
+        """
+        Сохранение текущей базы данных на диск.
+        В режиме отложенной записи только помечает базу изменённой и планирует сброс.
+        """
+        self.storage.save()
+
+    def flush(self):
+        """Немедленная запись несохранённых изменений на диск."""
+        self.storage.flush()
+
+    def close(self):
+        """Сброс несохранённых изменений и закрытие хранилища (вызывается при остановке)."""
+        self.storage.close()
+
+    def get_stats(self):
+        """Статистика хранилища базы."""
+        stats = self.storage.get_stats()
+        stats['devices'] = len(self.devices_registry)
+        return stats
 
     def clear_database(self):
         """Удаление всех устройств из базы данных."""
-        self.devices_registry = {}
-        self.save_db()
+        with self.lock.write_locked():
+            self.devices_registry = {}
+            self.states = {}
+            self.runtime = {}
+            self._rebuild_indexes()
+            self.seq += 1
+            self._reset_seq = self.seq
+            self._changes = {}
+            self.storage.record_clear()
 
     def delete_device(self, entity_id):
         """Удаление устройства из базы данных."""
-        if entity_id in self.devices_registry:
-            self.devices_registry.pop(entity_id)
-            self.save_db()
-            log_info(f"Удалено устройство: {entity_id}!")
+        with self.lock.write_locked():
+            if entity_id in self.devices_registry:
+                device = self.devices_registry.pop(entity_id)
+                for field in self.INDEXED_FIELDS:
+                    self._index_remove(field, device.get(field), entity_id)
+                del self._ordinals[entity_id]
+                self.states.pop(entity_id, None)
+                self.runtime.pop(entity_id, None)
+                self._touch(entity_id)
+                self.storage.record_delete(entity_id)
+                log_info(f"Удалено устройство: {entity_id}!")
 
     def is_device_in_base(self, entity_id):
         """Проверка существования устройства в базе данных."""
@@ -51,32 +339,75 @@ class DevicesDB(object):
         """Возвращает объект устройства по ID."""
         return self.devices_registry.get(entity_id)
 
+    def list_devices(self, offset=0, limit=100):
+        """
+        Постраничная выборка устройств, отсортированных по ID.
+        Возвращает (словарь {id: устройство} для страницы, общее количество устройств).
+        """
+        page = self.storage.list_page(offset, limit)
+        if page is not None:
+            rows, total = page
+            return {entity_id: dict(device, States=self.get_states(entity_id)) for entity_id, device in rows}, total
+
+        with self.lock.read_locked():
+            entity_ids = sorted(self.devices_registry)[offset:offset + limit]
+            return {entity_id: self.export_device(entity_id) for entity_id in entity_ids}, len(self.devices_registry)
+
     def change_state(self, entity_id, state_key, value):
         """Обновление состояния конкретного атрибута устройства."""
-        if entity_id not in self.devices_registry:
-            log_warning(f"Устройство id={entity_id} не найдено")
-            return
+        with self.lock.write_locked():
+            if entity_id not in self.devices_registry:
+                log_warning(f"Устройство id={entity_id} не найдено")
+                return
 
-        device = self.devices_registry[entity_id]
-        if 'States' not in device:
-            log_debug(f"Для устройства id={entity_id} не найдены состояния (States). Создаем.")
-            device['States'] = {}
+            states = self.states.get(entity_id)
+            if states is None:
+                log_debug(f"Для устройства id={entity_id} не найдены состояния (States). Создаем.")
+                states = self.states[entity_id] = DeviceState()
 
-        if state_key not in device['States']:
-            log_deeptrace(f"Для устройства id={entity_id} ключ={state_key} не найден. Создаем.")
+            if state_key not in states:
+                log_deeptrace(f"Для устройства id={entity_id} ключ={state_key} не найден. Создаем.")
 
-        device['States'][state_key] = value
+            if state_key in states and states.get(state_key) == value:
+                return
+            states.set(state_key, value, self._touch(entity_id))
+            if self.persist_states:
+                self.storage.record_state(entity_id, state_key, value)
+
+    def compare_and_set_state(self, entity_id, state_key, expected, value):
+        """Изменение состояния, только если текущее значение всё ещё равно expected. True — изменено."""
+        with self.lock.write_locked():
+            if self.get_state(entity_id, state_key) != expected:
+                return False
+            self.change_state(entity_id, state_key, value)
+            return True
 
     def get_states(self, entity_id):
-        """Возвращает все состояния для конкретного устройства."""
-        device = self.devices_registry.get(entity_id, {})
-        return device.get('States', {})
+        """Возвращает копию всех состояний устройства (её можно безопасно перебирать)."""
+        states = self.states.get(entity_id)
+        return dict(states.values) if states is not None else {}
 
     def get_state(self, entity_id, state_key):
         """Возвращает значение конкретного состояния устройства."""
-        device = self.devices_registry.get(entity_id, {})
-        states = device.get('States', {})
-        return states.get(state_key)
+        states = self.states.get(entity_id)
+        return states.get(state_key) if states is not None else None
+
+    def get_state_seq(self, entity_id):
+        """Номер последнего изменения состояний устройства (0 — не менялись с загрузки)."""
+        states = self.states.get(entity_id)
+        return states.seq if states is not None else 0
+
+    def set_runtime(self, entity_id, key, value):
+        """Служебное значение устройства, которое никогда не сохраняется на диск."""
+        with self.lock.write_locked():
+            self.runtime.setdefault(entity_id, {})[key] = value
+
+    def get_runtime(self, entity_id, key, default=None):
+        return self.runtime.get(entity_id, {}).get(key, default)
+
+    def pop_runtime(self, entity_id, key):
+        with self.lock.write_locked():
+            return self.runtime.get(entity_id, {}).pop(key, None)
 
     def update(self, entity_id, data, create_if_missing=True):
         """
@@ -85,42 +416,69 @@ class DevicesDB(object):
         :param data: словарь с атрибутами для обновления
         :param create_if_missing: создавать устройство, если оно не найдено
         """
-        if entity_id not in self.devices_registry:
-            if not create_if_missing:
-                log_warning(f"Устройство {entity_id} не найдено и создание запрещено.")
-                return
+        with self.lock.write_locked():
+            created = entity_id not in self.devices_registry
+            if created:
+                if not create_if_missing:
+                    log_warning(f"Устройство {entity_id} не найдено и создание запрещено.")
+                    return
 
-            log_info(f"Устройство {entity_id} не найдено. Добавляем новую запись.")
-            default_attributes = {
-                'enabled': False,
-                'name': '',
-                'default_name': '',
-                'nicknames': [],
-                'home': '',
-                'room': '',
-                'groups': [],
-                'model_id': '',
-                'category': '',
-                'hw_version': f'hw:{VERSION}',
-                'sw_version': f'sw:{VERSION}',
-                'entity_ha': False,
-                'entity_type': '',
-                'friendly_name': ''
-            }
+                log_info(f"Устройство {entity_id} не найдено. Добавляем новую запись.")
+                default_attributes = {
+                    'enabled': False,
+                    'name': '',
+                    'default_name': '',
+                    'nicknames': [],
+                    'home': '',
+                    'room': '',
+                    'groups': [],
+                    'model_id': '',
+                    'category': '',
+                    'hw_version': f'hw:{VERSION}',
+                    'sw_version': f'sw:{VERSION}',
+                    'entity_ha': False,
+                    'entity_type': '',
+                    'friendly_name': ''
+                }
             
-            self.devices_registry[entity_id] = {}
-            for key, default_val in default_attributes.items():
-                self.devices_registry[entity_id][key] = data.get(key, default_val)
+                self.devices_registry[entity_id] = Device()
+                for key, default_val in default_attributes.items():
+                    self.devices_registry[entity_id][key] = data.get(key, default_val)
+                self._assign_ordinal(entity_id)
+                for field in self.INDEXED_FIELDS:
+                    self._index_add(field, self.devices_registry[entity_id].get(field), entity_id)
 
-            if data.get('category') == 'scenario_button':
-                self.devices_registry[entity_id]['States'] = {'button_event': ''}
+                seq = self._touch(entity_id)
+                self.devices_registry[entity_id].seq = seq
+                if data.get('category') == 'scenario_button':
+                    self.states[entity_id] = DeviceState({'button_event': ''}, seq)
 
-        # Обновление данными
-        for key, value in data.items():
-            self.devices_registry[entity_id][key] = value
+            # Состояния из старого UI (PUT всего устройства) идут в хранилище состояний
+            data = dict(data)
+            for key, value in (data.pop('States', None) or {}).items():
+                self.change_state(entity_id, key, value)
 
-        # Убеждаемся, что имя не пустое
-        if not self.devices_registry[entity_id].get('name'):
-            self.devices_registry[entity_id]['name'] = self.devices_registry[entity_id].get('friendly_name', '')
+            # Обновление данными (с переиндексацией изменившихся индексируемых полей)
+            device = self.devices_registry[entity_id]
+            changed = created
+            for key, value in data.items():
+                if key in self.indexes and self._index_key(key, device.get(key)) != self._index_key(key, value):
+                    self._index_remove(key, device.get(key), entity_id)
+                    self._index_add(key, value, entity_id)
+                changed = changed or key not in device or device.get(key) != value
+                device[key] = value
+
+            # Убеждаемся, что имя не пустое
+            changes = data
+            if not self.devices_registry[entity_id].get('name'):
+                name = self.devices_registry[entity_id].get('friendly_name', '')
+                changed = changed or self.devices_registry[entity_id].get('name') != name
+                self.devices_registry[entity_id]['name'] = name
+                changes['name'] = name
+
+            if not changed:
+                return
+            if not created:
+                device.seq = self._touch(entity_id)
 
-        self.save_db()
+            self.storage.record_update(entity_id, self.devices_registry[entity_id].to_dict() if created else changes)
@@ -0,0 +1,699 @@
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+from config import read_json_file, write_json_file
+from logger import log_info, log_deeptrace, log_warning, log_error
+from rwlock import ReadWriteLock
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+SNAPSHOT_CACHE_VERSION = 1
+
+# Отметка в таблице meta SQLite: devices.json уже перенесён (см. migrate_json_to_sqlite)
+MIGRATED_META_KEY = 'migrated_from_json'
+
+# Не больше параметров в одном запросе SQLite (ограничение старых версий SQLite — 999)
+SQLITE_MAX_PARAMS = 500
+
+
+def _snapshot_stamp(file_path):
+    """Отметка исходного файла, по которой проверяется актуальность кэша."""
+    st = os.stat(file_path)
+    return (SNAPSHOT_CACHE_VERSION, sys.version_info[:2], st.st_mtime_ns, st.st_size)
+
+
+def read_snapshot_cache(file_path):
+    """
+    Чтение двоичного кэша (marshal) снимка file_path.
+    Возвращает None, если кэша нет, он повреждён или исходный файл с тех пор изменился.
+    """
+    cache_file_path = f"{file_path}.cache"
+    try:
+        stamp = _snapshot_stamp(file_path)
+        with open(cache_file_path, 'rb') as f:
+            header_size = int.from_bytes(f.read(4), 'little')
+            if marshal.loads(f.read(header_size)) != stamp:
+                return None
+            # marshal.loads по байтам заметно быстрее, чем marshal.load из файла
+            data = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def write_snapshot_cache(file_path, data):
+    """Атомарная запись двоичного кэша снимка, отмеченного текущим состоянием file_path."""
+    cache_file_path = f"{file_path}.cache"
+    tmp_path = f"{cache_file_path}.tmp"
+    try:
+        stamp = _snapshot_stamp(file_path)
+        header = marshal.dumps(stamp)
+        with open(tmp_path, 'wb') as f:
+            f.write(len(header).to_bytes(4, 'little'))
+            f.write(header)
+            f.write(marshal.dumps(data))
+        os.replace(tmp_path, cache_file_path)
+    except (OSError, ValueError) as e:
+        log_warning(f"Не удалось записать кэш базы устройств {cache_file_path}: {e}")
+
+
+class JsonStorage(object):
+    """
+    Хранилище базы устройств в одном JSON-файле (devices.json).
+    Поддерживает отложенную (write-behind) запись: изменения только помечают
+    базу изменённой, а на диск она сбрасывается не чаще одного раза за flush_interval.
+
+    Рядом с devices.json ведётся двоичный кэш devices.json.cache (marshal) с отметкой
+    mtime и размера исходного файла: если devices.json с тех пор не менялся, при запуске
+    читается кэш, а не разбирается JSON.
+    """
+
+    def __init__(self, db_file_path, flush_interval=0, snapshot_cache=False):
+        """
+        :param db_file_path: путь к devices.json
+        :param flush_interval: период отложенной записи на диск (сек).
+                               0 — запись сразу при каждом сохранении.
+        :param snapshot_cache: использовать двоичный кэш devices.json для быстрого запуска
+        """
+        self.db_file_path = db_file_path
+        self.flush_interval = flush_interval
+        self.snapshot_cache = snapshot_cache
+        self.meta_file_path = f"{db_file_path}.meta"
+        self.load_source = None
+        self.load_time = 0.0
+        self._snapshot_source = None
+        self._device_source = None
+        self._db_lock = ReadWriteLock()
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._flush_timer = None
+
+        # Статистика записи на диск
+        self.save_requests = 0
+        self.flush_count = 0
+        self.flush_time_last = 0.0
+        self.flush_time_max = 0.0
+        self.flush_time_total = 0.0
+
+    def load(self):
+        """Загрузка всей базы с диска."""
+        return self._load_snapshot()
+
+    def _load_snapshot(self):
+        """Чтение devices.json — из двоичного кэша, если он актуален, иначе разбором JSON."""
+        started = time.monotonic()
+        data = read_snapshot_cache(self.db_file_path) if self.snapshot_cache else None
+        if data is not None:
+            self.load_source = 'cache'
+        else:
+            self.load_source = 'json'
+            data = read_json_file(self.db_file_path)
+            if self.snapshot_cache and data and os.path.exists(self.db_file_path):
+                write_snapshot_cache(self.db_file_path, data)
+        self.load_time = time.monotonic() - started
+        log_info(f"Снимок базы устройств прочитан ({self.load_source}) за {self.load_time * 1000:.1f} мс")
+        return data
+
+    def list_page(self, offset, limit):
+        """
+        Страница устройств, отсортированная по ID: (список (id, устройство), общее количество).
+        None — хранилище не умеет постраничную выборку, страница строится по реестру в памяти.
+        """
+        return None
+
+    def load_meta(self):
+        """Служебные данные базы (счётчики ID и т.п.) из devices.json.meta."""
+        if not os.path.exists(self.meta_file_path):
+            return {}
+        return read_json_file(self.meta_file_path)
+
+    def save_meta(self, meta):
+        """Запись служебных данных базы. Меняются редко, поэтому пишутся сразу."""
+        with self._lock:
+            write_json_file(self.meta_file_path, meta)
+
+    def bind(self, snapshot_source, device_source, db_lock=None):
+        """
+        Привязка к базе устройств.
+        :param snapshot_source: функция, возвращающая весь реестр для записи снимка
+        :param device_source: функция entity_id -> устройство для построчной записи
+        :param db_lock: блокировка базы (ReadWriteLock), под которой снимается снимок
+        """
+        self._snapshot_source = snapshot_source
+        self._device_source = device_source
+        if db_lock is not None:
+            self._db_lock = db_lock
+
+    # ------------------------------------------------------------------ #
+    #  Уведомления об изменениях базы                                      #
+    # ------------------------------------------------------------------ #
+
+    def record_update(self, entity_id, changes):
+        """Изменены атрибуты устройства."""
+        self.save()
+
+    def record_state(self, entity_id, state_key, value):
+        """Изменено состояние устройства (только при сохранении состояний на диск)."""
+        self.save()
+
+    def record_delete(self, entity_id):
+        """Устройство удалено."""
+        self.save()
+
+    def record_clear(self):
+        """База очищена."""
+        self.save()
+
+    def record_rewrite(self, entity_ids):
+        """Устройства нужно переписать целиком (например, после удаления из них устаревших полей)."""
+        self.save()
+
+    # ------------------------------------------------------------------ #
+    #  Запись на диск                                                      #
+    # ------------------------------------------------------------------ #
+
+    def save(self):
+        """Запрос на сохранение: немедленно или отложенно, в зависимости от flush_interval."""
+        with self._lock:
+            self.save_requests += 1
+            self._dirty = True
+            if self.flush_interval > 0:
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(self.flush_interval, self._on_flush_timer)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return
+        self.flush()
+
+    def _on_flush_timer(self):
+        with self._lock:
+            self._flush_timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            log_error(f"Ошибка отложенной записи базы устройств: {e}")
+
+    def flush(self):
+        """
+        Немедленная запись на диск, если есть несохранённые изменения.
+
+        Порядок захвата блокировок везде один: блокировка базы -> _write_lock -> _lock
+        (писатели базы вызывают record_* под своей блокировкой записи). Блокировка базы
+        держится только пока снимается снимок, сама запись на диск идёт уже без неё.
+        """
+        self._db_lock.acquire_read()
+        try:
+            self._write_lock.acquire()
+            try:
+                with self._lock:
+                    pending = self._dirty
+                    self._dirty = False
+                    payload = self._collect() if pending else None
+            except BaseException:
+                self._write_lock.release()
+                raise
+        finally:
+            self._db_lock.release_read()
+
+        try:
+            if not pending:
+                return
+            started = time.monotonic()
+            try:
+                self._write(payload)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                    self._restore(payload)
+                raise
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.flush_count += 1
+                self.flush_time_last = elapsed
+                self.flush_time_total += elapsed
+                self.flush_time_max = max(self.flush_time_max, elapsed)
+        finally:
+            self._write_lock.release()
+        log_deeptrace(f"База устройств записана на диск за {elapsed * 1000:.1f} мс")
+
+    def _collect(self):
+        """Снимок данных для записи (вызывается под блокировкой базы на чтение)."""
+        return self._snapshot_source()
+
+    def _restore(self, payload):
+        """Возврат несохранённого снимка после ошибки записи."""
+
+    def _write(self, payload):
+        write_json_file(self.db_file_path, payload)
+
+    def close(self):
+        """Отмена таймера и сброс несохранённых изменений (вызывается при остановке)."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        self.flush()
+        if self.snapshot_cache:
+            self._refresh_snapshot_cache()
+
+    def _refresh_snapshot_cache(self):
+        """Обновление кэша по сохранённой базе, чтобы следующий запуск обошёлся без разбора JSON."""
+        with self._db_lock.read_locked(), self._write_lock, self._lock:
+            # Без несохранённых изменений снимок реестра совпадает с содержимым devices.json
+            if self._dirty or self._snapshot_source is None or not os.path.exists(self.db_file_path):
+                return
+            if read_snapshot_cache(self.db_file_path) is None:
+                write_snapshot_cache(self.db_file_path, self._snapshot_source())
+
+    def get_stats(self):
+        """Статистика записи базы на диск."""
+        with self._lock:
+            return {
+                'storage': 'json',
+                'flush_interval': self.flush_interval,
+                'save_requests': self.save_requests,
+                'flush_count': self.flush_count,
+                'saves_coalesced': self.save_requests - self.flush_count,
+                'dirty': self._dirty,
+                'flush_ms_last': round(self.flush_time_last * 1000, 2),
+                'flush_ms_max': round(self.flush_time_max * 1000, 2),
+                'flush_ms_avg': round(self.flush_time_total * 1000 / self.flush_count, 2) if self.flush_count else 0.0,
+                'load_source': self.load_source,
+                'load_ms': round(self.load_time * 1000, 2),
+            }
+
+
+class JournalStorage(JsonStorage):
+    """
+    Хранилище «снимок + журнал изменений».
+    Каждое изменение дописывается компактной строкой в devices.json.journal,
+    т.е. стоит O(изменения), а не O(всей базы). Когда журнал превышает
+    journal_max_size, снимок devices.json переписывается целиком, а журнал обнуляется.
+    При запуске база восстанавливается из снимка с последующим применением журнала.
+
+    Формат записей журнала (одна JSON-строка на запись):
+      {"op": "u", "id": ..., "d": {...}}  — обновление атрибутов
+      {"op": "s", "id": ..., "k": ..., "v": ...}  — изменение состояния
+      {"op": "d", "id": ...}  — удаление устройства
+      {"op": "c"}  — очистка базы
+    """
+
+    def __init__(self, db_file_path, flush_interval=0, journal_max_size=1024 * 1024, snapshot_cache=False):
+        super().__init__(db_file_path, flush_interval, snapshot_cache)
+        self.journal_file_path = f"{db_file_path}.journal"
+        self.journal_max_size = journal_max_size
+        self._journal_handle = None
+        self._journal_size = 0
+        self._compacting = False
+
+        # Статистика журнала
+        self.journal_records = 0
+        self.compaction_count = 0
+        self.compaction_time_last = 0.0
+
+    def load(self):
+        """Загрузка снимка и применение к нему журнала изменений."""
+        registry = self._load_snapshot()
+        replayed = 0
+
+        if os.path.exists(self.journal_file_path):
+            valid_size = 0  # размер журнала (байт) до первой повреждённой записи
+            torn = False
+            with open(self.journal_file_path, 'rb') as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        valid_size += len(line)
+                        continue
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('нет конца строки')
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка после аварийного завершения
+                        log_warning(f"Журнал базы устройств повреждён в строке {line_no}, остаток пропущен")
+                        torn = True
+                        break
+                    self._apply(registry, record)
+                    replayed += 1
+                    valid_size += len(line)
+            if torn:
+                # Новые записи дописываются после последней целой, а не после мусора
+                os.truncate(self.journal_file_path, valid_size)
+            log_info(f"Из журнала базы устройств применено записей: {replayed}")
+
+        self._open_journal()
+        return registry
+
+    @staticmethod
+    def _apply(registry, record):
+        op = record.get('op')
+        if op == 'u':
+            registry.setdefault(record['id'], {}).update(record['d'])
+        elif op == 's':
+            device = registry.get(record['id'])
+            if device is not None:
+                device.setdefault('States', {})[record['k']] = record['v']
+        elif op == 'd':
+            registry.pop(record['id'], None)
+        elif op == 'c':
+            registry.clear()
+
+    def _open_journal(self):
+        self._journal_handle = open(self.journal_file_path, 'a', encoding='utf-8')
+        self._journal_size = self._journal_handle.tell()
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._journal_handle.write(line)
+            # flush в ОС сразу (переживает падение процесса), fsync — отложенно через save()
+            self._journal_handle.flush()
+            self._journal_size += len(line.encode('utf-8'))
+            self.journal_records += 1
+            need_compaction = self._journal_size > self.journal_max_size and not self._compacting
+            if need_compaction:
+                self._compacting = True
+        self.save()
+        if need_compaction:
+            threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def record_update(self, entity_id, changes):
+        self._append({'op': 'u', 'id': entity_id, 'd': changes})
+
+    def record_state(self, entity_id, state_key, value):
+        self._append({'op': 's', 'id': entity_id, 'k': state_key, 'v': value})
+
+    def record_delete(self, entity_id):
+        self._append({'op': 'd', 'id': entity_id})
+
+    def record_clear(self):
+        self._append({'op': 'c'})
+
+    def record_rewrite(self, entity_ids):
+        # Журнал только дополняет снимок, поэтому удалённые поля убираются перезаписью снимка
+        self.compact()
+
+    def _collect(self):
+        return None
+
+    def _write(self, payload):
+        # Периодический сброс журнала на физический носитель
+        with self._lock:
+            os.fsync(self._journal_handle.fileno())
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            log_error(f"Ошибка уплотнения журнала базы устройств: {e}")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def compact(self):
+        """Перезапись снимка devices.json и обнуление журнала."""
+        started = time.monotonic()
+        with self._db_lock.read_locked(), self._write_lock, self._lock:
+            # Изменения базы и запись в журнал заблокированы на время уплотнения,
+            # поэтому ни одно изменение не потеряется между снимком и обнулением журнала
+            if self._journal_handle.closed:
+                # Хранилище уже закрыто (остановка во время фонового уплотнения):
+                # снимок с журналом и так согласованы, журнал не открывается повторно
+                return
+            snapshot = self._snapshot_source()
+            write_json_file(self.db_file_path, snapshot)
+            if self.snapshot_cache:
+                write_snapshot_cache(self.db_file_path, snapshot)
+            self._journal_handle.close()
+            open(self.journal_file_path, 'w', encoding='utf-8').close()
+            self._open_journal()
+            elapsed = time.monotonic() - started
+            self.compaction_count += 1
+            self.compaction_time_last = elapsed
+        log_info(f"Журнал базы устройств уплотнён за {elapsed * 1000:.1f} мс")
+
+    def _refresh_snapshot_cache(self):
+        # Реестр здесь — снимок плюс журнал, поэтому кэш обновляется только при уплотнении
+        pass
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self._journal_handle and not self._journal_handle.closed:
+                self._journal_handle.close()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        with self._lock:
+            stats.update({
+                'storage': 'journal',
+                'journal_size': self._journal_size,
+                'journal_max_size': self.journal_max_size,
+                'journal_records': self.journal_records,
+                'compaction_count': self.compaction_count,
+                'compaction_ms_last': round(self.compaction_time_last * 1000, 2),
+            })
+        return stats
+
+
+class SqliteStorage(JsonStorage):
+    """
+    Хранилище базы устройств в SQLite (режим WAL).
+    Каждое устройство — отдельная строка, поэтому изменение одного устройства
+    записывает одну строку, а не всю базу. Изменённые устройства накапливаются
+    и записываются одной транзакцией не чаще одного раза за flush_interval.
+    """
+
+    def __init__(self, sqlite_file_path, flush_interval=0):
+        super().__init__(sqlite_file_path, flush_interval)
+        self.connection = sqlite3.connect(sqlite_file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS devices (entity_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.commit()
+        self._dirty_ids = set()
+        self._deleted_ids = set()
+        self._clear_pending = False
+        self.rows_written = 0
+        self.rows_deleted = 0
+
+    def is_empty(self):
+        with self._lock:
+            return self.connection.execute('SELECT 1 FROM devices LIMIT 1').fetchone() is None
+
+    def load_meta(self):
+        with self._lock:
+            rows = self.connection.execute('SELECT key, value FROM meta').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_meta(self, meta):
+        with self._lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in meta.items()])
+
+    def load(self):
+        started = time.monotonic()
+        with self._lock:
+            rows = self.connection.execute('SELECT entity_id, data FROM devices ORDER BY rowid').fetchall()
+        registry = {entity_id: json.loads(data) for entity_id, data in rows}
+        self.load_source = 'sqlite'
+        self.load_time = time.monotonic() - started
+        log_info(f"База устройств прочитана из SQLite за {self.load_time * 1000:.1f} мс")
+        return registry
+
+    def list_page(self, offset, limit):
+        """
+        Страница читается из SQLite без записи на диск: ещё не записанные изменения
+        (изменённые и удалённые устройства) накладываются на результат запроса из памяти.
+        """
+        with self._lock:
+            pending = self._dirty_ids | self._deleted_ids
+            dirty_rows = []
+            for entity_id in self._dirty_ids:
+                device = self._device_source(entity_id)
+                if device is not None:
+                    dirty_rows.append((entity_id, device))
+            dirty_rows.sort()
+            if self._clear_pending:
+                return dirty_rows[offset:offset + limit], len(dirty_rows)
+
+            # Строки с ожидающими записи изменениями берутся из памяти, поэтому из SQLite
+            # читается с запасом на их число и они пропускаются
+            total = self.connection.execute('SELECT COUNT(*) FROM devices').fetchone()[0]
+            pending_ids = list(pending)
+            for start in range(0, len(pending_ids), SQLITE_MAX_PARAMS):
+                chunk = pending_ids[start:start + SQLITE_MAX_PARAMS]
+                total -= self.connection.execute(
+                    f'SELECT COUNT(*) FROM devices WHERE entity_id IN ({",".join("?" * len(chunk))})',
+                    chunk).fetchone()[0]
+            rows = self.connection.execute(
+                'SELECT entity_id, data FROM devices ORDER BY entity_id LIMIT ?',
+                (offset + limit + len(pending),)).fetchall()
+
+        stored_rows = [(entity_id, data) for entity_id, data in rows if entity_id not in pending]
+        page = []
+        stored_index = dirty_index = 0
+        while len(page) < offset + limit:
+            if dirty_index < len(dirty_rows) and (stored_index >= len(stored_rows)
+                                                  or dirty_rows[dirty_index][0] < stored_rows[stored_index][0]):
+                page.append(dirty_rows[dirty_index])
+                dirty_index += 1
+            elif stored_index < len(stored_rows):
+                page.append(stored_rows[stored_index])
+                stored_index += 1
+            else:
+                break
+        page = page[offset:]
+        return [(entity_id, json.loads(data) if isinstance(data, str) else data)
+                for entity_id, data in page], total + len(dirty_rows)
+
+    def record_update(self, entity_id, changes):
+        with self._lock:
+            self._deleted_ids.discard(entity_id)
+            self._dirty_ids.add(entity_id)
+        self.save()
+
+    def record_state(self, entity_id, state_key, value):
+        with self._lock:
+            self._dirty_ids.add(entity_id)
+        self.save()
+
+    def record_delete(self, entity_id):
+        with self._lock:
+            self._dirty_ids.discard(entity_id)
+            self._deleted_ids.add(entity_id)
+        self.save()
+
+    def record_clear(self):
+        with self._lock:
+            self._dirty_ids.clear()
+            self._deleted_ids.clear()
+            self._clear_pending = True
+        self.save()
+
+    def record_rewrite(self, entity_ids):
+        with self._lock:
+            self._dirty_ids.update(entity_ids)
+        self.save()
+
+    def _collect(self):
+        rows = []
+        for entity_id in self._dirty_ids:
+            device = self._device_source(entity_id)
+            if device is not None:
+                rows.append((entity_id, json.dumps(device, ensure_ascii=False)))
+        payload = (self._clear_pending, set(self._deleted_ids), set(self._dirty_ids), rows)
+        self._dirty_ids.clear()
+        self._deleted_ids.clear()
+        self._clear_pending = False
+        return payload
+
+    def _restore(self, payload):
+        clear_pending, deleted_ids, dirty_ids, _ = payload
+        self._clear_pending = self._clear_pending or clear_pending
+        self._deleted_ids |= deleted_ids - self._dirty_ids
+        self._dirty_ids |= dirty_ids - self._deleted_ids
+
+    def _write(self, payload):
+        clear_pending, deleted_ids, _, rows = payload
+        with self._lock, self.connection:
+            if clear_pending:
+                self.connection.execute('DELETE FROM devices')
+            self.connection.executemany(
+                'DELETE FROM devices WHERE entity_id = ?', [(i,) for i in deleted_ids])
+            self.connection.executemany(
+                'INSERT INTO devices (entity_id, data) VALUES (?, ?) '
+                'ON CONFLICT(entity_id) DO UPDATE SET data = excluded.data', rows)
+            self.rows_written += len(rows)
+            self.rows_deleted += len(deleted_ids)
+
+    def import_registry(self, registry):
+        """Запись всей базы (используется при миграции из JSON)."""
+        with self._lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO devices (entity_id, data) VALUES (?, ?)',
+                [(entity_id, json.dumps(device, ensure_ascii=False)) for entity_id, device in registry.items()])
+
+    def close(self):
+        super().close()
+        with self._lock:
+            self.connection.close()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        with self._lock:
+            stats.update({
+                'storage': 'sqlite',
+                'pending_rows': len(self._dirty_ids) + len(self._deleted_ids),
+                'rows_written': self.rows_written,
+                'rows_deleted': self.rows_deleted,
+            })
+        return stats
+
+
+def migrate_json_to_sqlite(db_file_path, sqlite_storage):
+    """
+    Одноразовый перенос devices.json (вместе с журналом, если он есть) в SQLite.
+    После переноса в таблице meta ставится отметка MIGRATED_META_KEY, поэтому перенос
+    не повторяется, даже если база SQLite позже опустеет (удаление всех устройств).
+    Исходные файлы не удаляются, чтобы можно было вернуться к режиму json.
+    """
+    if sqlite_storage.load_meta().get(MIGRATED_META_KEY):
+        return 0
+    if not sqlite_storage.is_empty() or not os.path.exists(db_file_path):
+        # База SQLite уже заполнена (создана до появления отметки) или переносить нечего
+        sqlite_storage.save_meta({MIGRATED_META_KEY: True})
+        return 0
+
+    registry = read_json_file(db_file_path)
+    journal_file_path = f"{db_file_path}.journal"
+    if os.path.exists(journal_file_path):
+        with open(journal_file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    JournalStorage._apply(registry, json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    break
+
+    sqlite_storage.import_registry(registry)
+    sqlite_storage.save_meta({MIGRATED_META_KEY: True})
+    log_info(f"База устройств перенесена из {db_file_path} в SQLite: {len(registry)} устройств")
+    return len(registry)
+
+
+def create_storage(db_file_path, options):
+    """Создание хранилища базы устройств по настройкам аддона."""
+    storage_mode = options.get('db_storage', 'json')
+    flush_interval = options.get('db_flush_interval', 2)
+    snapshot_cache = options.get('db_snapshot_cache', True)
+
+    if storage_mode == 'journal':
+        journal_max_size = options.get('db_journal_max_size', 1024) * 1024
+        log_info(f"База устройств: режим журнала (уплотнение после {journal_max_size} байт)")
+        return JournalStorage(db_file_path, flush_interval, journal_max_size, snapshot_cache)
+
+    if storage_mode == 'sqlite':
+        if sqlite3 is None:
+            log_warning("Модуль sqlite3 недоступен, база устройств хранится в json")
+            return JsonStorage(db_file_path, flush_interval, snapshot_cache)
+        sqlite_file_path = os.path.splitext(db_file_path)[0] + '.db'
+        log_info(f"База устройств: SQLite ({sqlite_file_path})")
+        storage = SqliteStorage(sqlite_file_path, flush_interval)
+        migrate_json_to_sqlite(db_file_path, storage)
+        return storage
+
+    if storage_mode != 'json':
+        log_warning(f"Неизвестный режим хранения базы устройств: {storage_mode}, используется json")
+    return JsonStorage(db_file_path, flush_interval, snapshot_cache)
@@ -139,17 +139,20 @@ class HAEntityUpdater:
         """
         sensor_temp_devices: dict[str, list[str]] = {}
 
+        # Перебираем только датчики из индекса категории, а не всю базу
+        sensor_temp_ids = set(self.device_database.find_by_category('sensor_temp'))
+
         for entity in ha_entities:
             entity_id = entity['entity_id']
-            db_entity = self.device_database.devices_registry.get(entity_id)
-            if not db_entity or db_entity.get('category') != 'sensor_temp':
+            if entity_id not in sensor_temp_ids:
                 continue
 
             device_class = entity['attributes'].get('device_class', '')
             if device_class not in ('temperature', 'humidity', 'pressure', 'atmospheric_pressure'):
                 continue
 
-            device_id = db_entity.get('device_id')
+            device = self.device_database.get_device(entity_id)
+            device_id = device.get('device_id') if device else None
             if device_id:
                 sensor_temp_devices.setdefault(device_id, []).append(entity_id)
 
@@ -2,6 +2,9 @@ import requests
 from logger import log_info, log_debug, log_deeptrace
 from converters import sber_brightness_to_ha, sber_temp_to_ha
 
+# Таймаут REST запросов к HA (сек): (подключение, ответ)
+HA_REQUEST_TIMEOUT = (5, 10)
+
 
 class HARestClient:
     """
@@ -27,7 +30,7 @@ class HARestClient:
     def _post(self, url, payload):
         log_debug(f"REST запрос в HA: {url} | данные: {payload}")
         try:
-            requests.post(url, json=payload, headers=self._get_headers())
+            requests.post(url, json=payload, headers=self._get_headers(), timeout=HA_REQUEST_TIMEOUT)
         except Exception as e:
             from logger import log_error
             log_error(f"Ошибка REST запроса к HA: {e}")
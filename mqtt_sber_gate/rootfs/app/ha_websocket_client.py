@@ -12,6 +12,10 @@ class HAWebSocketClient:
     """
 
     def __init__(self, device_database, sber_serializer, config_options, publish_status_callback):
+        """
+        :param publish_status_callback: функция, принимающая список ID устройств, состояния
+                                        которых изменились и должны быть отправлены в Сбер
+        """
         self.device_database = device_database
         self.sber_serializer = sber_serializer
         self.config_options = config_options
@@ -193,8 +197,7 @@ class HAWebSocketClient:
         changed = self._update_state_in_db(entity_id, db_entity, category, new_state, attributes, device_class)
 
         if is_enabled and changed:
-            payload = self.sber_serializer.build_mqtt_states_payload([entity_id])
-            self.publish_status_callback(payload)
+            self.publish_status_callback([entity_id])
 
     def _update_state_in_db(self, entity_id, db_entity, category, new_state, attributes, device_class) -> bool:
         """
@@ -237,16 +240,12 @@ class HAWebSocketClient:
         self.device_database.change_state(entity_id, key, value)
 
         # Синхронизация с другими датчиками того же физического устройства
-        current_device_id = db_entity.get('device_id')
-        if current_device_id:
-            for other_id, other_dev in self.device_database.devices_registry.items():
-                if (other_id != entity_id
-                        and other_dev.get('device_id') == current_device_id
-                        and other_dev.get('category') == 'sensor_temp'):
-                    self.device_database.change_state(other_id, key, value)
-                    if other_dev.get('enabled', False):
-                        payload = self.sber_serializer.build_mqtt_states_payload([other_id])
-                        self.publish_status_callback(payload)
+        for other_id in self.device_database.get_siblings(entity_id, category='sensor_temp'):
+            self.device_database.change_state(other_id, key, value)
+            # Устройство могло быть удалено через веб-интерфейс, пока обрабатывалось событие
+            other_device = self.device_database.get_device(other_id)
+            if other_device and other_device.get('enabled', False):
+                self.publish_status_callback([other_id])
 
         return True
 
@@ -263,12 +262,13 @@ class HAWebSocketClient:
 
     def _handle_relay_or_light(self, entity_id, db_entity, category, new_state, attributes) -> bool:
         entity_type = db_entity.get('entity_type')
-        expected_state = db_entity.get('_expected_mqtt_state')
+        expected_state = self.device_database.get_runtime(entity_id, '_expected_mqtt_state')
 
         if entity_type == 'button':
             if expected_state is not None:
                 log_deeptrace(f"Игнорируем эхо кнопки {entity_id}")
-                db_entity.pop('_expected_mqtt_state', None)
+                self.device_database.pop_runtime(entity_id, '_expected_mqtt_state')
+                self._mark_command_echo(entity_id)
                 return False
 
             click_type = attributes.get('click_type') or attributes.get('event_type')
@@ -281,7 +281,8 @@ class HAWebSocketClient:
             if expected_state is not None:
                 if is_on == expected_state:
                     log_deeptrace(f"Эхо подавлено для {entity_id} (ожидалось: {expected_state})")
-                    db_entity.pop('_expected_mqtt_state', None)
+                    self.device_database.pop_runtime(entity_id, '_expected_mqtt_state')
+                    self._mark_command_echo(entity_id)
                 else:
                     log_deeptrace(f"Промежуточное состояние {entity_id} ({is_on}), ждём {expected_state}")
                 return False
@@ -292,13 +293,13 @@ class HAWebSocketClient:
                 log_deeptrace(f"Состояние {entity_id} не изменилось ({is_on}), пропуск")
                 return False
 
-            last_ts = db_entity.get('_last_state_change_ts', 0)
+            last_ts = self.device_database.get_runtime(entity_id, '_last_state_change_ts', 0)
             now = time.time()
             if now - last_ts < 0.5:
                 log_deeptrace(f"Слишком частое переключение {entity_id}, пропуск")
                 return False
 
-            db_entity['_last_state_change_ts'] = now
+            self.device_database.set_runtime(entity_id, '_last_state_change_ts', now)
             self.device_database.change_state(entity_id, 'on_off', is_on)
 
         if category == 'light':
@@ -306,6 +307,12 @@ class HAWebSocketClient:
 
         return True
 
+    def _mark_command_echo(self, entity_id):
+        """Эхо команды Сбера получено от HA — отмечаем этап в трассировке команды."""
+        trace = self.device_database.pop_runtime(entity_id, '_command_trace')
+        if trace is not None:
+            trace.mark('ha_echo')
+
     def _handle_vacuum(self, entity_id, ha_state: str, attributes: dict) -> bool:
         """Обновление состояний пылесоса из события HA state_changed."""
         from ha_entity_updater import HAEntityUpdater
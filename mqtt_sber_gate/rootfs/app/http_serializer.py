@@ -10,24 +10,36 @@ class HttpSerializer:
     def build_http_devices_list(self):
         """Генерация упрощенного списка устройств для UI/HTTP API."""
         device_list = []
-        for entity_id, device in self.devices_db.devices_registry.items():
-            device_info = {
-                'id': entity_id,
-                'name': device.get('name', ''),
-                'default_name': device.get('default_name', ''),
-                'nicknames': device.get('nicknames', []),
-                'home': device.get('home', ''),
-                'room': device.get('room', ''),
-                'groups': device.get('groups', []),
-                'model_id': device.get('model_id', ''),
-                'category': device.get('category', ''),
-                'hw_version': device.get('hw_version', ''),
-                'sw_version': device.get('sw_version', '')
-            }
-            device_list.append(device_info)
+        with self.devices_db.read_lock():
+            for entity_id, device in self.devices_db.devices_registry.items():
+                device_info = {
+                    'id': entity_id,
+                    'name': device.get('name', ''),
+                    'default_name': device.get('default_name', ''),
+                    'nicknames': device.get('nicknames', []),
+                    'home': device.get('home', ''),
+                    'room': device.get('room', ''),
+                    'groups': device.get('groups', []),
+                    'model_id': device.get('model_id', ''),
+                    'category': device.get('category', ''),
+                    'hw_version': device.get('hw_version', ''),
+                    'sw_version': device.get('sw_version', '')
+                }
+                device_list.append(device_info)
 
         return json.dumps({'devices': device_list})
 
     def build_http_devices_list_full(self):
         """Возвращает всю базу данных в формате JSON."""
-        return json.dumps({'devices': self.devices_db.devices_registry})
+        with self.devices_db.read_lock():
+            devices = {entity_id: self.devices_db.export_device(entity_id) for entity_id in self.devices_db.devices_registry}
+        return json.dumps({'devices': devices})
+
+    def build_http_devices_page(self, offset, limit):
+        """Возвращает одну страницу базы данных в формате JSON (для больших установок)."""
+        devices, total = self.devices_db.list_devices(offset, limit)
+        return json.dumps({'devices': devices, 'total': total, 'offset': offset, 'limit': limit})
+
+    def build_http_devices_changes(self, since, epoch=None):
+        """Только изменения базы после номера since (инкрементальная синхронизация UI)."""
+        return json.dumps(self.devices_db.changes_since(since, epoch))
@@ -1,22 +1,143 @@
+import hashlib
 import json
+import os
+import random
 import ssl
+import threading
+import time
 import paho.mqtt.client as mqtt
 from logger import log_info, log_error, log_warning, log_debug, log_deeptrace
-from config import update_option
+from config import update_option, read_json_file, write_json_file, MQTT_STATE_FILE_PATH
 from converters import sber_hsv_to_rgb
+from status_coalescer import StatusCoalescer
+from rate_limiter import TokenBucket
+from command_dispatcher import CommandDispatcher
+from status_outbox import StatusOutbox
+from command_tracer import CommandTracer
+from connection_supervisor import ConnectionSupervisor, SupervisedClient, HEALTH_ONLINE, HEALTH_DEGRADED
 
 class SberMQTTClient:
     """
     Клиент для взаимодействия с MQTT-брокером Сбера.
     Обеспечивает получение команд и отправку состояний устройств.
     """
+    # Повторный config_request в течение этого времени (сек) при неизменной
+    # конфигурации не приводит к повторной публикации
+    CONFIG_REQUEST_DEDUP_WINDOW = 30
+    # Количество устройств в одной порции при отправке буфера после переподключения
+    OUTBOX_FLUSH_BATCH = 100
+    # Синхронизация после переподключения растягивается примерно на это время (сек)
+    # со случайной задержкой, чтобы не отправлять состояния всех устройств одним залпом
+    RESYNC_SPREAD = 3.0
+    RESYNC_JITTER = 1.0
+
     def __init__(self, device_database, sber_serializer, config_options):
         """Инициализация MQTT клиента Сбера."""
         self.device_database = device_database
         self.sber_serializer = sber_serializer
         self.config_options = config_options
         self.ha_client = None  # Устанавливается через set_ha_client
-        self.mqtt_client = mqtt.Client()
+        # Сокетом владеет сетевой поток paho, паузы между переподключениями задаёт ConnectionSupervisor
+        self.mqtt_client = SupervisedClient()
+        self.connected = False
+        self.connection = ConnectionSupervisor(
+            self.mqtt_client, max_delay=self.config_options.get('sber-mqtt_reconnect_max_delay', 60) or 60)
+
+        # Подтверждение доставки публикаций: {mid: коллбэк или None}, вызывается из on_publish.
+        # on_publish может прийти раньше, чем publish() вернёт mid, — такие mid запоминаются
+        # в _published_early и подтверждаются сразу после publish()
+        self._publish_lock = threading.Lock()
+        self._delivery_callbacks = {}
+        self._published_early = set()
+
+        # Хэш последней доставленной конфигурации сохраняется между запусками,
+        # чтобы не публиковать в Сбер ту же самую конфигурацию повторно
+        self.mqtt_state = read_json_file(MQTT_STATE_FILE_PATH) if os.path.exists(MQTT_STATE_FILE_PATH) else {}
+        self.config_hash_published = self.mqtt_state.get('config_hash')
+        self.config_published_at = 0.0
+        self.config_publish_count = 0
+        self.config_publish_suppressed = 0
+
+        # Ограничение размера одного сообщения (байт), 0 — без ограничения
+        self.max_payload_size = self.config_options.get('sber-mqtt_max_payload_size', 0) or 0
+        self.status_messages_sent = 0
+        self.status_send_failures = 0
+        self.status_chunked_count = 0
+        self.status_chunks_sent = 0
+        self.status_chunk_bytes_last = 0
+        self.status_chunk_bytes_max = 0
+        self.config_oversize_count = 0
+
+        # Объединение частых изменений состояний в одну публикацию /up/status
+        coalesce_ms = self.config_options.get('sber-mqtt_status_coalesce_ms', 100)
+        self.status_coalescer = StatusCoalescer(self.publish_changed_states, coalesce_ms / 1000.0)
+
+        # Ограничение частоты публикаций (сообщений в секунду) — отдельно для /up/status и /up/config.
+        # Пока токенов нет, обновления откладываются; повторные обновления тех же устройств
+        # объединяются, поэтому отправляется последнее состояние, а очередь не растёт.
+        self.status_bucket = TokenBucket(self.config_options.get('sber-mqtt_status_rate_limit', 10) or 0)
+        self.config_bucket = TokenBucket(self.config_options.get('sber-mqtt_config_rate_limit', 0.2) or 0)
+        self._rate_lock = threading.Lock()
+        self._status_lock = threading.Lock()
+        self._deferred_status = {}  # {entity_id: True — дельта, False — полное состояние}
+        self._deferred_status_all = False
+        self._deferred_status_callbacks = []  # коллбэки доставки отложенных публикаций
+        self._status_retry_timer = None
+        self._deferred_config = None  # None — нет отложенной публикации, иначе значение force
+        self._config_retry_timer = None
+        self.status_deferred_count = 0
+        self.status_merged_count = 0
+        self.config_deferred_count = 0
+        self.config_merged_count = 0
+
+        # Обновления за время отсутствия связи с брокером накапливаются (по одному на устройство)
+        # и отправляются после переподключения; при необходимости буфер сохраняется между запусками
+        self.status_outbox = StatusOutbox(self.config_options.get('sber-mqtt_outbox_size', 5000))
+        self.outbox_persist = self.config_options.get('sber-mqtt_outbox_persist', False)
+        if self.outbox_persist:
+            self.status_outbox.load(self.mqtt_state.get('outbox'))
+        self._outbox_config = None  # None — конфигурация не ожидает отправки, иначе значение force
+        # Буфер отправляет один поток: повторное подключение во время отправки только
+        # запрашивает ещё один проход (_outbox_flush_requested)
+        self._outbox_flushing = False
+        self._outbox_flush_requested = False
+
+        # «Поколение» опубликованного состояния устройства — DeviceState.seq на момент публикации:
+        # отправленное и подтверждённое (сообщение передано брокеру, on_publish).
+        # После переподключения повторно отправляются только устройства, изменившиеся
+        # после последней подтверждённой публикации.
+        self._sent_generation = {}
+        self._confirmed_generation = {}
+        self._has_connected = False
+        self.resync_count = 0
+        self.resync_entities_last = 0
+        self.resync_time_last = 0.0
+        # Подтверждённые опубликованные значения сохраняются при остановке: после запуска
+        # отправляются только устройства, состояния которых отличаются от них
+        self.resync_persist = self.config_options.get('sber-mqtt_resync_persist', True)
+        published = self.mqtt_state.pop('published', None)
+        if published is not None:
+            if self.resync_persist:
+                self.sber_serializer.load_published(published)
+                log_info(f"Загружены опубликованные в прошлом запуске состояния: {len(published)} устройств")
+            # Сохранённые значения действительны только для одного запуска
+            self._save_mqtt_state()
+
+        # Запросы к HA по командам Сбера выполняются в пуле потоков, а не в сетевом потоке paho:
+        # медленный ответ HA не должен задерживать keepalive и приём сообщений
+        self.command_dispatcher = CommandDispatcher(self.config_options.get('sber-mqtt_command_workers', 4))
+        # Подтверждение команды (статус всех её устройств) отправляется после выполнения запросов к HA
+        # или, в «оптимистичном» режиме, сразу после разбора команды
+        self.optimistic_ack = self.config_options.get('sber-mqtt_optimistic_ack', False)
+        self.command_ack_count = 0
+        self.command_ack_devices = 0
+        self.command_ack_published = 0
+        self.command_ack_deferred = 0
+        self.command_ack_held = 0
+        self.command_ack_time_last = 0.0
+        self.command_ack_time_max = 0.0
+        # Сквозная трассировка команд: Сбер -> агент -> HA -> Сбер (/api/v2/traces)
+        self.command_tracer = CommandTracer()
         
         # Структура топиков SberDevice MQTT
         self.sber_user_login = self.config_options.get('sber-mqtt_login', 'UNKNOWN_USER')
@@ -40,11 +161,23 @@ class SberMQTTClient:
             # Подписка на команды и обновления конфигурации
             client.subscribe(f"{self.downlink_topic}/#", qos=0)
             client.subscribe("sberdevices/v1/__config", qos=0)
+            # После переподключения отправляем то, что могло не дойти до Сбера
+            if self._has_connected:
+                self._queue_resync()
+            self._has_connected = True
+            self.connected = True
+            self.connection.on_connected()
+            # Накопленное за время без связи отправляется порциями, затем — живые обновления
+            self._start_outbox_flush()
         else:
             log_error(f"Ошибка подключения к брокеру SberDevices (rc: {reason_code})")
+            self.connection.on_connect_refused(mqtt.connack_string(reason_code))
 
     def on_disconnect(self, client, userdata, reason_code):
         """Обработчик отключения от брокера."""
+        self.connected = False
+        self.status_outbox.hold()
+        self.connection.on_connection_lost()
         if reason_code != 0:
             log_error(f"Неожиданное отключение от MQTT (rc: {reason_code}). Автореконнект включен.")
 
@@ -52,28 +185,396 @@ class SberMQTTClient:
         """Общий обработчик входящих MQTT сообщений."""
         log_deeptrace(f"MQTT сообщение: {message.topic} (QoS: {message.qos}) -> {message.payload}")
 
+    def on_publish(self, client, userdata, mid):
+        """
+        Сообщение передано брокеру (QoS 0 — записано в сокет, QoS 1 — получен PUBACK):
+        вызываем коллбэк подтверждения, если он был задан.
+        """
+        with self._publish_lock:
+            if mid in self._delivery_callbacks:
+                callback = self._delivery_callbacks.pop(mid)
+            else:
+                callback = None
+                self._published_early.add(mid)
+        if callback:
+            callback()
+
+    def _publish(self, topic, payload, qos=0, on_delivered=None):
+        """
+        Публикация с необязательным коллбэком подтверждения доставки.
+        Возвращает True, если сообщение принято клиентом paho к отправке.
+        publish() вызывается без _publish_lock: on_publish выполняется в сетевом потоке paho
+        под его внутренними блокировками и сам берёт _publish_lock.
+        """
+        info = self.mqtt_client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (qos and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            log_warning(f"Публикация в {topic} не выполнена (rc: {info.rc})")
+            return False
+        # Сообщение QoS 1 без связи paho оставляет в очереди и отправляет после переподключения:
+        # оно считается принятым, а его PUBACK обрабатывается on_publish как обычно
+        with self._publish_lock:
+            delivered = info.mid in self._published_early
+            if delivered:
+                self._published_early.discard(info.mid)
+            else:
+                self._delivery_callbacks[info.mid] = on_delivered
+        if delivered and on_delivered:
+            on_delivered()
+        return True
+
     def on_subscribe_success(self, client, userdata, mid, granted_qos):
         """Обработчик успешной подписки на топик."""
         log_info(f"Подписка успешна (MID: {mid}, QoS: {granted_qos})")
 
-    def send_status(self, status_payload):
-        """Отправка текущего статуса устройств в Сбер."""
-        status_topic = f"{self.uplink_topic}/status"
-        self.mqtt_client.publish(status_topic, status_payload, qos=0)
+    def send_status(self, status_payload, on_delivered=None):
+        """
+        Отправка текущего статуса устройств в Сбер. Пустой payload (нет изменений) не отправляется.
+        Возвращает False, если сообщение не принято к отправке (нет связи с брокером).
+        """
+        if not status_payload:
+            return True
+        if not self._publish(f"{self.uplink_topic}/status", status_payload, qos=0, on_delivered=on_delivered):
+            return False
+        self.status_messages_sent += 1
+        return True
+
+    def send_status_chunks(self, chunks, on_delivered=None):
+        """
+        Последовательная отправка статуса, разбитого на несколько сообщений. False — не всё отправлено.
+        on_delivered вызывается для каждого переданного брокеру сообщения.
+        """
+        if len(chunks) > 1:
+            self.status_chunked_count += 1
+            log_debug(f"Статус устройств разбит на {len(chunks)} сообщений (до {self.max_payload_size} байт)")
+        sent_all = True
+        for chunk in chunks:
+            if not self.send_status(chunk, on_delivered):
+                sent_all = False
+                continue
+            self.status_chunks_sent += 1
+            self.status_chunk_bytes_last = len(chunk)
+            self.status_chunk_bytes_max = max(self.status_chunk_bytes_max, len(chunk))
+        return sent_all
+
+    def queue_status(self, entity_ids):
+        """Устройства, состояния которых изменились: отправляются в Сбер пакетом после окна объединения."""
+        self.status_coalescer.add(entity_ids)
+
+    def publish_changed_states(self, entity_ids):
+        """Отправка только изменившихся функций указанных устройств (дельта)."""
+        self._submit_states(entity_ids, delta=True)
+
+    def close(self):
+        """
+        Выполнение принятых команд, отправка накопленных и отложенных обновлений
+        и отключение от брокера (вызывается при остановке).
+        """
+        self.command_dispatcher.close()
+        self.status_coalescer.close()
+        with self._rate_lock:
+            for timer in (self._status_retry_timer, self._config_retry_timer):
+                if timer is not None:
+                    timer.cancel()
+            self._status_retry_timer = self._config_retry_timer = None
+            deferred_config = self._deferred_config
+            self._deferred_config = None
+        # При остановке отложенное отправляется без учёта ограничения частоты
+        self._send_deferred_states(paid=0)
+        if deferred_config is not None:
+            self._publish_config(deferred_config, limited=False)
+        if self.outbox_persist:
+            self.mqtt_state['outbox'] = self.status_outbox.to_dict()
+        if self.resync_persist:
+            confirmed = [entity_id for entity_id, generation in self._confirmed_generation.items()
+                         if self._sent_generation.get(entity_id) == generation]
+            self.mqtt_state['published'] = self.sber_serializer.export_published(confirmed)
+        if self.outbox_persist or self.resync_persist:
+            self._save_mqtt_state()
+        self.connection.stop()
+
+    def resync_states(self):
+        """
+        Публикация состояний всех устройств, отличающихся от последних опубликованных
+        (при запуске — от подтверждённых в прошлом запуске): только изменившиеся функции.
+        """
+        self._submit_states(None, delta=True)
+
+    def _queue_resync(self):
+        """Устройства, изменившиеся после последней подтверждённой публикации, — в буфер на отправку."""
+        stale = [entity_id for entity_id in self.device_database.get_enabled_ids()
+                 if self._confirmed_generation.get(entity_id, -1) < self.device_database.get_state_seq(entity_id)]
+        if stale:
+            # Что из отправленного дошло до Сбера, неизвестно — эти устройства отправляются полностью
+            self.sber_serializer.forget_published(stale)
+            self.status_outbox.add(stale)
+        log_debug(f"После переподключения требуется синхронизация устройств: {len(stale)}")
+
+    def _track_delivery(self, rendered, on_delivered=None):
+        """
+        Коллбэк для сообщений render: когда все они переданы брокеру, поколения устройств
+        подтверждаются и вызывается on_delivered.
+        """
+        generations = rendered.generations
+        self._sent_generation.update(generations)
+        if not rendered.chunks:
+            self._confirm_generations(generations)
+            if on_delivered:
+                on_delivered()
+            return None
+        remaining = [len(rendered.chunks)]
+
+        def delivered():
+            with self._publish_lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self._confirm_generations(generations)
+                if on_delivered:
+                    on_delivered()
+        return delivered
+
+    def _confirm_generations(self, generations):
+        confirmed = self._confirmed_generation
+        for entity_id, generation in generations.items():
+            if generation > confirmed.get(entity_id, -1):
+                confirmed[entity_id] = generation
+
+    def _start_outbox_flush(self):
+        """Запуск отправки буфера после подключения (если поток отправки уже работает — ещё один проход)."""
+        with self._rate_lock:
+            self._outbox_flush_requested = True
+            if self._outbox_flushing:
+                return
+            self._outbox_flushing = True
+        threading.Thread(target=self._run_outbox_flush, name="sber-outbox", daemon=True).start()
+
+    def _run_outbox_flush(self):
+        """Поток отправки буфера: проходы _flush_outbox, пока они запрашиваются."""
+        while True:
+            with self._rate_lock:
+                if not self._outbox_flush_requested:
+                    self._outbox_flushing = False
+                    return
+                self._outbox_flush_requested = False
+            try:
+                if not self._flush_outbox() and self.connected:
+                    # Публикация не выполнена, хотя связь есть — повторим отправку остатка позже
+                    time.sleep(self.RESYNC_JITTER)
+                    with self._rate_lock:
+                        self._outbox_flush_requested = True
+            except Exception as e:
+                log_error(f"Ошибка отправки буфера состояний: {e}")
+
+    def _flush_outbox(self):
+        """
+        Отправка накопленного за время отсутствия связи порциями, затем возврат к живой публикации.
+        Порции распределяются примерно на RESYNC_SPREAD секунд со случайной задержкой.
+        При выходе буфер не остаётся активным без отправителя: при наличии связи обновления снова
+        публикуются сразу (остаток буфера отправит следующий проход), без связи — накапливаются.
+        Возвращает False, если отправка прервана неудачной публикацией.
+        """
+        try:
+            with self._rate_lock:
+                config_force = self._outbox_config
+                self._outbox_config = None
+            if config_force is not None:
+                self.publish_config(config_force)
+            size = self.status_outbox.get_stats()['size']
+            total = len(self.device_database.get_enabled_ids()) if size == 'all' else size
+            # Обновления, пришедшие во время отправки, тоже попадают в буфер — отправляются без паузы
+            pause = 0.0
+            if total:
+                batches = -(-total // self.OUTBOX_FLUSH_BATCH)
+                pause = min(self.RESYNC_JITTER, self.RESYNC_SPREAD / batches)
+                time.sleep(random.uniform(0, self.RESYNC_JITTER))
+            started = time.monotonic()
+            sent = 0
+            while self.connected:
+                batch, delta = self.status_outbox.take(self.OUTBOX_FLUSH_BATCH)
+                if batch == []:
+                    if sent:
+                        self.resync_count += 1
+                        self.resync_entities_last = sent
+                        self.resync_time_last = time.monotonic() - started
+                        log_info(f"Синхронизация состояний с Сбером: {sent} устройств "
+                                 f"за {self.resync_time_last:.1f} с")
+                    if self.outbox_persist:
+                        self.mqtt_state['outbox'] = self.status_outbox.to_dict()
+                        self._save_mqtt_state()
+                    return True
+                if sent:
+                    time.sleep(pause * random.uniform(0.5, 1.5))
+                # None — все включённые устройства на момент отправки
+                sent += len(self.device_database.get_enabled_ids()) if batch is None else len(batch)
+                failures = self.status_send_failures
+                # Дельта (например, синхронизация при запуске) отправляется как дельта — только то,
+                # что отличается от опубликованного; полные состояния — полностью
+                self._submit_states(batch, delta=delta, live=False)
+                if self.status_send_failures != failures:
+                    # Связь снова потеряна — продолжим после следующего подключения (on_connect)
+                    return False
+            return True
+        finally:
+            if self.connected:
+                self.status_outbox.release()
+            else:
+                self.status_outbox.hold()
+
+    def _save_mqtt_state(self):
+        """Сохранение состояния клиента (mqtt_state.json) на диск."""
+        try:
+            write_json_file(MQTT_STATE_FILE_PATH, self.mqtt_state)
+        except OSError as e:
+            log_error(f"Не удалось сохранить {MQTT_STATE_FILE_PATH}: {e}")
+
+    def publish_states(self, entity_ids=None):
+        """Публикация полного статуса устройств (None — все включённые) с учётом ограничения размера."""
+        self._submit_states(entity_ids, delta=False)
+
+    def _submit_states(self, entity_ids, delta, live=True, on_delivered=None):
+        """
+        Отправка состояний с учётом ограничения частоты.
+        Если токенов нет (или уже есть отложенные обновления), устройства добавляются
+        к отложенным и будут отправлены одной публикацией, когда появится токен.
+        Живые обновления (live) при отсутствии связи сохраняются в буфер status_outbox.
+        on_delivered вызывается, когда публикация с этими устройствами передана брокеру
+        (для устройств, сохранённых в буфер, — не вызывается).
+        Возвращает 'sent' — опубликовано сразу, 'deferred' — отложено ограничением частоты,
+        'held' — сохранено в буфер до появления связи.
+        """
+        if live and self.status_outbox.offer(entity_ids, delta):
+            return 'held'
+        with self._rate_lock:
+            if not self._has_deferred_states() and self.status_bucket.try_acquire():
+                deferred = False
+            else:
+                deferred = True
+                self._defer_states(entity_ids, delta)
+                if on_delivered:
+                    self._deferred_status_callbacks.append(on_delivered)
+        if deferred:
+            return 'deferred'
+        return 'sent' if self._send_states(entity_ids, delta, paid=1, on_delivered=on_delivered) else 'held'
+
+    def _has_deferred_states(self):
+        return self._deferred_status_all or bool(self._deferred_status)
+
+    def _defer_states(self, entity_ids, delta):
+        """Добавление устройств к отложенным (под _rate_lock). Повторные обновления объединяются."""
+        if not self._has_deferred_states():
+            self.status_deferred_count += 1
+            log_debug(f"Превышена частота публикаций /up/status, отправка отложена "
+                      f"на {self.status_bucket.wait_time():.2f} с")
+        if entity_ids is None:
+            # Полный статус всех устройств поглощает всё отложенное ранее
+            self.status_merged_count += len(self._deferred_status) + int(self._deferred_status_all)
+            self._deferred_status_all = True
+            self._deferred_status = {}
+        elif self._deferred_status_all:
+            self.status_merged_count += len(entity_ids)
+        else:
+            pending = self._deferred_status
+            for entity_id in entity_ids:
+                if entity_id in pending:
+                    self.status_merged_count += 1
+                    # Полное состояние включает в себя дельту
+                    pending[entity_id] = pending[entity_id] and delta
+                else:
+                    pending[entity_id] = delta
+        if self._status_retry_timer is None:
+            self._status_retry_timer = self._start_retry_timer(self.status_bucket, self._on_status_retry)
+
+    @staticmethod
+    def _start_retry_timer(bucket, callback):
+        timer = threading.Timer(max(bucket.wait_time(), 0.01), callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _on_status_retry(self):
+        with self._rate_lock:
+            self._status_retry_timer = None
+            if not self.status_bucket.try_acquire():
+                self._status_retry_timer = self._start_retry_timer(self.status_bucket, self._on_status_retry)
+                return
+        try:
+            self._send_deferred_states(paid=1)
+        except Exception as e:
+            log_error(f"Ошибка отправки отложенных состояний: {e}")
+
+    def _send_deferred_states(self, paid):
+        """Отправка всех отложенных устройств: сначала полные состояния, затем дельты."""
+        with self._rate_lock:
+            send_all, pending = self._deferred_status_all, self._deferred_status
+            callbacks = self._deferred_status_callbacks
+            self._deferred_status_all = False
+            self._deferred_status = {}
+            self._deferred_status_callbacks = []
+        if send_all:
+            self._send_states(None, delta=False, paid=paid, on_delivered=self._join_callbacks(callbacks, 1))
+            return
+        full_ids = [entity_id for entity_id, delta in pending.items() if not delta]
+        delta_ids = [entity_id for entity_id, delta in pending.items() if delta]
+        # Коллбэки отложенных публикаций вызываются, когда доставлены все части этой отправки
+        on_delivered = self._join_callbacks(callbacks, int(bool(full_ids)) + int(bool(delta_ids)))
+        if full_ids:
+            self._send_states(full_ids, delta=False, paid=paid, on_delivered=on_delivered)
+            paid = 0
+        if delta_ids:
+            self._send_states(delta_ids, delta=True, paid=paid, on_delivered=on_delivered)
+        elif paid:
+            self.status_bucket.consume(-paid)
+
+    def _join_callbacks(self, callbacks, count):
+        """Один коллбэк, который после count вызовов вызывает все callbacks (None — вызывать нечего)."""
+        if not callbacks or not count:
+            return None
+        remaining = [count]
+
+        def joined():
+            with self._publish_lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                for callback in callbacks:
+                    callback()
+        return joined
+
+    def _send_states(self, entity_ids, delta, paid=0, on_delivered=None):
+        """
+        Формирование и отправка состояний. paid — сколько токенов уже взято:
+        недостающие списываются по числу фактически отправленных сообщений.
+        on_delivered вызывается, когда все сообщения переданы брокеру.
+        Возвращает False, если отправить не удалось (устройства сохранены в буфер).
+        """
+        with self._status_lock:
+            rendered = self.sber_serializer.render_states(entity_ids, delta=delta, max_size=self.max_payload_size)
+            sent = self.send_status_chunks(rendered.chunks, self._track_delivery(rendered, on_delivered))
+            if not sent:
+                # Связь потеряна — устройства будут отправлены после переподключения (полностью:
+                # что из отправленного дошло до Сбера, неизвестно)
+                self.status_send_failures += 1
+                self.status_outbox.add(None if entity_ids is None else list(rendered.published), delta=False)
+            self.status_bucket.consume(len(rendered.chunks) - paid)
+            self.sber_serializer.commit_published(rendered)
+        return sent
 
     def handle_command_message(self, client, userdata, message):
         """Обработка команд управления устройствами от Сбера."""
+        trace = self.command_tracer.start()
         try:
             command_data = json.loads(message.payload)
         except json.JSONDecodeError:
             log_error(f"Ошибка декодирования команды: {message.payload}")
             return
+        trace.mark('parsed')
 
-        log_debug(f"Получена команда от Сбера через MQTT: {command_data}")
-        
-        last_entity_id = None
+        log_debug(f"Получена команда от Сбера через MQTT (трассировка {trace.trace_id}): {command_data}")
+
+        entity_ids = []
+        ha_commands = []
         for entity_id, device_data in command_data.get('devices', {}).items():
-            last_entity_id = entity_id
+            entity_ids.append(entity_id)
             state_changes = {}
             
             for state_item in device_data.get('states', []):
@@ -112,29 +613,90 @@ class SberMQTTClient:
                 self.device_database.change_state(entity_id, key, new_value)
                 
                 # Устанавливаем ожидаемое состояние для фильтрации эха
-                device_info = self.device_database.devices_registry.get(entity_id, {})
-                device_info['_expected_mqtt_state'] = new_value
+                if self.device_database.is_device_in_base(entity_id):
+                    self.device_database.set_runtime(entity_id, '_expected_mqtt_state', new_value)
+                    # По эху отмечается этап ha_echo трассировки
+                    self.device_database.set_runtime(entity_id, '_command_trace', trace)
 
-            # Передаем команду в Home Assistant
+            # Запрос в Home Assistant (выполняется в пуле потоков, по очереди для каждого устройства)
             if self.ha_client:
-                device_info = self.device_database.devices_registry.get(entity_id, {})
-                if device_info.get('entity_type') == 'climate':
-                    self.ha_client.set_climate_temperature(entity_id, state_changes)
-                elif device_info.get('entity_type') == 'vacuum':
-                    # Команды пылесоса приходят как vacuum_cleaner_command
-                    vacuum_command = self.device_database.get_state(entity_id, 'vacuum_cleaner_command')
-                    if vacuum_command:
-                        self.ha_client.send_vacuum_command(entity_id, vacuum_command)
-                    else:
-                        log_warning(f"Получена команда пылесосу {entity_id}, но vacuum_cleaner_command пуст")
-                elif device_info.get('entity_ha', False):
-                    self.ha_client.toggle_device_state(entity_id)
-                else:
-                    log_info(f"Устройство не найдено или не управляется HA: {entity_id}")
-        
-        # Отправляем подтверждение с обновленным статусом
-        if last_entity_id:
-            self.send_status(self.sber_serializer.build_mqtt_states_payload([last_entity_id]))
+                ha_command = self._build_ha_command(entity_id, state_changes)
+                if ha_command:
+                    ha_commands.append((entity_id, self._traced_ha_command(trace, ha_command)))
+
+        trace.devices = entity_ids
+        trace.mark('db_updated')
+        if not entity_ids:
+            return
+        # Одно подтверждение со статусом всех устройств команды
+        if self.optimistic_ack or not ha_commands:
+            self._send_command_ack(entity_ids, trace)
+            on_done = None
+        else:
+            remaining = [len(ha_commands)]
+
+            def on_done():
+                with self._publish_lock:
+                    remaining[0] -= 1
+                    done = remaining[0] == 0
+                if done:
+                    self._send_command_ack(entity_ids, trace)
+        for entity_id, ha_command in ha_commands:
+            self.command_dispatcher.submit(entity_id, ha_command, on_done)
+
+    @staticmethod
+    def _traced_ha_command(trace, ha_command):
+        """Запрос к HA с отметками начала и окончания в трассировке команды."""
+        def run():
+            trace.mark('ha_call_start')
+            started = time.monotonic()
+            try:
+                ha_command()
+            finally:
+                trace.observe('ha_call', time.monotonic() - started)
+                trace.mark('ha_call_end')
+        return run
+
+    def _send_command_ack(self, entity_ids, trace):
+        """
+        Отправка подтверждения команды: текущий статус всех её устройств одной публикацией.
+        Этап ack_published отмечается, когда сообщение передано брокеру (on_publish). Если публикация
+        отложена ограничением частоты или сохранена в буфер без связи — отмечается ack_deferred / ack_held.
+        """
+        self.command_ack_count += 1
+        self.command_ack_devices += len(entity_ids)
+        outcome = self._submit_states(entity_ids, delta=False,
+                                      on_delivered=lambda: self._on_command_ack_published(trace))
+        if outcome == 'deferred':
+            self.command_ack_deferred += 1
+            trace.mark('ack_deferred')
+        elif outcome == 'held':
+            self.command_ack_held += 1
+            trace.mark('ack_held')
+
+    def _on_command_ack_published(self, trace):
+        trace.mark('ack_published')
+        elapsed = time.monotonic() - trace.stages['received']
+        self.command_ack_published += 1
+        self.command_ack_time_last = elapsed
+        self.command_ack_time_max = max(self.command_ack_time_max, elapsed)
+
+    def _build_ha_command(self, entity_id, state_changes):
+        """Запрос к HA по команде Сбера (функция без аргументов) или None, если устройство не управляется HA."""
+        device_info = self.device_database.devices_registry.get(entity_id, {})
+        if device_info.get('entity_type') == 'climate':
+            return lambda: self.ha_client.set_climate_temperature(entity_id, state_changes)
+        elif device_info.get('entity_type') == 'vacuum':
+            # Команды пылесоса приходят как vacuum_cleaner_command
+            vacuum_command = self.device_database.get_state(entity_id, 'vacuum_cleaner_command')
+            if vacuum_command:
+                return lambda: self.ha_client.send_vacuum_command(entity_id, vacuum_command)
+            log_warning(f"Получена команда пылесосу {entity_id}, но vacuum_cleaner_command пуст")
+        elif device_info.get('entity_ha', False):
+            return lambda: self.ha_client.toggle_device_state(entity_id)
+        else:
+            log_info(f"Устройство не найдено или не управляется HA: {entity_id}")
+        return None
 
     def handle_status_request(self, client, userdata, message):
         """Обработка запроса текущего состояния устройств."""
@@ -145,14 +707,15 @@ class SberMQTTClient:
             device_ids = []
             
         log_debug(f"Получен запрос статуса для: {device_ids}")
-        response_payload = self.sber_serializer.build_mqtt_states_payload(device_ids)
-        self.send_status(response_payload)
+        # Пустой список — запрос статуса всех устройств
+        self.publish_states(device_ids or None)
 
     def handle_config_request(self, client, userdata, message):
         """Обработка запроса конфигурации устройств."""
         log_info("Получен запрос конфигурации устройств")
-        config_payload = self.sber_serializer.build_mqtt_devices_payload()
-        self.mqtt_client.publish(f"{self.uplink_topic}/config", config_payload, qos=0)
+        # Сбер явно просит конфигурацию — отвечаем, кроме повторов той же конфигурации подряд
+        recently = time.monotonic() - self.config_published_at < self.CONFIG_REQUEST_DEDUP_WINDOW
+        self.publish_config(force=not recently)
 
     def handle_global_config(self, client, userdata, message):
         """Обработка глобальной конфигурации от Сбера."""
@@ -174,6 +737,7 @@ class SberMQTTClient:
         self.mqtt_client.on_subscribe = self.on_subscribe_success
         self.mqtt_client.on_message = self.on_message_received
         self.mqtt_client.on_disconnect = self.on_disconnect
+        self.mqtt_client.on_publish = self.on_publish
         
         # Коллбэки для конкретных топиков
         self.mqtt_client.message_callback_add("sberdevices/v1/__config", self.handle_global_config)
@@ -196,19 +760,161 @@ class SberMQTTClient:
         self.mqtt_client.tls_insecure_set(True)
 
     def start(self):
-        """Подключение к брокеру и запуск цикла обработки сообщений."""
+        """
+        Запуск подключения к брокеру в отдельном потоке (не блокирует).
+        При ошибке подключения или разрыве соединения попытки повторяются с растущей задержкой.
+        """
         broker_host = self.config_options.get('sber-mqtt_broker', 'mqtt.sberdevices.ru')
         broker_port = self.config_options.get('sber-mqtt_broker_port', 8883)
         log_info(f"Подключение к брокеру Sber MQTT: {broker_host}:{broker_port}")
-        
+        self.connection.start(broker_host, broker_port, keepalive=60)
+
+    def get_connection_status(self):
+        """Состояние связи с брокером для /api/v1/status."""
+        stats = self.connection.get_stats()
+        return {
+            'online': stats['health'] in (HEALTH_ONLINE, HEALTH_DEGRADED) and self.connected,
+            'health': stats['health'],
+            'error': stats['last_error'],
+            'connection': stats,
+        }
+
+    def publish_config(self, force=False):
+        """
+        Публикация конфигурации всех включенных устройств в Сбер.
+        Если конфигурация совпадает с последней доставленной (в т.ч. в прошлом запуске),
+        публикация пропускается, если не указан force.
+        При превышении частоты публикация откладывается; повторные вызовы до её отправки
+        объединяются в одну, с актуальной на момент отправки конфигурацией.
+        Возвращает True, если конфигурация отправлена.
+        """
+        with self._rate_lock:
+            if self._deferred_config is not None:
+                self._deferred_config = self._deferred_config or force
+                self.config_merged_count += 1
+                return False
+        return self._publish_config(force)
+
+    def _on_config_retry(self):
+        with self._rate_lock:
+            self._config_retry_timer = None
+            force = self._deferred_config
+            self._deferred_config = None
+        if force is None:
+            return
         try:
-            self.mqtt_client.connect(broker_host, broker_port, keepalive=60)
-            self.mqtt_client.loop_start()
+            self._publish_config(force)
         except Exception as e:
-            log_error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Sber MQTT: {e}")
+            log_error(f"Ошибка отложенной публикации конфигурации: {e}")
 
-    def publish_config(self):
-        """Публикация конфигурации всех включенных устройств в Сбер."""
+    def _publish_config(self, force, limited=True):
         config_payload = self.sber_serializer.build_mqtt_devices_payload()
-        self.mqtt_client.publish(f"{self.uplink_topic}/config", config_payload, qos=0)
+        config_hash = hashlib.sha256(config_payload.encode('utf-8')).hexdigest()
+        if not force and config_hash == self.config_hash_published:
+            self.config_publish_suppressed += 1
+            log_debug("Конфигурация устройств не изменилась, повторная публикация пропущена")
+            return False
+
+        if not self.connected:
+            # Конфигурация будет опубликована после подключения
+            with self._rate_lock:
+                self._outbox_config = self._outbox_config or force
+            return False
+
+        if limited:
+            with self._rate_lock:
+                if not self.config_bucket.try_acquire():
+                    self._deferred_config = force
+                    self.config_deferred_count += 1
+                    log_debug(f"Превышена частота публикаций /up/config, отправка отложена "
+                              f"на {self.config_bucket.wait_time():.2f} с")
+                    if self._config_retry_timer is None:
+                        self._config_retry_timer = self._start_retry_timer(self.config_bucket, self._on_config_retry)
+                    return False
+
+        if self.max_payload_size and len(config_payload) > self.max_payload_size:
+            # Конфигурация в Сбере заменяется целиком, поэтому её нельзя разбить на части
+            self.config_oversize_count += 1
+            log_warning(f"Конфигурация устройств ({len(config_payload)} байт) больше ограничения "
+                        f"{self.max_payload_size} байт, публикуется одним сообщением")
+
+        # QoS 1: on_publish придёт только после PUBACK брокера, поэтому хэш запоминается лишь для
+        # конфигурации, действительно полученной брокером (при разрыве paho повторит отправку сам)
+        if not self._publish(f"{self.uplink_topic}/config", config_payload, qos=1,
+                             on_delivered=lambda: self._on_config_delivered(config_hash)):
+            with self._rate_lock:
+                self._outbox_config = self._outbox_config or force
+            return False
+        self.config_publish_count += 1
         log_info("Конфигурация устройств опубликована в Sber MQTT")
+        return True
+
+    def _on_config_delivered(self, config_hash):
+        """Брокер подтвердил получение конфигурации (PUBACK) — запоминаем её хэш (и на диске — для следующего запуска)."""
+        self.config_published_at = time.monotonic()
+        if config_hash == self.config_hash_published:
+            return
+        self.config_hash_published = config_hash
+        self.mqtt_state['config_hash'] = config_hash
+        self._save_mqtt_state()
+
+    def get_stats(self):
+        """Статистика публикаций в Sber MQTT."""
+        return {
+            'config_publish_count': self.config_publish_count,
+            'config_publish_suppressed': self.config_publish_suppressed,
+            'config_hash': self.config_hash_published,
+            'config_oversize_count': self.config_oversize_count,
+            'max_payload_size': self.max_payload_size,
+            'status_messages_sent': self.status_messages_sent,
+            'status_send_failures': self.status_send_failures,
+            'status_chunked_count': self.status_chunked_count,
+            'status_chunks_sent': self.status_chunks_sent,
+            'status_chunk_bytes_last': self.status_chunk_bytes_last,
+            'status_chunk_bytes_max': self.status_chunk_bytes_max,
+            'coalescer': self.status_coalescer.get_stats(),
+            'rate_limit': self._get_rate_limit_stats(),
+            'commands': self.command_dispatcher.get_stats(),
+            'command_ack': {
+                'optimistic': self.optimistic_ack,
+                'count': self.command_ack_count,
+                'devices': self.command_ack_devices,
+                'published': self.command_ack_published,
+                'deferred': self.command_ack_deferred,
+                'held': self.command_ack_held,
+                'latency_ms_last': round(self.command_ack_time_last * 1000, 2),
+                'latency_ms_max': round(self.command_ack_time_max * 1000, 2),
+            },
+            'connected': self.connected,
+            'connection': self.connection.get_stats(),
+            'outbox': self.status_outbox.get_stats(),
+            'resync': {
+                'count': self.resync_count,
+                'entities_last': self.resync_entities_last,
+                'duration_ms_last': round(self.resync_time_last * 1000, 2),
+                'confirmed': len(self._confirmed_generation),
+                'unconfirmed': sum(1 for entity_id, generation in list(self._sent_generation.items())
+                                   if self._confirmed_generation.get(entity_id, -1) < generation),
+            },
+        }
+
+    def _get_rate_limit_stats(self):
+        with self._rate_lock:
+            return {
+                'status': {
+                    'rate': self.status_bucket.rate,
+                    'burst': self.status_bucket.capacity,
+                    'tokens': self.status_bucket.tokens,
+                    'deferred_count': self.status_deferred_count,
+                    'merged_count': self.status_merged_count,
+                    'pending': 'all' if self._deferred_status_all else len(self._deferred_status),
+                },
+                'config': {
+                    'rate': self.config_bucket.rate,
+                    'burst': self.config_bucket.capacity,
+                    'tokens': self.config_bucket.tokens,
+                    'deferred_count': self.config_deferred_count,
+                    'merged_count': self.config_merged_count,
+                    'pending': self._deferred_config is not None,
+                },
+            }
@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Ограничитель частоты «ведро токенов».
+    Токены пополняются со скоростью rate в секунду до capacity. Каждая публикация
+    расходует токен; при rate = 0 ограничение отключено.
+    consume() допускает уход в минус: сообщение, уже разбитое на части, отправляется
+    целиком, а следующие публикации ждут, пока долг не будет погашен.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: скорость пополнения (токенов в секунду), 0 — без ограничения
+        :param capacity: ёмкость ведра (максимальный «залп»), по умолчанию max(2, 2 * rate)
+        """
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity if capacity is not None else max(2.0, 2 * self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Взять токен. False — токенов нет, публикацию нужно отложить."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def consume(self, count):
+        """
+        Списать count токенов без проверки (может уйти в минус).
+        Отрицательный count возвращает неиспользованные токены (не больше ёмкости).
+        """
+        if not self.enabled or not count:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - count)
+
+    def wait_time(self):
+        """Через сколько секунд появится токен."""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    @property
+    def tokens(self):
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._refill()
+            return round(self._tokens, 2)
@@ -0,0 +1,85 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock(object):
+    """
+    Блокировка «много читателей / один писатель» с приоритетом писателя.
+
+    - Читатели не блокируют друг друга.
+    - Повторный захват на чтение в том же потоке не ждёт ожидающих писателей
+      (иначе вложенное чтение приводило бы к взаимоблокировке).
+    - Писатель реентерабелен и может читать под своей блокировкой.
+    - Повышение чтения до записи не поддерживается: это верная взаимоблокировка,
+      поэтому выбрасывается RuntimeError.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def acquire_read(self):
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        if depth == 0 and self._writer != threading.get_ident():
+            with self._cond:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+            local.counted = True
+        elif depth == 0:
+            local.counted = False
+        local.depth = depth + 1
+
+    def release_read(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0 and local.counted:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if getattr(self._local, 'depth', 0):
+                raise RuntimeError("Повышение блокировки чтения до записи не поддерживается")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -1,7 +1,9 @@
 ﻿#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import atexit
 import os
+import signal
 import sys
 import time
 from logger import (
@@ -10,6 +12,7 @@ from logger import (
 )
 from config import OPTIONS, DEVICES_DB_FILE_PATH, write_json_file, VERSION, update_option
 from devices_db import DevicesDB
+from devices_storage import create_storage
 from sber_serializer import SberMQTTSerializer
 from http_serializer import HttpSerializer
 from ha_api import HAClient
@@ -40,15 +43,24 @@ if not os.path.exists(DEVICES_DB_FILE_PATH):
     write_json_file(DEVICES_DB_FILE_PATH, {})
 
 log_info(f"Загрузка базы данных устройств из devices.json")
-device_db_manager = DevicesDB(DEVICES_DB_FILE_PATH)
+device_db_manager = DevicesDB(
+    DEVICES_DB_FILE_PATH,
+    create_storage(DEVICES_DB_FILE_PATH, OPTIONS),
+    persist_states=OPTIONS.get('db_persist_states', False)
+)
+# Несохранённые изменения базы сбрасываются на диск при любом завершении процесса
+atexit.register(device_db_manager.close)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 sber_serializer = SberMQTTSerializer(device_db_manager)
 http_serializer = HttpSerializer(device_db_manager)
 
 # Инициализация MQTT клиента Сбера
 sber_mqtt_handler = SberMQTTClient(device_db_manager, sber_serializer, OPTIONS)
+# Накопленные обновления состояний отправляются до закрытия базы (atexit выполняется в обратном порядке)
+atexit.register(sber_mqtt_handler.close)
 
 # Инициализация клиента Home Assistant
-ha_integration_client = HAClient(device_db_manager, sber_serializer, OPTIONS, sber_mqtt_handler.send_status)
+ha_integration_client = HAClient(device_db_manager, sber_serializer, OPTIONS, sber_mqtt_handler.queue_status)
 
 # Связывание MQTT клиента с клиентом HA
 sber_mqtt_handler.set_ha_client(ha_integration_client)
@@ -76,9 +88,10 @@ sber_api.init_categories()
 # Публикация конфигурации устройств в MQTT
 sber_mqtt_handler.publish_config()
 
-# Публикация текущих состояний всех устройств — чтобы Салют знал актуальное состояние с первого момента
+# Публикация текущих состояний устройств — чтобы Салют знал актуальное состояние с первого момента.
+# Отправляются только состояния, отличающиеся от подтверждённых брокером в прошлом запуске
 log_info("Публикация начальных состояний устройств в Сбер...")
-sber_mqtt_handler.send_status(sber_serializer.build_mqtt_states_payload())
+sber_mqtt_handler.resync_states()
 
 # Текущий статус агента
 agent_status_report = {
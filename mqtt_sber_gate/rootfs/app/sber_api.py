@@ -6,6 +6,8 @@ from config import OPTIONS, read_json_file, write_json_file, CATEGORIES_FILE_PAT
 
 Categories = {}
 resCategories = {'categories': []}
+# Увеличивается при каждой загрузке категорий (по нему сериализатор перекомпилирует планы)
+CategoriesVersion = 0
 
 def get_sber_headers():
     return {'content-type': 'application/json'}
@@ -62,7 +64,7 @@ def get_category():
     return Categories
 
 def init_categories():
-    global Categories, resCategories
+    global Categories, resCategories, CategoriesVersion
     Categories = get_category()
 
     if Categories.get('categories', False):
@@ -75,3 +77,4 @@ def init_categories():
     resCategories = {'categories': []}
     for id in Categories:
         resCategories['categories'].append(id)
+    CategoriesVersion += 1
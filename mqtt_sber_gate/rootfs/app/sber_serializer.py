@@ -1,9 +1,220 @@
 import json
+import threading
+import time
+from collections import namedtuple, OrderedDict
 import sber_api
 from config import VERSION
 from converters import rgb_to_sber_hsv
 from logger import log_debug, log_error, log_deeptrace, log_trace, log_warning
 
+# Функции, которые Сбер присылает нам как команды управления.
+# Их не нужно включать в статусные обновления — Сбер и так знает их значение,
+# поскольку сам их и устанавливает.
+COMMAND_ONLY_FEATURES = frozenset({'vacuum_cleaner_command'})
+
+# События: отправляются каждый раз, даже если значение совпадает с уже опубликованным
+EVENT_FEATURES = frozenset({'button_event'})
+
+# Для датчиков (sensor_temp) флаг required у этих функций игнорируется: иначе чистому
+# датчику температуры пришлось бы отправлять влажность и наоборот.
+SENSOR_OPTIONAL_FEATURES = frozenset({'temperature', 'humidity', 'air_pressure'})
+
+DEFAULT_VALUES_BY_TYPE = {
+    'BOOL': False,
+    'INTEGER': 0,
+    'ENUM': '',
+    'COLOUR': {'red': 255, 'green': 255, 'blue': 255}  # Белый в формате dict
+}
+
+# Корневой хаб — первое устройство в каждой публикации конфигурации
+ROOT_HUB_FRAGMENT = json.dumps({
+    "id": "root",
+    "name": "Вумный контроллер",
+    'hw_version': VERSION,
+    'sw_version': VERSION,
+    'model': {
+        'id': 'ID_root_hub',
+        'manufacturer': 'TM',
+        'model': 'VHub',
+        'description': "HA MQTT SberGate HUB",
+        'category': 'hub',
+        'features': ['online']
+    }
+})
+
+# Типы с небольшим набором значений кэшируются целиком, остальные — в LRU ограниченного размера
+UNBOUNDED_CACHE_TYPES = frozenset({'BOOL', 'ENUM'})
+ENCODED_CACHE_LRU_SIZE = 512
+
+# Обёртка сообщения состояний '{"devices": {...}}' без фрагментов устройств (в байтах)
+STATES_PAYLOAD_OVERHEAD = len('{"devices": {}}')
+
+# Состояния корневого хаба, если публиковать больше нечего
+ROOT_ONLINE_STATES = '{"root": {"states": [{"key": "online", "value": {"type": "BOOL", "bool_value": true}}]}}'
+
+# Результат render_states: сообщения и всё, что нужно зафиксировать после их отправки
+# (published — {entity_id: {функция: фрагмент}},
+#  db_changes — [(entity_id, функция, отправленное значение, новое значение)])
+StatesRender = namedtuple('StatesRender', (
+    'chunks', 'published', 'db_changes', 'delta', 'features_sent', 'features_skipped', 'oversize', 'generations'))
+
+# Скомпилированное описание функции категории: имя, тип, обязательность,
+# значение по умолчанию, форматтер formatter(entity_id, value) -> состояние для Сбера
+# и encoder(entity_id, value) -> то же состояние, уже закодированное в JSON (с кэшем)
+FeaturePlan = namedtuple('FeaturePlan', ('name', 'data_type', 'required', 'default', 'formatter', 'encoder'))
+
+# План категории: все функции (для конфигурации) и функции для статусов (без команд)
+CategoryPlan = namedtuple('CategoryPlan', ('category', 'features', 'state_features'))
+
+
+def _make_formatter(feature_name, data_type):
+    """Форматтер значения одной функции, специализированный под её тип данных."""
+    if data_type == 'BOOL':
+        def format_value(entity_id, value):
+            return {'key': feature_name, 'value': {'type': 'BOOL', 'bool_value': bool(value)}}
+    elif data_type == 'INTEGER':
+        def format_value(entity_id, value):
+            try:
+                value = int(value) if value is not None else 0
+            except ValueError:
+                value = 0
+            return {'key': feature_name, 'value': {'type': 'INTEGER', 'integer_value': value}}
+    elif data_type == 'ENUM':
+        def format_value(entity_id, value):
+            return {'key': feature_name, 'value': {'type': 'ENUM', 'enum_value': str(value) if value is not None else ""}}
+    elif data_type == 'COLOUR':
+        def format_value(entity_id, value):
+            # COLOUR в Сбере использует HSV формат: h (0-360), s (0-1000), v (100-1000)
+            if isinstance(value, dict):
+                r = value.get('red', 255)
+                g = value.get('green', 255)
+                b = value.get('blue', 255)
+                h_sber, s_sber, v_sber = rgb_to_sber_hsv(r, g, b)
+                log_deeptrace(f"RGB({r},{g},{b}) -> HSV(h={h_sber}, s={s_sber}, v={v_sber})")
+                colour_value = {'h': h_sber, 's': s_sber, 'v': v_sber}
+            else:
+                log_warning(f"ПРЕДУПРЕЖДЕНИЕ: Неверный формат COLOUR для {entity_id}: {value}")
+                colour_value = {'h': 0, 's': 0, 'v': 1000}
+            return {'key': feature_name, 'value': {'type': 'COLOUR', 'colour_value': colour_value}}
+    else:
+        def format_value(entity_id, value):
+            return {'key': feature_name, 'value': {'type': data_type}}
+
+    if feature_name != 'temperature':
+        return format_value
+
+    def format_temperature(entity_id, value):
+        # Сбер ожидает температуру, умноженную на 10
+        if value is not None:
+            try:
+                value = value * 10
+            except TypeError:
+                pass
+        return format_value(entity_id, value)
+    return format_temperature
+
+
+class EncodedValueCache(object):
+    """
+    Кэш готовых JSON-фрагментов {"key": ..., "value": {...}} одной функции по её значению.
+    Для BOOL/ENUM набор значений мал и кэш не ограничен, для INTEGER/COLOUR и прочих —
+    LRU на ENCODED_CACHE_LRU_SIZE значений.
+    """
+
+    def __init__(self, formatter, bounded):
+        self.formatter = formatter
+        self.bounded = bounded
+        self.values = OrderedDict() if bounded else {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(value):
+        # Тип входит в ключ: True == 1, но str(True) != str(1)
+        if isinstance(value, dict):
+            return dict, tuple(value.items())
+        return type(value), value
+
+    def encode(self, entity_id, value):
+        try:
+            key = self._key(value)
+            hash(key)
+        except TypeError:
+            return json.dumps(self.formatter(entity_id, value))
+
+        if not self.bounded:
+            # Обычный dict: get и присваивание атомарны, блокировка не нужна
+            fragment = self.values.get(key)
+            if fragment is None:
+                self.misses += 1
+                fragment = self.values[key] = json.dumps(self.formatter(entity_id, value))
+            else:
+                self.hits += 1
+            return fragment
+
+        with self.lock:
+            fragment = self.values.get(key)
+            if fragment is not None:
+                self.hits += 1
+                self.values.move_to_end(key)
+                return fragment
+
+        fragment = json.dumps(self.formatter(entity_id, value))
+        with self.lock:
+            self.misses += 1
+            self.values[key] = fragment
+            if len(self.values) > ENCODED_CACHE_LRU_SIZE:
+                self.values.popitem(last=False)
+        return fragment
+
+
+def get_default_value_for_feature(feature):
+    """Возвращает значение по умолчанию на основе типа данных Сбера."""
+    data_type = feature['data_type']
+    value = DEFAULT_VALUES_BY_TYPE.get(data_type)
+    if value is None:
+        log_error(f'Неизвестный тип данных: {data_type}')
+        return False
+
+    if feature.get('name', '') == 'online':
+        return True
+    return value
+
+
+def compile_category_plans(categories):
+    """Компиляция описаний категорий Сбера в планы сериализации {категория: CategoryPlan}."""
+    plans = {}
+    # Кэши фрагментов общие для одинаковых функций разных категорий
+    encoders = {}
+    for category, category_features in categories.items():
+        features = []
+        for feature in category_features or ():
+            feature_name = feature['name']
+            required = feature.get('required', False)
+            if category == 'sensor_temp' and feature_name in SENSOR_OPTIONAL_FEATURES:
+                required = False
+            data_type = feature['data_type']
+            formatter = _make_formatter(feature_name, data_type)
+            encoder = encoders.get((feature_name, data_type))
+            if encoder is None:
+                encoder = encoders[(feature_name, data_type)] = EncodedValueCache(
+                    formatter, data_type not in UNBOUNDED_CACHE_TYPES)
+            features.append(FeaturePlan(
+                feature_name,
+                data_type,
+                required,
+                get_default_value_for_feature(feature) if required else None,
+                formatter,
+                encoder.encode,
+            ))
+        plans[category] = CategoryPlan(
+            category,
+            tuple(features),
+            tuple(f for f in features if f.name not in COMMAND_ONLY_FEATURES),
+        )
+    return plans
+
 
 class SberMQTTSerializer:
     """
@@ -13,216 +224,301 @@ class SberMQTTSerializer:
 
     def __init__(self, devices_db):
         self.devices_db = devices_db
+        # (версия категорий, планы) — одна пара, чтобы потоки не увидели планы от другой версии
+        self._plans = (None, {})
+        # Кэш закодированных фрагментов конфигурации {entity_id: (ключ актуальности, JSON)}
+        self._config_fragments = {}
+        self.config_fragment_hits = 0
+        self.config_fragment_misses = 0
+        self.config_build_time_last = 0.0
+        # Последние опубликованные (отформатированные) значения {entity_id: {функция: состояние}}
+        # для дельта-публикаций — только изменившиеся функции
+        self._published_states = {}
+        self.delta_features_sent = 0
+        self.delta_features_skipped = 0
+        self.oversize_fragments = 0
+
+    def get_category_plans(self):
+        """Планы сериализации категорий; перекомпилируются только после загрузки новых категорий."""
+        return self._current_plans()[1]
+
+    def _current_plans(self):
+        """Пара (версия категорий, планы)."""
+        current = self._plans
+        if current[0] != sber_api.CategoriesVersion:
+            plans = compile_category_plans(sber_api.Categories)
+            current = self._plans = (sber_api.CategoriesVersion, plans)
+            log_debug(f"Скомпилированы планы сериализации для категорий: {len(plans)}")
+        return current
 
     def build_mqtt_devices_payload(self):
         """Генерация JSON для публикации конфигурации устройств в Sber MQTT."""
-        payload = {'devices': []}
-
-        # Добавляем корневой хаб
-        payload['devices'].append({
-            "id": "root",
-            "name": "Вумный контроллер",
-            'hw_version': VERSION,
-            'sw_version': VERSION,
+        plans_version, plans = self._current_plans()
+        started = time.monotonic()
+        fragments = [ROOT_HUB_FRAGMENT]
+        cache = self._config_fragments
+        new_cache = {}
+        hits = 0
+
+        # Перебор под блокировкой чтения: реестр не меняется во время сборки payload
+        with self.devices_db.read_lock():
+            for entity_id in self.devices_db.get_enabled_ids():
+                device = self.devices_db.get_device(entity_id)
+                if device:
+                    category = device.get('category', 'relay')
+                    plan = plans.get(category)
+
+                    active_features = ()
+                    if plan:
+                        states = self.devices_db.get_states(entity_id)
+                        # Обязательные функции — всегда, необязательные — если они есть в текущих состояниях
+                        active_features = tuple(f.name for f in plan.features if f.required or f.name in states)
+
+                    # Фрагмент устройства действителен, пока не изменились его конфигурация (Device.seq),
+                    # набор функций и планы категорий
+                    key = (device.seq, plans_version, active_features)
+                    cached = cache.get(entity_id)
+                    if cached is not None and cached[0] == key:
+                        hits += 1
+                    else:
+                        cached = (key, self._encode_device_config(entity_id, device, category, active_features))
+                    new_cache[entity_id] = cached
+                    fragments.append(cached[1])
+
+        self._config_fragments = new_cache
+        self.config_fragment_hits += hits
+        self.config_fragment_misses += len(new_cache) - hits
+        self.config_build_time_last = time.monotonic() - started
+
+        # Тот же результат, что json.dumps({'devices': [...]}) с разделителями по умолчанию
+        json_payload = '{"devices": [' + ', '.join(fragments) + ']}'
+        log_debug(f'Новый список устройств для MQTT: {json_payload}')
+        return json_payload
+
+    @staticmethod
+    def _encode_device_config(entity_id, device, category, active_features):
+        """JSON-фрагмент конфигурации одного устройства для /up/config."""
+        return json.dumps({
+            'id': entity_id,
+            'name': device.get('name', ''),
+            'default_name': device.get('default_name', ''),
+            'home': device.get('home', 'Мой дом'),
+            'room': device.get('room', ''),
+            'hw_version': device.get('hw_version', ''),
+            'sw_version': device.get('sw_version', ''),
             'model': {
-                'id': 'ID_root_hub',
+                'id': f'ID_{category}',
                 'manufacturer': 'TM',
-                'model': 'VHub',
-                'description': "HA MQTT SberGate HUB",
-                'category': 'hub',
-                'features': ['online']
-            }
+                'model': f'Model_{category}',
+                'category': category,
+                'features': list(active_features)
+            },
+            'model_id': ''
         })
 
-        for entity_id, device in self.devices_db.devices_registry.items():
-            if device.get('enabled', False):
-                dev_entry = {
-                    'id': entity_id,
-                    'name': device.get('name', ''),
-                    'default_name': device.get('default_name', ''),
-                    'home': device.get('home', 'Мой дом'),
-                    'room': device.get('room', ''),
-                    'hw_version': device.get('hw_version', ''),
-                    'sw_version': device.get('sw_version', '')
-                }
-
-                category = device.get('category', 'relay')
-                category_features = sber_api.Categories.get(category)
-
-                active_features = []
-                if category_features:
-                    for feature in category_features:
-                        feature_name = feature['name']
-                        is_required = feature.get('required', False)
-
-                        # Для датчиков игнорируем обязательность, если нет данных
-                        if category == 'sensor_temp' and feature_name in ['temperature', 'humidity', 'air_pressure']:
-                            is_required = False
-
-                        if is_required:
-                            active_features.append(feature_name)
-                        else:
-                            # Добавляем необязательные функции, если они есть в текущих состояниях
-                            if feature_name in self.devices_db.get_states(entity_id):
-                                active_features.append(feature_name)
-
-                dev_entry['model'] = {
-                    'id': f'ID_{category}',
-                    'manufacturer': 'TM',
-                    'model': f'Model_{category}',
-                    'category': category,
-                    'features': active_features
-                }
-                dev_entry['model_id'] = ''
-                payload['devices'].append(dev_entry)
-
-        json_payload = json.dumps(payload)
-        log_debug(f'Новый список устройств для MQTT: {json_payload}')
-        return json_payload
+    def get_stats(self):
+        """Статистика кэшей фрагментов конфигурации и состояний."""
+        encoders = {feature.encoder.__self__ for plan in self.get_category_plans().values() for feature in plan.features}
+        return {
+            'config_fragments': len(self._config_fragments),
+            'config_fragment_hits': self.config_fragment_hits,
+            'config_fragment_misses': self.config_fragment_misses,
+            'config_build_ms_last': round(self.config_build_time_last * 1000, 2),
+            'delta_features_sent': self.delta_features_sent,
+            'delta_features_skipped': self.delta_features_skipped,
+            'oversize_fragments': self.oversize_fragments,
+            'encoded_cache_hits': sum(cache.hits for cache in encoders),
+            'encoded_cache_misses': sum(cache.misses for cache in encoders),
+            'encoded_cache_size': sum(len(cache.values) for cache in encoders),
+        }
 
     def get_default_value_for_feature(self, feature):
         """Возвращает значение по умолчанию на основе типа данных Сбера."""
-        data_type = feature['data_type']
-        feature_name = feature.get('name', '')
-
-        default_values_by_type = {
-            'BOOL': False,
-            'INTEGER': 0,
-            'ENUM': '',
-            'COLOUR': {'red': 255, 'green': 255, 'blue': 255}  # Белый в формате dict
-        }
-
-        value = default_values_by_type.get(data_type)
-        if value is None:
-            log_error(f'Неизвестный тип данных: {data_type}')
-            return False
-
-        if feature_name == 'online':
-            return True
-        return value
+        return get_default_value_for_feature(feature)
 
     def format_state_for_sber(self, entity_id, feature, state_value):
         """Форматирование одного значения состояния для полезной нагрузки Sber MQTT."""
-        feature_name = feature['name']
-        data_type = feature['data_type']
-
-        # Сбер ожидает температуру, умноженную на 10
-        if feature_name == 'temperature' and state_value is not None:
-            try:
-                state_value = state_value * 10
-            except TypeError:
-                pass
-
-        result = {'key': feature_name, 'value': {'type': data_type}}
-
-        if data_type == 'BOOL':
-            result['value']['bool_value'] = bool(state_value)
-        elif data_type == 'INTEGER':
-            try:
-                result['value']['integer_value'] = int(state_value) if state_value is not None else 0
-            except ValueError:
-                result['value']['integer_value'] = 0
-        elif data_type == 'ENUM':
-            result['value']['enum_value'] = str(state_value) if state_value is not None else ""
-        elif data_type == 'COLOUR':
-            # COLOUR в Сбере использует HSV формат: h (0-360), s (0-1000), v (100-1000)
-            if isinstance(state_value, dict):
-                r = state_value.get('red', 255)
-                g = state_value.get('green', 255)
-                b = state_value.get('blue', 255)
-
-                h_sber, s_sber, v_sber = rgb_to_sber_hsv(r, g, b)
-
-                result['value']['colour_value'] = {
-                    'h': h_sber,
-                    's': s_sber,
-                    'v': v_sber
-                }
-                log_deeptrace(f"RGB({r},{g},{b}) -> HSV(h={h_sber}, s={s_sber}, v={v_sber})")
-            else:
-                log_warning(f"ПРЕДУПРЕЖДЕНИЕ: Неверный формат COLOUR для {entity_id}: {state_value}")
-                result['value']['colour_value'] = {'h': 0, 's': 0, 'v': 1000}
-
+        result = _make_formatter(feature['name'], feature['data_type'])(entity_id, state_value)
         log_deeptrace(f"{entity_id}: {result}")
         return result
 
-    def build_mqtt_states_payload(self, entity_id_list=None):
-        """
-        Генерация JSON для обновлений состояния в Sber MQTT.
-        Оптимизированная версия: объединяет проверку обязательных полей и форматирование в один проход.
-        """
-        # Функции, которые Сбер присылает нам как команды управления.
-        # Их не нужно включать в статусные обновления — Сбер и так знает их значение,
-        # поскольку сам их и устанавливает.
-        COMMAND_ONLY_FEATURES = {'vacuum_cleaner_command'}
-
-        states_payload = {'devices': {}}
-
-        if entity_id_list is None:
-            # Используем keys() напрямую, чтобы избежать создания лишнего списка
-            entity_id_list = self.devices_db.devices_registry.keys()
-
-        for entity_id in entity_id_list:
-            device = self.devices_db.get_device(entity_id)
+    def reset_published_states(self):
+        """Забыть опубликованные значения: следующая дельта-публикация будет полной (например, после переподключения)."""
+        self._published_states = {}
 
-            # Пропускаем отключенные или несуществующие устройства
-            if not device or not device.get('enabled'):
-                continue
+    def forget_published(self, entity_ids):
+        """Забыть опубликованные значения указанных устройств (их следующая публикация будет полной)."""
+        for entity_id in entity_ids:
+            self._published_states.pop(entity_id, None)
 
-            # Определяем категорию без записи в БД (side-effect removed)
-            category = device.get('category')
-            if not category:
-                category = 'relay'
+    def export_published(self, entity_ids):
+        """Опубликованные значения указанных устройств {entity_id: {функция: JSON}} — для сохранения на диск."""
+        published_states = self._published_states
+        return {entity_id: dict(published_states[entity_id]) for entity_id in entity_ids if entity_id in published_states}
 
-            features = sber_api.Categories.get(category)
-            if not features:
-                continue
+    def load_published(self, published):
+        """Восстановление опубликованных значений, сохранённых export_published (например, после перезапуска)."""
+        for entity_id, updates in published.items():
+            self._published_states.setdefault(entity_id, {}).update(updates)
 
-            formatted_states = []
+    def build_mqtt_states_payload(self, entity_id_list=None, delta=False):
+        """
+        Генерация JSON для обновлений состояния в Sber MQTT (одним сообщением).
+        :param entity_id_list: ID устройств (None — все включённые)
+        :param delta: только функции, значения которых изменились с последней публикации.
+                      Если изменений нет, возвращается None (публиковать нечего).
+        """
+        chunks = self.build_mqtt_states_chunks(entity_id_list, delta)
+        return chunks[0] if chunks else None
 
-            for feature in features:
-                feature_name = feature['name']
+    def build_mqtt_states_chunks(self, entity_id_list=None, delta=False, max_size=0):
+        """
+        Генерация обновлений состояния (render) с немедленной фиксацией как опубликованных
+        (commit_published). Для отправки, после которой нужно фиксировать, используйте
+        render_states и commit_published по отдельности.
+        """
+        rendered = self.render_states(entity_id_list, delta, max_size)
+        self.commit_published(rendered)
+        return rendered.chunks
 
-                # Пропускаем функции-команды — они не должны включаться в статусные обновления
-                if feature_name in COMMAND_ONLY_FEATURES:
+    def render_states(self, entity_id_list=None, delta=False, max_size=0):
+        """
+        Формирование обновлений состояния в виде одного или нескольких самостоятельных JSON-сообщений.
+        Проход по заранее скомпилированному плану категории (см. compile_category_plans).
+
+        Не имеет побочных эффектов: не меняет ни базу, ни запомненные опубликованные значения,
+        поэтому может выполняться параллельно и повторно. Всё, что должно произойти после
+        отправки, возвращается в StatesRender и применяется commit_published().
+
+        :param entity_id_list: ID устройств (None — все включённые)
+        :param delta: только функции, значения которых изменились с последней публикации
+        :param max_size: максимальный размер сообщения в байтах (0 — без ограничения).
+                         Устройство целиком попадает в одно сообщение, поэтому устройство
+                         больше max_size отправляется отдельным сообщением.
+        :return: StatesRender; chunks пуст в режиме delta, если изменений нет
+        """
+        plans = self.get_category_plans()
+        published_states = self._published_states
+        # Готовые JSON-фрагменты устройств: '"entity_id": {"states": [...]}'
+        device_fragments = []
+        published_updates = {}
+        # Номер изменения состояний (DeviceState.seq) каждого просмотренного устройства
+        generations = {}
+        db_changes = []
+        features_sent = 0
+        features_skipped = 0
+
+        with self.devices_db.read_lock():
+            if entity_id_list is None:
+                # Полная выборка — только включённые устройства из индекса
+                entity_id_list = self.devices_db.get_enabled_ids()
+
+            for entity_id in entity_id_list:
+                device = self.devices_db.get_device(entity_id)
+
+                # Пропускаем отключенные или несуществующие устройства
+                if not device or not device.get('enabled'):
                     continue
 
-                current_val = self.devices_db.get_state(entity_id, feature_name)
+                generations[entity_id] = self.devices_db.get_state_seq(entity_id)
 
-                # Если значения нет, проверяем обязательность и инициализируем дефолтным
-                if current_val is None:
-                    is_required = feature.get('required', False)
+                # Определяем категорию без записи в БД (side-effect removed)
+                category = device.get('category')
+                if not category:
+                    category = 'relay'
 
-                    # Специальная обработка для датчиков (sensor_temp):
-                    # Игнорируем флаг required для температуры и влажности, если их нет в БД.
-                    # Это нужно, чтобы не отправлять humidity для чистого датчика температуры и наоборот.
-                    if category == 'sensor_temp' and feature_name in ['temperature', 'humidity', 'air_pressure']:
-                        is_required = False
+                plan = plans.get(category)
+                if not plan or not plan.features:
+                    continue
 
-                    if is_required:
-                        current_val = self.get_default_value_for_feature(feature)
-                        self.devices_db.change_state(entity_id, feature_name, current_val)
-                    else:
-                        # Необязательное состояние отсутствует — пропускаем
+                states = self.devices_db.get_states(entity_id)
+                published = published_states.get(entity_id, {})
+                encoded_states = []
+                updates = {}
+
+                for feature in plan.state_features:
+                    current_val = states.get(feature.name)
+
+                    # Если значения нет: обязательное отправляем со значением по умолчанию
+                    # (в базу оно не записывается), необязательное пропускаем
+                    if current_val is None:
+                        if not feature.required:
+                            continue
+                        current_val = feature.default
+
+                    # Значение для Сбера, уже закодированное в JSON (из кэша фрагментов)
+                    encoded = feature.encoder(entity_id, current_val)
+                    is_event = feature.name in EVENT_FEATURES and current_val
+                    if delta and published.get(feature.name) == encoded and not is_event:
+                        features_skipped += 1
                         continue
-
-                # Форматируем значение для Сбера
-                formatted_states.append(self.format_state_for_sber(entity_id, feature, current_val))
-
-                # Сброс событий кнопок после отправки
-                if feature_name == 'button_event':
-                    self.devices_db.change_state(entity_id, 'button_event', '')
-
-            # Добавляем устройство в payload только если есть состояния
-            if formatted_states:
-                states_payload['devices'][entity_id] = {'states': formatted_states}
-
-        # Если список устройств пуст, отправляем статус online для корневого хаба
-        if not states_payload['devices']:
-            states_payload['devices'] = {
-                "root": {"states": [{"key": "online", "value": {"type": "BOOL", "bool_value": True}}]}
-            }
-
-        json_payload = json.dumps(states_payload)
-        log_debug(f"Отправка состояний в Сбер: {json_payload}")
-        return json_payload
\ No newline at end of file
+                    updates[feature.name] = encoded
+                    encoded_states.append(encoded)
+
+                    # Событие кнопки сбрасывается после отправки
+                    if is_event:
+                        db_changes.append((entity_id, feature.name, current_val, ''))
+
+                # Добавляем устройство в payload только если есть состояния
+                if encoded_states:
+                    features_sent += len(encoded_states)
+                    published_updates[entity_id] = updates
+                    device_fragments.append(
+                        json.dumps(entity_id) + ': {"states": [' + ', '.join(encoded_states) + ']}')
+
+        if not device_fragments:
+            # Если список устройств пуст, отправляем статус online для корневого хаба
+            chunks = [] if delta else ['{"devices": ' + ROOT_ONLINE_STATES + '}']
+            return StatesRender(chunks, published_updates, db_changes, delta, 0, features_skipped, 0, generations)
+
+        # Тот же результат, что json.dumps({'devices': {...}}) с разделителями по умолчанию
+        # (json.dumps экранирует не-ASCII символы, поэтому длина строки равна размеру в байтах)
+        groups, oversize = self._split_fragments(device_fragments, STATES_PAYLOAD_OVERHEAD, max_size)
+        chunks = ['{"devices": {' + ', '.join(group) + '}}' for group in groups]
+        return StatesRender(chunks, published_updates, db_changes, delta, features_sent, features_skipped, oversize,
+                            generations)
+
+    def commit_published(self, rendered):
+        """
+        Фиксация отправленных состояний: запоминание опубликованных значений для дельта-публикаций,
+        сброс отправленных событий кнопок в базе и статистика.
+        """
+        if rendered.delta:
+            self.delta_features_sent += rendered.features_sent
+            self.delta_features_skipped += rendered.features_skipped
+        self.oversize_fragments += rendered.oversize
+        for entity_id, updates in rendered.published.items():
+            self._published_states.setdefault(entity_id, {}).update(updates)
+        for entity_id, feature_name, sent_value, value in rendered.db_changes:
+            # Событие, пришедшее между render_states и отправкой, не затирается — оно уйдёт следующим
+            self.devices_db.compare_and_set_state(entity_id, feature_name, sent_value, value)
+        for chunk in rendered.chunks:
+            log_debug(f"Отправка состояний в Сбер: {chunk}")
+
+    @staticmethod
+    def _split_fragments(fragments, overhead, max_size):
+        """
+        Разбиение фрагментов на группы, каждая из которых с обёрткой не больше max_size.
+        Возвращает (группы, количество фрагментов, которые сами по себе больше max_size).
+        """
+        if max_size <= 0:
+            return [fragments], 0
+        groups = []
+        oversize = 0
+        group = []
+        size = overhead
+        for fragment in fragments:
+            added = len(fragment) + (2 if group else 0)  # разделитель ', '
+            if group and size + added > max_size:
+                groups.append(group)
+                group = []
+                size = overhead
+                added = len(fragment)
+            if overhead + len(fragment) > max_size:
+                oversize += 1
+                log_warning(f"Состояние одного устройства ({len(fragment)} байт) больше ограничения {max_size} байт")
+            group.append(fragment)
+            size += added
+        if group:
+            groups.append(group)
+        return groups, oversize
@@ -0,0 +1,102 @@
+import threading
+import time
+from logger import log_debug, log_error
+
+
+class StatusCoalescer(object):
+    """
+    Объединение частых обновлений состояний перед отправкой в Сбер.
+    ID изменившихся устройств накапливаются в течение окна window (сек), после чего
+    flush_callback вызывается один раз со всеми накопленными ID — устройство, изменившееся
+    несколько раз за окно, отправляется один раз с последним состоянием.
+    Если накоплено max_batch устройств, сброс выполняется сразу, не дожидаясь окна.
+    При window = 0 каждое обновление отправляется немедленно.
+    """
+
+    def __init__(self, flush_callback, window=0.1, max_batch=200):
+        """
+        :param flush_callback: функция, принимающая список ID устройств для отправки
+        :param window: окно накопления (сек)
+        :param max_batch: количество устройств, при котором сброс выполняется немедленно
+        """
+        self.flush_callback = flush_callback
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+        # Статистика
+        self.updates_received = 0
+        self.flush_count = 0
+        self.entities_flushed = 0
+        self.immediate_flushes = 0
+        self.flush_time_last = 0.0
+
+    def add(self, entity_ids):
+        """Пометить устройства изменившимися."""
+        with self._lock:
+            self.updates_received += len(entity_ids)
+            for entity_id in entity_ids:
+                # Повторно изменившееся устройство переносится в конец очереди
+                self._pending.pop(entity_id, None)
+                self._pending[entity_id] = None
+            flush_now = self.window <= 0 or len(self._pending) >= self.max_batch
+            if flush_now:
+                if self.window > 0:
+                    self.immediate_flushes += 1
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            log_error(f"Ошибка отправки накопленных состояний: {e}")
+
+    def flush(self):
+        """Немедленная отправка всех накопленных устройств."""
+        # Сбросы выполняются по очереди, чтобы дельты отправлялись в порядке изменений
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                entity_ids = list(self._pending)
+                self._pending = {}
+            if not entity_ids:
+                return
+            started = time.monotonic()
+            self.flush_callback(entity_ids)
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.flush_count += 1
+                self.entities_flushed += len(entity_ids)
+                self.flush_time_last = elapsed
+        log_debug(f"Отправлены накопленные состояния устройств: {len(entity_ids)}")
+
+    def close(self):
+        """Отправка оставшихся обновлений (вызывается при остановке)."""
+        self.flush()
+
+    def get_stats(self):
+        """Статистика объединения обновлений."""
+        with self._lock:
+            return {
+                'window_ms': int(self.window * 1000),
+                'max_batch': self.max_batch,
+                'pending': len(self._pending),
+                'updates_received': self.updates_received,
+                'flush_count': self.flush_count,
+                'entities_flushed': self.entities_flushed,
+                'immediate_flushes': self.immediate_flushes,
+                'batching_ratio': round(self.updates_received / self.flush_count, 2) if self.flush_count else 0.0,
+                'flush_ms_last': round(self.flush_time_last * 1000, 2),
+            }
@@ -0,0 +1,146 @@
+import threading
+from logger import log_warning
+
+
+class StatusOutbox(object):
+    """
+    Исходящий буфер состояний на время отсутствия связи с брокером Сбера.
+    Хранит только ID устройств (а не сообщения): при отправке формируется актуальное
+    состояние, поэтому для каждого устройства отправляется последнее значение.
+    Для каждого устройства запоминается, что отправлять: только изменившиеся функции
+    (дельта) или полное состояние; полное состояние поглощает дельту.
+    Пока буфер активен (нет связи или идёт его отправка после переподключения),
+    все обновления попадают в него — живые публикации не обгоняют накопленные.
+    Размер ограничен max_size устройствами: при переполнении буфер заменяется
+    отметкой «отправить полный статус всех устройств».
+    """
+
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self.active = True  # до первого подключения публиковать некуда
+        self._full = {}  # {entity_id: None} — полное состояние
+        self._delta = {}  # {entity_id: None} — только изменившиеся функции
+        self._all = False
+        self._all_delta = False
+        self._lock = threading.Lock()
+
+        # Статистика
+        self.held_count = 0
+        self.merged_count = 0
+        self.overflow_count = 0
+        self.flushed_count = 0
+        self.flush_batches = 0
+
+    def offer(self, entity_ids, delta=False):
+        """Сохранить устройства, если буфер активен. False — связь есть, публиковать сразу."""
+        with self._lock:
+            if not self.active:
+                return False
+            self._add(entity_ids, delta)
+            return True
+
+    def add(self, entity_ids, delta=False):
+        """Сохранить устройства независимо от состояния связи (например, после неудачной публикации)."""
+        with self._lock:
+            self._add(entity_ids, delta)
+
+    def _add(self, entity_ids, delta):
+        if entity_ids is None:
+            # Дельта всех устройств не отменяет полной отправки отдельных устройств
+            self.merged_count += len(self._delta) + (0 if delta else len(self._full))
+            self._all_delta = (self._all_delta or not self._all) and delta
+            self._all = True
+            self._delta = {}
+            if not delta:
+                self._full = {}
+            return
+        self.held_count += len(entity_ids)
+        for entity_id in entity_ids:
+            if entity_id in self._full or (delta and (self._all or entity_id in self._delta)):
+                self.merged_count += 1
+            elif delta:
+                self._delta[entity_id] = None
+            elif self._all and not self._all_delta:
+                self.merged_count += 1
+            else:
+                if entity_id in self._delta:
+                    del self._delta[entity_id]
+                    self.merged_count += 1
+                self._full[entity_id] = None
+        if len(self._full) + len(self._delta) > self.max_size:
+            self.overflow_count += 1
+            log_warning(f"Буфер состояний переполнен ({len(self._full) + len(self._delta)} устройств), "
+                        f"после подключения будет отправлен статус всех устройств")
+            self._all = True
+            self._all_delta = False
+            self._full = {}
+            self._delta = {}
+
+    def hold(self):
+        """Связь потеряна — обновления накапливаются в буфере."""
+        with self._lock:
+            self.active = True
+
+    def release(self):
+        """
+        Отправка буфера завершена или прервана при наличии связи — обновления снова публикуются сразу.
+        Оставшиеся в буфере устройства отправляются следующим проходом отправки.
+        """
+        with self._lock:
+            self.active = False
+
+    def take(self, batch_size):
+        """
+        Следующая порция устройств для отправки: (список ID или None — все устройства, дельта ли это).
+        Сначала отдаются полные состояния, затем дельты.
+        Если буфер пуст, он деактивируется (обновления снова публикуются сразу) и возвращается ([], False).
+        """
+        with self._lock:
+            if self._all:
+                self._all = False
+                self.flush_batches += 1
+                return None, self._all_delta
+            pending, delta = (self._full, False) if self._full else (self._delta, True)
+            if not pending:
+                self.active = False
+                return [], False
+            batch = []
+            for entity_id in pending:
+                batch.append(entity_id)
+                if len(batch) >= batch_size:
+                    break
+            for entity_id in batch:
+                del pending[entity_id]
+            self.flushed_count += len(batch)
+            self.flush_batches += 1
+            return batch, delta
+
+    def to_dict(self):
+        """Содержимое буфера для сохранения на диск."""
+        with self._lock:
+            return {'all': self._all, 'all_delta': self._all_delta,
+                    'entities': list(self._full), 'delta_entities': list(self._delta)}
+
+    def load(self, data):
+        """Восстановление содержимого, сохранённого to_dict()."""
+        if not data:
+            return
+        with self._lock:
+            if data.get('all'):
+                self._add(None, data.get('all_delta', False))
+            self._add(data.get('delta_entities', []), True)
+            self._add(data.get('entities', []), False)
+
+    def get_stats(self):
+        """Статистика буфера."""
+        with self._lock:
+            return {
+                'active': self.active,
+                'size': 'all' if self._all else len(self._full) + len(self._delta),
+                'max_size': self.max_size,
+                'held_count': self.held_count,
+                'merged_count': self.merged_count,
+                'overflow_count': self.overflow_count,
+                'flushed_count': self.flushed_count,
+                'flush_batches': self.flush_batches,
+            }
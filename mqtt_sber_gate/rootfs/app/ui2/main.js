@@ -292,16 +292,29 @@ function apiGetCategories(callback) {
     xhr.send();
 }
 
+/** Размер страницы при загрузке списка устройств */
+const DEVICES_PAGE_SIZE = 500;
+
 /**
- * Загружает полный список устройств из БД и отрисовывает таблицу.
+ * Загружает список устройств из БД постранично (/api/v2/devices?offset=N&limit=M)
+ * и отрисовывает таблицу, когда получены все страницы.
+ * @param {number} [offset]  — с какого устройства загружать
+ * @param {Object} [devices] — устройства, полученные с предыдущих страниц
  */
-function apiGet() {
+function apiGet(offset = 0, devices = {}) {
     let xhr = new XMLHttpRequest();
-    xhr.open('GET', '/api/v2/devices');
+    xhr.open('GET', `/api/v2/devices?offset=${offset}&limit=${DEVICES_PAGE_SIZE}`);
 
     xhr.onload = function () {
         if (xhr.status === 200) {
-            window.devicesList = JSON.parse(xhr.response)['devices'];
+            let page = JSON.parse(xhr.response);
+            Object.assign(devices, page['devices']);
+            let received = Object.keys(page['devices']).length;
+            if (received > 0 && offset + received < page['total']) {
+                apiGet(offset + received, devices);
+                return;
+            }
+            window.devicesList = devices;
             UpdateDeviceList(window.devicesList);
         } else {
             console.log(`Ошибка загрузки устройств: ${xhr.status} ${xhr.statusText}`);
@@ -4,6 +4,7 @@ import sys
 import threading
 import re
 import requests
+from urllib.parse import urlsplit, parse_qs
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from logger import log_info, log_error, log_warning, log_debug
 import sber_api
@@ -78,10 +79,12 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(bytes('<h1>Список устройств:</h1> <br>', "utf-8"))
         self.wfile.write(bytes('<table border="1" cellpadding="5" cellspacing="0">', "utf-8"))
         self.wfile.write(bytes('<tr><th>ID</th><th>Имя</th><th>Тип</th></tr>', "utf-8"))
-        for entity_id in self.device_database.devices_registry:
-            device = self.device_database.devices_registry[entity_id]
-            device_name = device.get('name', '')
-            device_type = device.get('entity_type', 'unknown')
+        with self.device_database.read_lock():
+            rows = [
+                (entity_id, device.get('name', ''), device.get('entity_type', 'unknown'))
+                for entity_id, device in self.device_database.devices_registry.items()
+            ]
+        for entity_id, device_name, device_type in rows:
             self.wfile.write(bytes(f"<tr><td>{entity_id}</td><td>{device_name}</td><td>{device_type}</td></tr>", "utf-8"))
         self.wfile.write(bytes('</table>', "utf-8"))
         self.wfile.write(bytes('</body></html>', "utf-8"))
@@ -107,7 +110,6 @@ class RequestHandler(BaseHTTPRequestHandler):
         category = post_data.get('category', '')
         if category:
             new_id = self.device_database.generate_new_id(category)
-            self.device_database.devices_registry[new_id] = {}
             self.device_database.update(new_id, post_data)
             self.device_database.save_db()
             self.mqtt_client.publish_config()
@@ -132,11 +134,44 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             log_warning(f"Получена неизвестная команда: {post_data}")
 
-    def handle_api_v2_devices_get(self):
+    def handle_api_v2_devices_get(self, query=None):
+        # ?since=N[&epoch=E] — только изменения после номера N (см. DevicesDB.changes_since)
+        if query and 'since' in query:
+            try:
+                since = int(query['since'][0])
+                epoch = int(query['epoch'][0]) if 'epoch' in query else None
+            except ValueError:
+                since, epoch = 0, None
+            self.send_text_response(self.http_serializer.build_http_devices_changes(since, epoch), "application/json")
+            return
+        # ?offset=N&limit=M — постраничная выдача вместо всей базы
+        if query and ('offset' in query or 'limit' in query):
+            try:
+                offset = max(0, int(query.get('offset', ['0'])[0]))
+                limit = max(1, int(query.get('limit', ['100'])[0]))
+            except ValueError:
+                offset, limit = 0, 100
+            self.send_text_response(self.http_serializer.build_http_devices_page(offset, limit), "application/json")
+            return
         self.send_text_response(self.http_serializer.build_http_devices_list_full(), "application/json")
 
     def handle_api_status(self):
-        self.send_json_response(self.agent_status_data)
+        # Состояние связи с брокером — текущее, а не на момент запуска
+        status = dict(self.agent_status_data)
+        status.update(self.mqtt_client.get_connection_status())
+        self.send_json_response(status)
+
+    def handle_api_v2_stats(self):
+        self.send_json_response({
+            'db': self.device_database.get_stats(),
+            'serializer': self.mqtt_client.sber_serializer.get_stats(),
+            'mqtt': self.mqtt_client.get_stats(),
+            'seq': self.device_database.current_seq()
+        })
+
+    def handle_api_v2_traces(self):
+        # Гистограммы задержек этапов обработки команд Сбера и последние трассировки
+        self.send_json_response(self.mqtt_client.command_tracer.get_stats())
 
     def handle_api_categories(self):
         log_info('Запрос категорий')
@@ -222,9 +257,16 @@ class RequestHandler(BaseHTTPRequestHandler):
             '/api/v1/categories': self.handle_api_categories,
             '/api/v1/devices': self.handle_api_devices_get,
             '/api/v2/devices': self.handle_api_v2_devices_get,
+            '/api/v2/stats': self.handle_api_v2_stats,
+            '/api/v2/traces': self.handle_api_v2_traces,
             '/api/version': lambda: self.send_json_response({'version': VERSION})
         }
         
+        url = urlsplit(self.path)
+        if url.path == '/api/v2/devices' and url.query:
+            self.handle_api_v2_devices_get(parse_qs(url.query))
+            return
+
         handler = routes.get(self.path)
         if handler:
             handler()
@@ -0,0 +1,216 @@
+"""
+Замеры производительности базы устройств и сериализатора Сбера на синтетических устройствах.
+
+Запуск: python mqtt_sber_gate/tests/benchmark.py [раздел ...]
+Без аргументов выполняются все разделы (см. SECTIONS).
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+import sber_api  # noqa: E402
+from device_model import Device  # noqa: E402
+from devices_db import DevicesDB  # noqa: E402
+from devices_storage import JsonStorage  # noqa: E402
+from sber_serializer import SberMQTTSerializer  # noqa: E402
+
+
+def _feature(name, data_type, required=False):
+    return {'name': name, 'data_type': data_type, 'required': required}
+
+
+# Категории Сбера (в аддоне загружаются из облака Сбера) — только используемые в замерах
+SAMPLE_CATEGORIES = {
+    'relay': [_feature('online', 'BOOL', True), _feature('on_off', 'BOOL', True)],
+    'light': [_feature('online', 'BOOL', True), _feature('on_off', 'BOOL', True),
+              _feature('light_brightness', 'INTEGER'), _feature('light_colour', 'COLOUR'),
+              _feature('light_colour_temp', 'INTEGER'), _feature('light_mode', 'ENUM')],
+    'sensor_temp': [_feature('online', 'BOOL', True), _feature('temperature', 'INTEGER', True),
+                    _feature('humidity', 'INTEGER', True), _feature('air_pressure', 'INTEGER')],
+}
+
+
+def build_database(count):
+    """
+    База из count включённых устройств (светильники, реле и датчики поровну) с состояниями
+    и сериализатор к ней. База не записывается на диск во время замеров.
+    """
+    sber_api.Categories = SAMPLE_CATEGORIES
+    sber_api.CategoriesVersion += 1
+    db_file_path = os.path.join(tempfile.mkdtemp(), 'devices.json')
+    db = DevicesDB(db_file_path, JsonStorage(db_file_path, flush_interval=3600))
+    for index in range(count):
+        kind = index % 3
+        if kind == 0:
+            entity_id = f'light.l{index}'
+            db.update(entity_id, dict(light_device(index), enabled=True))
+            states = {'online': True, 'on_off': index % 2 == 0, 'light_brightness': 100 + index % 900,
+                      'light_colour': {'red': index % 256, 'green': 128, 'blue': 255}, 'light_mode': 'white'}
+        elif kind == 1:
+            entity_id = f'switch.s{index}'
+            db.update(entity_id, {'enabled': True, 'name': f'Switch {index}', 'category': 'relay',
+                                  'entity_type': 'switch'})
+            states = {'online': True, 'on_off': index % 2 == 0}
+        else:
+            entity_id = f'sensor.t{index}'
+            db.update(entity_id, {'enabled': True, 'name': f'Sensor {index}', 'category': 'sensor_temp',
+                                  'entity_type': 'sensor', 'device_class': 'temperature'})
+            states = {'online': True, 'temperature': 20 + index % 10 / 10, 'humidity': 40 + index % 30}
+        for key, value in states.items():
+            db.change_state(entity_id, key, value)
+    return db, SberMQTTSerializer(db)
+
+
+def best_time(function, repeat):
+    """Лучшее время (мс) из repeat запусков."""
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def light_device(index):
+    """Конфигурация типичного светильника (16 полей, как после HAEntityUpdater)."""
+    return {
+        'enabled': True,
+        'name': f'Light {index}',
+        'default_name': f'Light {index}',
+        'nicknames': [],
+        'home': 'Мой дом',
+        'room': f'Room {index % 20}',
+        'groups': [],
+        'model_id': '',
+        'category': 'light',
+        'hw_version': 'hw:2.1.0',
+        'sw_version': 'sw:2.1.0',
+        'entity_ha': True,
+        'entity_type': 'light',
+        'friendly_name': f'Light {index}',
+        'device_id': f'dev{index}',
+        'device_class': '',
+    }
+
+
+def measure_memory(factory):
+    """Память (КиБ), выделенная при построении factory() (строки-значения уже созданы заранее)."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = factory()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return (after - before) / 1024
+
+
+def bench_memory():
+    """Память реестра устройств: словари против Device (user-006)."""
+    print('Память реестра (tracemalloc, светильники из 16 полей):')
+    for count in (1000, 5000, 10000):
+        data = {f'light.l{index}': light_device(index) for index in range(count)}
+        # Строковые значения общие для обоих вариантов, измеряются только контейнеры записей
+        as_dicts = measure_memory(lambda: {entity_id: dict(device) for entity_id, device in data.items()})
+        as_devices = measure_memory(lambda: {entity_id: Device.from_dict(device) for entity_id, device in data.items()})
+        print(f'  {count:>6}: dict {as_dicts:8.0f} КиБ   Device {as_devices:8.0f} КиБ   '
+              f'(-{(1 - as_devices / as_dicts) * 100:.0f}%)')
+
+    # Цена словарного интерфейса Device: get() — метод на Python, а не dict.get
+    dicts = [dict(device) for device in data.values()]
+    devices = [Device.from_dict(device) for device in data.values()]
+    fields = ('enabled', 'name', 'category', 'room', 'home', 'entity_type', 'device_id', 'hw_version',
+              'sw_version', 'friendly_name')
+    for title, records in (('dict', dicts), ('Device', devices)):
+        seconds = min(timeit.repeat(lambda: [record.get(field) for record in records for field in fields],
+                                    number=1, repeat=5))
+        print(f'  {len(records)} устройств x {len(fields)} get(): {title} {seconds * 1000:.1f} мс')
+
+
+def bench_config():
+    """Размер и время сборки конфигурации /up/config с кэшем фрагментов устройств (user-012)."""
+    print('Конфигурация устройств /up/config (лучшее из 15):')
+    for count in (500, 2000):
+        db, serializer = build_database(count)
+        payload = serializer.build_mqtt_devices_payload()
+
+        def build_uncached():
+            # Без кэша каждое устройство кодируется заново — как до появления фрагментов
+            serializer._config_fragments = {}
+            serializer.build_mqtt_devices_payload()
+
+        def build_after_change():
+            # Типичный случай: в веб-интерфейсе изменено одно устройство
+            db.update('light.l0', {'name': f'Light {time.monotonic()}'})
+            serializer.build_mqtt_devices_payload()
+
+        print(f'  {count:>5} устройств: {len(payload.encode("utf-8")):>8} байт   '
+              f'без кэша {best_time(build_uncached, 15):6.2f} мс   '
+              f'изменено одно {best_time(build_after_change, 15):6.2f} мс   '
+              f'без изменений {best_time(serializer.build_mqtt_devices_payload, 15):6.2f} мс')
+
+
+def reference_states_payload(db, serializer, entity_ids):
+    """Статус устройств способом без кэша фрагментов: словари состояний и один json.dumps."""
+    plans = serializer.get_category_plans()
+    devices = {}
+    # Обход тот же, что в SberMQTTSerializer.render_states, отличается только кодирование
+    with db.read_lock():
+        for entity_id in entity_ids:
+            device = db.get_device(entity_id)
+            if not device or not device.get('enabled'):
+                continue
+            plan = plans.get(device.get('category') or 'relay')
+            states = db.get_states(entity_id)
+            formatted = []
+            for feature in plan.state_features:
+                value = states.get(feature.name)
+                if value is None:
+                    if not feature.required:
+                        continue
+                    value = feature.default
+                formatted.append(feature.formatter(entity_id, value))
+            devices[entity_id] = {'states': formatted}
+    return json.dumps({'devices': devices})
+
+
+def bench_states():
+    """Статус /up/status: кэш готовых JSON-фрагментов против словарей и json.dumps (user-015)."""
+    db, serializer = build_database(3500)
+    entity_ids = db.get_enabled_ids()
+    single_ids = entity_ids[:1000]
+    # Результат должен совпадать побайтно
+    assert serializer.render_states(entity_ids).chunks[0] == reference_states_payload(db, serializer, entity_ids)
+
+    print(f'Статус /up/status, {len(entity_ids)} устройств (лучшее из 7):')
+    rows = (
+        ('полный статус', lambda: reference_states_payload(db, serializer, entity_ids),
+         lambda: serializer.render_states(entity_ids)),
+        (f'{len(single_ids)} статусов по одному устройству',
+         lambda: [reference_states_payload(db, serializer, [entity_id]) for entity_id in single_ids],
+         lambda: [serializer.render_states([entity_id]) for entity_id in single_ids]),
+    )
+    for title, reference, cached in rows:
+        print(f'  {title}: dict + json.dumps {best_time(reference, 7):6.1f} мс   '
+              f'кэш фрагментов {best_time(cached, 7):6.1f} мс')
+
+
+SECTIONS = {
+    'memory': bench_memory,
+    'config': bench_config,
+    'states': bench_states,
+}
+
+
+def main(names):
+    for name in names or SECTIONS:
+        if name not in SECTIONS:
+            sys.exit(f'Неизвестный раздел: {name} (доступны: {", ".join(SECTIONS)})')
+        SECTIONS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
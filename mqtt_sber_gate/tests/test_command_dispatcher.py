@@ -0,0 +1,105 @@
+"""
+Проверка пула выполнения команд Сбера (CommandDispatcher).
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']
+from command_dispatcher import CommandDispatcher  # noqa: E402
+
+TIMEOUT = 5
+
+
+class CommandDispatcherTest(unittest.TestCase):
+
+    def make_dispatcher(self, workers=4, max_pending=1000):
+        dispatcher = CommandDispatcher(workers, max_pending)
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+    def test_commands_of_one_device_run_in_order(self):
+        """Команды одного устройства выполняются по порядку и не одновременно, разных устройств — вперемешку."""
+        dispatcher = self.make_dispatcher(workers=4)
+        executed = {key: [] for key in ('light.a', 'light.b', 'light.c')}
+        running = {key: 0 for key in executed}
+        overlaps = []
+        lock = threading.Lock()
+
+        def command(key, index):
+            def run():
+                with lock:
+                    running[key] += 1
+                    if running[key] > 1:
+                        overlaps.append(key)
+                time.sleep(0.001)
+                with lock:
+                    running[key] -= 1
+                    executed[key].append(index)
+            return run
+
+        for index in range(30):
+            for key in executed:
+                dispatcher.submit(key, command(key, index))
+        dispatcher.close(TIMEOUT)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(executed, {key: list(range(30)) for key in executed})
+        self.assertEqual(dispatcher.get_stats()['executed'], 90)
+
+    def test_slow_device_does_not_block_others(self):
+        """Пока выполняется медленная команда одного устройства, команды других выполняются."""
+        dispatcher = self.make_dispatcher(workers=2)
+        release = threading.Event()
+        fast_done = threading.Event()
+        dispatcher.submit('light.slow', lambda: release.wait(TIMEOUT))
+        dispatcher.submit('light.slow', lambda: None)
+        dispatcher.submit('light.fast', lambda: None, on_done=fast_done.set)
+        self.assertTrue(fast_done.wait(TIMEOUT))
+        self.assertEqual(dispatcher.get_stats()['queue_depth'], 1)
+        release.set()
+
+    def test_inline_without_workers(self):
+        """При workers = 0 команда выполняется сразу в вызывающем потоке, ошибка не пробрасывается."""
+        dispatcher = self.make_dispatcher(workers=0)
+        threads = []
+        done = []
+        self.assertTrue(dispatcher.submit('light.a', lambda: threads.append(threading.current_thread()),
+                                          on_done=lambda: done.append(1)))
+        self.assertEqual((threads, done), ([threading.current_thread()], [1]))
+
+        def fail():
+            raise ValueError('ошибка HA')
+        self.assertTrue(dispatcher.submit('light.a', fail, on_done=lambda: done.append(2)))
+        self.assertEqual(done, [1, 2])
+        stats = dispatcher.get_stats()
+        self.assertEqual((stats['executed'], stats['errors'], stats['in_flight']), (2, 1, 0))
+
+    def test_rejects_over_max_pending(self):
+        """Сверх max_pending ожидающих команд новые отклоняются, on_done вызывается сразу."""
+        dispatcher = self.make_dispatcher(workers=1, max_pending=2)
+        release = threading.Event()
+        started = threading.Event()
+        dispatcher.submit('light.a', lambda: started.set() or release.wait(TIMEOUT))
+        self.assertTrue(started.wait(TIMEOUT))
+        self.assertTrue(dispatcher.submit('light.b', lambda: None))
+        self.assertTrue(dispatcher.submit('light.c', lambda: None))
+        rejected = []
+        self.assertFalse(dispatcher.submit('light.d', lambda: None, on_done=lambda: rejected.append(1)))
+        self.assertEqual(rejected, [1])
+        release.set()
+        dispatcher.close(TIMEOUT)
+        stats = dispatcher.get_stats()
+        self.assertEqual((stats['executed'], stats['rejected']), (3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+"""
+Проверка ConnectionSupervisor на локальном «брокере-заглушке» (MQTT 3.1.1 без TLS).
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+import paho.mqtt  # noqa: E402
+from connection_supervisor import (ConnectionSupervisor, SupervisedClient,  # noqa: E402
+                                   HEALTH_DEGRADED, HEALTH_ONLINE, PAHO_VERSION)
+
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']
+
+
+class StubBroker(object):
+    """
+    Минимальный брокер: CONNACK, SUBACK, PUBACK, PINGRESP.
+    drop_after — через сколько секунд разрывать каждое соединение («мигающий» брокер).
+    Все принятые PUBLISH проверяются: перемешанные пакеты от одновременной записи
+    в сокет из нескольких потоков дают неверный заголовок или топик.
+    """
+
+    def __init__(self, drop_after=None):
+        self.drop_after = drop_after
+        self.connections = []  # моменты подключений
+        self.publishes = []
+        self.corrupt = 0
+        self._lock = threading.Lock()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self._server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _read(conn, size, deadline):
+        data = b''
+        while len(data) < size:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                conn.settimeout(remaining)
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _serve(self, conn):
+        deadline = None
+        try:
+            while True:
+                header = self._read(conn, 1, deadline)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self._read(conn, 1, deadline)[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self._read(conn, length, deadline)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    with self._lock:
+                        self.connections.append(time.monotonic())
+                    conn.sendall(b'\x20\x02\x00\x00')
+                    if self.drop_after is not None:
+                        deadline = time.monotonic() + self.drop_after
+                elif packet_type == 3:  # PUBLISH
+                    self._on_publish(conn, header, body)
+                elif packet_type == 8:  # SUBSCRIBE
+                    conn.sendall(b'\x90\x03' + body[:2] + b'\x00')
+                elif packet_type == 12:  # PINGREQ
+                    conn.sendall(b'\xd0\x00')
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                else:
+                    with self._lock:
+                        self.corrupt += 1
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _on_publish(self, conn, header, body):
+        qos = (header >> 1) & 0x03
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length]
+        payload = body[2 + topic_length + (2 if qos else 0):]
+        with self._lock:
+            if qos == 3 or not topic.startswith(b'test/') or not payload.startswith(b'msg-'):
+                self.corrupt += 1
+                return
+            self.publishes.append(payload)
+        if qos:
+            conn.sendall(b'\x40\x02' + body[2 + topic_length:4 + topic_length])
+
+
+class ConnectionSupervisorTest(unittest.TestCase):
+
+    def start(self, broker, **kwargs):
+        client = SupervisedClient()
+        supervisor = ConnectionSupervisor(client, **kwargs)
+        client.on_connect = lambda c, u, f, rc: supervisor.on_connected() if rc == 0 else None
+        client.on_disconnect = lambda c, u, rc: supervisor.on_connection_lost()
+        supervisor.start('127.0.0.1', broker.port, keepalive=30)
+        self.addCleanup(broker.close)
+        self.addCleanup(supervisor.stop)
+        return client, supervisor
+
+    @staticmethod
+    def wait_for(condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return condition()
+
+    def test_flapping_broker_reconnects_are_bounded(self):
+        """Брокер рвёт каждое соединение: паузы растут до max_delay, а не идут подряд."""
+        broker = StubBroker(drop_after=0.1)
+        _, supervisor = self.start(broker, min_delay=0.05, max_delay=0.4, stable_after=10.0, flap_window=10.0)
+        time.sleep(3.0)
+
+        connections = list(broker.connections)
+        gaps = [later - earlier for earlier, later in zip(connections, connections[1:])]
+        # Без ограничения (пауза min_delay) было бы около 3.0 / 0.15 = 20 подключений
+        self.assertGreaterEqual(len(connections), 4)
+        self.assertLessEqual(len(connections), 12)
+        # Начиная с четвёртой попытки задержка достигла max_delay: разброс не меньше max_delay / 2
+        for gap in gaps[3:]:
+            self.assertGreaterEqual(gap, 0.2)
+        self.assertEqual(supervisor.health(), HEALTH_DEGRADED)
+        self.assertGreaterEqual(supervisor.get_stats()['consecutive_failures'], len(connections) - 1)
+
+    def test_paho_calls_reconnect_hook(self):
+        """Вложенный paho — проверенной версии и перед каждой повторной попыткой вызывает супервизор."""
+        self.assertEqual(paho.mqtt.__version__, PAHO_VERSION)
+        broker = StubBroker(drop_after=0.1)
+        _, supervisor = self.start(broker, min_delay=0.05, max_delay=0.1)
+        waits = []
+        wait_before_retry = supervisor.wait_before_retry
+
+        def traced_wait():
+            waits.append(time.monotonic())
+            wait_before_retry()
+        supervisor.wait_before_retry = traced_wait
+        self.assertTrue(self.wait_for(lambda: len(waits) >= 2))
+
+    def test_recovers_after_flapping(self):
+        """После стабилизации брокера соединение восстанавливается и остаётся одно."""
+        broker = StubBroker(drop_after=0.1)
+        _, supervisor = self.start(broker, min_delay=0.05, max_delay=0.2, flap_window=1.0)
+        self.assertTrue(self.wait_for(lambda: len(broker.connections) >= 3))
+        broker.drop_after = None
+        # Соединение, открытое до переключения, ещё может быть разорвано
+        time.sleep(0.5)
+        self.assertTrue(self.wait_for(lambda: supervisor.connected and supervisor.state == 'connected'))
+        count = len(broker.connections)
+        time.sleep(1.2)
+        self.assertEqual(len(broker.connections), count)
+        self.assertEqual(supervisor.health(), HEALTH_ONLINE)
+
+    def test_publish_from_many_threads(self):
+        """publish() из нескольких потоков не пишет в сокет в обход сетевого потока paho."""
+        broker = StubBroker()
+        client, supervisor = self.start(broker)
+        self.assertTrue(self.wait_for(lambda: supervisor.connected))
+
+        writers = set()
+        send = client._sock_send
+
+        def traced_send(data):
+            writers.add(threading.current_thread().name)
+            return send(data)
+        client._sock_send = traced_send
+
+        def publisher(index):
+            for number in range(300):
+                client.publish('test/status', f'msg-{index}-{number}-' + 'x' * 2000, qos=number % 2)
+        threads = [threading.Thread(target=publisher, args=(index,), name=f'pub{index}') for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(self.wait_for(lambda: len(broker.publishes) >= 1200, timeout=10.0))
+        self.assertEqual(broker.corrupt, 0)
+        self.assertEqual(len(set(broker.publishes)), 1200)
+        self.assertFalse(writers & {thread.name for thread in threads})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Проверка базы устройств (DevicesDB): состояния хранятся отдельно от сохраняемой конфигурации.
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+from devices_db import DevicesDB  # noqa: E402
+
+
+class DeviceStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file_path = os.path.join(tempfile.mkdtemp(), 'devices.json')
+        self.write_file({})
+
+    def write_file(self, registry):
+        with open(self.db_file_path, 'w', encoding='utf-8') as f:
+            json.dump(registry, f)
+
+    def read_file(self):
+        with open(self.db_file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def open_db(self, persist_states=False):
+        db = DevicesDB(self.db_file_path, persist_states=persist_states)
+        self.addCleanup(db.close)
+        return db
+
+    def test_states_not_written_to_disk(self):
+        """Изменения состояний и служебные ключи не попадают в devices.json и не вызывают запись."""
+        db = self.open_db()
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light'})
+        mtime = os.stat(self.db_file_path).st_mtime_ns
+        db.change_state('light.kitchen', 'on_off', True)
+        db.set_runtime('light.kitchen', '_expected_mqtt_state', True)
+        db.close()
+
+        self.assertEqual(os.stat(self.db_file_path).st_mtime_ns, mtime)
+        saved = self.read_file()['light.kitchen']
+        self.assertNotIn('States', saved)
+        self.assertFalse([key for key in saved if key.startswith('_')])
+        self.assertEqual(db.get_state('light.kitchen', 'on_off'), True)
+        self.assertEqual(db.get_runtime('light.kitchen', '_expected_mqtt_state'), True)
+
+    def test_legacy_states_moved_out_of_file(self):
+        """States и служебные ключи старого devices.json загружаются в память и удаляются из файла."""
+        self.write_file({'light.kitchen': {'enabled': True, 'name': 'Кухня', 'category': 'light',
+                                           'States': {'on_off': True, 'light_brightness': 300},
+                                           '_expected_mqtt_state': True, '_last_state_change_ts': 1.0}})
+        db = self.open_db()
+        self.assertEqual(db.get_states('light.kitchen'), {'on_off': True, 'light_brightness': 300})
+        self.assertEqual(db.get_device('light.kitchen')['name'], 'Кухня')
+        db.close()
+        self.assertEqual(self.read_file(), {'light.kitchen': db.get_device('light.kitchen').to_dict()})
+        self.assertNotIn('States', self.read_file()['light.kitchen'])
+
+    def test_persist_states_option(self):
+        """При persist_states состояния сохраняются вместе с конфигурацией и восстанавливаются."""
+        db = self.open_db(persist_states=True)
+        db.update('switch.fan', {'name': 'Вентилятор', 'category': 'relay'})
+        db.change_state('switch.fan', 'on_off', True)
+        db.close()
+        self.assertEqual(self.read_file()['switch.fan']['States'], {'on_off': True})
+
+        db = self.open_db(persist_states=True)
+        self.assertEqual(db.get_states('switch.fan'), {'on_off': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
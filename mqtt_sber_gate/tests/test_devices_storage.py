@@ -0,0 +1,149 @@
+"""
+Проверка хранилищ базы устройств: журнал изменений (JournalStorage) и SQLite (SqliteStorage).
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+from devices_db import DevicesDB  # noqa: E402
+from devices_storage import JournalStorage, MIGRATED_META_KEY, create_storage  # noqa: E402
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file_path = os.path.join(tempfile.mkdtemp(), 'devices.json')
+        with open(self.db_file_path, 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+
+    def open_db(self, storage):
+        db = DevicesDB(self.db_file_path, storage)
+        self.addCleanup(db.close)
+        return db
+
+
+class JournalStorageTest(StorageTestCase):
+
+    def open_journal_db(self, journal_max_size=1024 * 1024):
+        return self.open_db(JournalStorage(self.db_file_path, journal_max_size=journal_max_size))
+
+    def journal_lines(self):
+        with open(f'{self.db_file_path}.journal', 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def test_replay_restores_changes(self):
+        """Изменения, записанные только в журнал, восстанавливаются при следующем запуске."""
+        db = self.open_journal_db()
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light', 'enabled': True})
+        db.update('switch.fan', {'name': 'Вентилятор', 'category': 'relay'})
+        db.update('light.kitchen', {'room': 'Кухня'})
+        db.delete_device('switch.fan')
+        db.close()
+        with open(self.db_file_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {}, 'снимок не переписывается до уплотнения')
+
+        db = self.open_journal_db()
+        self.assertEqual(list(db.devices_registry), ['light.kitchen'])
+        device = db.get_device('light.kitchen')
+        self.assertEqual((device['name'], device['room'], device['enabled']), ('Кухня', 'Кухня', True))
+
+    def test_torn_last_record_is_skipped_and_truncated(self):
+        """Недописанная последняя строка пропускается и не портит записи, добавленные после запуска."""
+        db = self.open_journal_db()
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light'})
+        db.close()
+        with open(f'{self.db_file_path}.journal', 'a', encoding='utf-8') as f:
+            f.write('{"op":"u","id":"light.hall","d":{"na')
+
+        db = self.open_journal_db()
+        self.assertEqual(list(db.devices_registry), ['light.kitchen'])
+        db.update('light.bedroom', {'name': 'Спальня', 'category': 'light'})
+        db.close()
+        for line in self.journal_lines():
+            json.loads(line)
+
+        db = self.open_journal_db()
+        self.assertEqual(sorted(db.devices_registry), ['light.bedroom', 'light.kitchen'])
+
+    def test_compaction_rewrites_snapshot_and_resets_journal(self):
+        """После превышения размера журнала снимок переписывается, журнал обнуляется."""
+        db = self.open_journal_db(journal_max_size=1)
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light'})
+        db.storage.compact()
+        self.assertEqual(self.journal_lines(), [])
+        with open(self.db_file_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['light.kitchen']['name'], 'Кухня')
+        db.update('light.kitchen', {'name': 'Кухня 2'})
+        db.close()
+
+        db = self.open_journal_db()
+        self.assertEqual(db.get_device('light.kitchen')['name'], 'Кухня 2')
+
+
+class SqliteStorageTest(StorageTestCase):
+
+    def open_sqlite_db(self):
+        return self.open_db(create_storage(self.db_file_path, {'db_storage': 'sqlite', 'db_flush_interval': 0}))
+
+    def test_json_and_journal_migrated_once(self):
+        """devices.json с журналом переносится в SQLite один раз, исходный файл остаётся."""
+        db = self.open_db(JournalStorage(self.db_file_path))
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light'})
+        db.update('switch.fan', {'name': 'Вентилятор', 'category': 'relay'})
+        db.close()
+
+        db = self.open_sqlite_db()
+        self.assertEqual(sorted(db.devices_registry), ['light.kitchen', 'switch.fan'])
+        self.assertTrue(db.storage.load_meta()[MIGRATED_META_KEY])
+        self.assertTrue(os.path.exists(self.db_file_path))
+
+        # После удаления всех устройств devices.json повторно не переносится
+        db.clear_database()
+        db.close()
+        db = self.open_sqlite_db()
+        self.assertEqual(db.devices_registry, {})
+
+    def test_existing_database_is_not_overwritten(self):
+        """База SQLite, заполненная до появления отметки, не перезаписывается из devices.json."""
+        db = self.open_sqlite_db()
+        db.update('light.kitchen', {'name': 'Кухня', 'category': 'light'})
+        db.storage.connection.execute('DELETE FROM meta')
+        db.storage.connection.commit()
+        db.close()
+        with open(self.db_file_path, 'w', encoding='utf-8') as f:
+            json.dump({'switch.old': {'name': 'Старое', 'category': 'relay'}}, f)
+
+        db = self.open_sqlite_db()
+        self.assertEqual(list(db.devices_registry), ['light.kitchen'])
+        self.assertTrue(db.storage.load_meta()[MIGRATED_META_KEY])
+
+    def test_page_includes_unflushed_changes_without_writing(self):
+        """Страница строится из SQLite и ещё не записанных изменений, без записи на диск."""
+        db = self.open_db(create_storage(self.db_file_path, {'db_storage': 'sqlite', 'db_flush_interval': 3600}))
+        for index in range(10):
+            db.update(f'light.l{index}', {'name': f'L{index}', 'category': 'light'})
+        db.flush()
+        db.update('light.a', {'name': 'Новое', 'category': 'light'})
+        db.update('light.l3', {'name': 'Изменено'})
+        db.delete_device('light.l5')
+        rows_written = db.storage.rows_written
+
+        expected = sorted(db.devices_registry)
+        pages = [db.list_devices(offset, 4) for offset in range(0, 12, 4)]
+        self.assertEqual([entity_id for page, _ in pages for entity_id in page], expected)
+        self.assertEqual({total for _, total in pages}, {len(expected)})
+        self.assertEqual(pages[1][0]['light.l3']['name'], 'Изменено')
+        self.assertEqual(db.storage.rows_written, rows_written)
+
+
+if __name__ == '__main__':
+    unittest.main()
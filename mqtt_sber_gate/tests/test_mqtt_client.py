@@ -0,0 +1,129 @@
+"""
+Проверка подтверждения команд Сбера (SberMQTTClient): одно сообщение со статусом всех устройств команды.
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+import mqtt_client  # noqa: E402
+import sber_api  # noqa: E402
+from devices_db import DevicesDB  # noqa: E402
+from sber_serializer import SberMQTTSerializer  # noqa: E402
+
+TIMEOUT = 5
+ENTITY_IDS = ['switch.s0', 'switch.s1', 'switch.s2']
+
+
+class PublishInfo(object):
+    def __init__(self, mid):
+        self.rc = 0
+        self.mid = mid
+
+
+class Message(object):
+    def __init__(self, payload):
+        self.payload = json.dumps(payload).encode('utf-8')
+
+
+class FakeHAClient(object):
+    """Клиент HA, запоминающий запросы; запросы ждут события release."""
+
+    def __init__(self, events):
+        self.events = events
+        self.release = threading.Event()
+        self.release.set()
+
+    def toggle_device_state(self, entity_id):
+        self.release.wait(TIMEOUT)
+        self.events.append(('ha', entity_id))
+
+
+class CommandAckTest(unittest.TestCase):
+
+    def make_client(self, **options):
+        sber_api.Categories = {'relay': [{'name': 'online', 'data_type': 'BOOL', 'required': True},
+                                         {'name': 'on_off', 'data_type': 'BOOL', 'required': True}]}
+        sber_api.CategoriesVersion += 1
+        data_dir = tempfile.mkdtemp()
+        mqtt_client.MQTT_STATE_FILE_PATH = os.path.join(data_dir, 'mqtt_state.json')
+        db_file_path = os.path.join(data_dir, 'devices.json')
+        with open(db_file_path, 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+        db = DevicesDB(db_file_path)
+        for index, entity_id in enumerate(ENTITY_IDS):
+            db.update(entity_id, {'enabled': True, 'name': f'Switch {index}', 'category': 'relay',
+                                  'entity_type': 'switch', 'entity_ha': True})
+            db.change_state(entity_id, 'on_off', False)
+
+        config_options = {'sber-mqtt_login': 'test', 'sber-mqtt_status_rate_limit': 0}
+        config_options.update(options)
+        client = mqtt_client.SberMQTTClient(db, SberMQTTSerializer(db), config_options)
+        self.addCleanup(client.command_dispatcher.close)
+        self.events = []
+        self.ack_event = threading.Event()
+
+        def publish(topic, payload, qos=0):
+            mid = len(self.events) + 1
+            if topic.endswith('/status'):
+                self.events.append(('status', sorted(json.loads(payload)['devices'])))
+                self.ack_event.set()
+            # Брокер принял сообщение сразу (on_publish раньше, чем publish() вернёт mid)
+            client.on_publish(None, None, mid)
+            return PublishInfo(mid)
+
+        client.mqtt_client.publish = publish
+        client.connected = True
+        client.status_outbox.release()
+        self.ha_client = FakeHAClient(self.events)
+        client.set_ha_client(self.ha_client)
+        return client
+
+    @staticmethod
+    def command(entity_ids):
+        return Message({'devices': {entity_id: {'states': [{'key': 'on_off', 'value': {'type': 'BOOL', 'bool_value': True}}]}
+                                    for entity_id in entity_ids}})
+
+    def test_one_ack_after_all_ha_calls(self):
+        """Подтверждение отправляется одним сообщением после выполнения запросов к HA всех устройств."""
+        client = self.make_client(**{'sber-mqtt_command_workers': 2})
+        client.handle_command_message(None, None, self.command(ENTITY_IDS))
+        self.assertTrue(self.ack_event.wait(TIMEOUT))
+        self.assertEqual(sorted(self.events[:3]), [('ha', entity_id) for entity_id in ENTITY_IDS])
+        self.assertEqual(self.events[3:], [('status', ENTITY_IDS)])
+
+        stats = client.get_stats()['command_ack']
+        self.assertEqual((stats['count'], stats['devices'], stats['published']), (1, 3, 1))
+        trace = client.command_tracer.get_stats()['recent'][0]
+        self.assertIn('ack_published', trace['stages_ms'])
+
+    def test_optimistic_ack_before_ha_calls(self):
+        """В оптимистичном режиме подтверждение отправляется сразу, не дожидаясь HA."""
+        client = self.make_client(**{'sber-mqtt_command_workers': 2, 'sber-mqtt_optimistic_ack': True})
+        self.ha_client.release.clear()
+        client.handle_command_message(None, None, self.command(ENTITY_IDS))
+        self.assertTrue(self.ack_event.wait(TIMEOUT))
+        self.assertEqual(self.events, [('status', ENTITY_IDS)])
+        self.ha_client.release.set()
+        client.command_dispatcher.close(TIMEOUT)
+        self.assertEqual(sorted(self.events[1:]), [('ha', entity_id) for entity_id in ENTITY_IDS])
+
+    def test_ack_for_devices_without_ha_calls(self):
+        """Устройства без запроса к HA (не найдены или не управляются HA) подтверждаются сразу."""
+        client = self.make_client(**{'sber-mqtt_command_workers': 0})
+        client.device_database.update('switch.s2', {'entity_ha': False})
+        client.handle_command_message(None, None, self.command(['switch.s2']))
+        self.assertEqual(self.events, [('status', ['switch.s2'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
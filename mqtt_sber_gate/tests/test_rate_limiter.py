@@ -0,0 +1,126 @@
+"""
+Проверка ограничения частоты публикаций: TokenBucket и отложенная отправка /up/status.
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+import mqtt_client  # noqa: E402
+import sber_api  # noqa: E402
+from devices_db import DevicesDB  # noqa: E402
+from rate_limiter import TokenBucket  # noqa: E402
+from sber_serializer import SberMQTTSerializer  # noqa: E402
+
+TIMEOUT = 5
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_disabled_without_rate(self):
+        """rate = 0 — ограничение отключено."""
+        bucket = TokenBucket(0)
+        self.assertFalse(bucket.enabled)
+        self.assertTrue(all(bucket.try_acquire() for _ in range(100)))
+        self.assertEqual(bucket.wait_time(), 0.0)
+        self.assertIsNone(bucket.tokens)
+
+    def test_burst_then_refill(self):
+        """Сразу доступен залп в capacity токенов, затем токены пополняются со скоростью rate."""
+        bucket = TokenBucket(20, capacity=3)
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+        self.assertGreater(bucket.wait_time(), 0)
+        time.sleep(0.06)
+        self.assertTrue(bucket.try_acquire())
+
+    def test_consume_debt_and_refund(self):
+        """consume() уходит в минус (долг), отрицательный count возвращает токены не выше ёмкости."""
+        bucket = TokenBucket(10, capacity=2)
+        bucket.consume(5)
+        self.assertLess(bucket.tokens, -2.5)
+        self.assertFalse(bucket.try_acquire())
+        self.assertGreater(bucket.wait_time(), 0.35)
+        bucket.consume(-100)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class PublishInfo(object):
+    def __init__(self, mid):
+        self.rc = 0
+        self.mid = mid
+
+
+class StatusRateLimitTest(unittest.TestCase):
+    """Публикации /up/status сверх ограничения откладываются и объединяются."""
+
+    def setUp(self):
+        sber_api.Categories = {'relay': [{'name': 'online', 'data_type': 'BOOL', 'required': True},
+                                         {'name': 'on_off', 'data_type': 'BOOL', 'required': True}]}
+        sber_api.CategoriesVersion += 1
+        data_dir = tempfile.mkdtemp()
+        mqtt_client.MQTT_STATE_FILE_PATH = os.path.join(data_dir, 'mqtt_state.json')
+        db_file_path = os.path.join(data_dir, 'devices.json')
+        with open(db_file_path, 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+        self.db = DevicesDB(db_file_path)
+        for index in range(3):
+            entity_id = f'switch.s{index}'
+            self.db.update(entity_id, {'enabled': True, 'name': f'Switch {index}', 'category': 'relay'})
+            self.db.change_state(entity_id, 'on_off', False)
+
+        self.client = mqtt_client.SberMQTTClient(
+            self.db, SberMQTTSerializer(self.db),
+            {'sber-mqtt_login': 'test', 'sber-mqtt_status_rate_limit': 50, 'sber-mqtt_command_workers': 0})
+        self.published = []
+        self.published_event = threading.Event()
+        self.client.mqtt_client.publish = self.publish
+        # Связь есть, буфер на время отсутствия связи не используется
+        self.client.connected = True
+        self.client.status_outbox.release()
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, json.loads(payload)))
+        self.published_event.set()
+        return PublishInfo(len(self.published))
+
+    def published_devices(self):
+        return [sorted(payload['devices']) for topic, payload in self.published if topic.endswith('/status')]
+
+    def test_deferred_updates_sent_together(self):
+        """Без токенов обновления откладываются и отправляются одной публикацией, когда токен появится."""
+        self.assertEqual(self.client._submit_states(['switch.s0'], delta=False), 'sent')
+        self.client.status_bucket.consume(self.client.status_bucket.capacity + 1)
+        self.published_event.clear()
+
+        self.db.change_state('switch.s1', 'on_off', True)
+        self.assertEqual(self.client._submit_states(['switch.s1'], delta=True), 'deferred')
+        self.assertEqual(self.client._submit_states(['switch.s2', 'switch.s1'], delta=False), 'deferred')
+        self.assertEqual(self.published_devices(), [['switch.s0']])
+
+        self.assertTrue(self.published_event.wait(TIMEOUT))
+        self.assertEqual(self.published_devices(), [['switch.s0'], ['switch.s1', 'switch.s2']])
+        stats = self.client.get_stats()['rate_limit']['status']
+        self.assertEqual((stats['deferred_count'], stats['merged_count'], stats['pending']), (1, 1, 0))
+
+    def test_live_updates_wait_for_deferred(self):
+        """Пока есть отложенные обновления, новые не обгоняют их, даже если токен уже появился."""
+        self.client.status_bucket.consume(self.client.status_bucket.capacity + 1)
+        self.assertEqual(self.client._submit_states(['switch.s0'], delta=False), 'deferred')
+        self.client.status_bucket.consume(-100)
+        self.assertEqual(self.client._submit_states(['switch.s1'], delta=False), 'deferred')
+        self.assertTrue(self.published_event.wait(TIMEOUT))
+        self.assertEqual(self.published_devices(), [['switch.s0', 'switch.s1']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Проверка блокировки «много читателей / один писатель» (ReadWriteLock).
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+
+from rwlock import ReadWriteLock  # noqa: E402
+
+TIMEOUT = 5
+
+
+class ReadWriteLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = ReadWriteLock()
+
+    def run_in_thread(self, target):
+        """Запуск target в отдельном потоке; возвращает событие его завершения."""
+        done = threading.Event()
+
+        def run():
+            target()
+            done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        return done
+
+    def read_once(self):
+        with self.lock.read_locked():
+            pass
+
+    def wait_for_waiting_writer(self):
+        deadline = time.monotonic() + TIMEOUT
+        while not self.lock._writers_waiting:
+            self.assertLess(time.monotonic(), deadline, 'писатель не встал в очередь')
+            time.sleep(0.001)
+
+    def test_readers_do_not_block_each_other(self):
+        """Чтение в другом потоке не ждёт, пока удерживается чтение."""
+        with self.lock.read_locked():
+            done = self.run_in_thread(self.read_once)
+            self.assertTrue(done.wait(TIMEOUT))
+
+    def test_nested_read_does_not_wait_for_pending_writer(self):
+        """Повторное чтение в том же потоке проходит, даже если писатель уже ждёт."""
+        entered = []
+
+        def writer():
+            with self.lock.write_locked():
+                entered.append(1)
+
+        with self.lock.read_locked():
+            writer_done = self.run_in_thread(writer)
+            self.wait_for_waiting_writer()
+            with self.lock.read_locked():
+                self.assertEqual(entered, [])
+            self.assertEqual(entered, [], 'писатель вошёл до освобождения внешнего чтения')
+        self.assertTrue(writer_done.wait(TIMEOUT))
+
+    def test_pending_writer_blocks_new_readers(self):
+        """Новый читатель другого потока ждёт писателя, вставшего в очередь (приоритет записи)."""
+        order = []
+        release_writer = threading.Event()
+
+        def writer():
+            with self.lock.write_locked():
+                order.append('write')
+                release_writer.wait(TIMEOUT)
+
+        def reader():
+            with self.lock.read_locked():
+                order.append('read')
+
+        with self.lock.read_locked():
+            writer_done = self.run_in_thread(writer)
+            self.wait_for_waiting_writer()
+            reader_done = self.run_in_thread(reader)
+            self.assertFalse(reader_done.wait(0.05))
+        release_writer.set()
+        self.assertTrue(writer_done.wait(TIMEOUT))
+        self.assertTrue(reader_done.wait(TIMEOUT))
+        self.assertEqual(order, ['write', 'read'])
+
+    def test_writer_is_reentrant_and_may_read(self):
+        """Писатель повторно захватывает запись и читает под своей блокировкой."""
+        with self.lock.write_locked():
+            with self.lock.write_locked():
+                with self.lock.read_locked():
+                    pass
+            done = self.run_in_thread(self.read_once)
+            self.assertFalse(done.wait(0.05), 'чтение другого потока прошло во время записи')
+        self.assertTrue(done.wait(TIMEOUT))
+
+    def test_upgrade_from_read_raises(self):
+        """Повышение чтения до записи — RuntimeError, блокировка после этого остаётся рабочей."""
+        with self.lock.read_locked():
+            with self.assertRaises(RuntimeError):
+                self.lock.acquire_write()
+        with self.lock.write_locked():
+            pass
+        self.assertEqual((self.lock._readers, self.lock._writer, self.lock._writers_waiting), (0, None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Проверка сериализатора Сбера (SberMQTTSerializer): совпадение с исходной реализацией и разбиение статуса.
+
+serializer_baseline.json — вывод сериализатора версии до кэша фрагментов и разбиения сообщений
+(словари + json.dumps) для устройств из DEVICES; версия аддона заменена на {version}.
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']  # до импорта config: в нём читается options.json
+import sber_api  # noqa: E402
+from config import VERSION  # noqa: E402
+from devices_db import DevicesDB  # noqa: E402
+from sber_serializer import SberMQTTSerializer  # noqa: E402
+
+
+def _feature(name, data_type, required=False):
+    return {'name': name, 'data_type': data_type, 'required': required}
+
+
+CATEGORIES = {
+    'relay': [_feature('online', 'BOOL', True), _feature('on_off', 'BOOL', True)],
+    'light': [_feature('online', 'BOOL', True), _feature('on_off', 'BOOL', True),
+              _feature('light_brightness', 'INTEGER'), _feature('light_colour', 'COLOUR'),
+              _feature('light_colour_temp', 'INTEGER'), _feature('light_mode', 'ENUM')],
+    'sensor_temp': [_feature('online', 'BOOL', True), _feature('temperature', 'INTEGER', True),
+                    _feature('humidity', 'INTEGER', True), _feature('air_pressure', 'INTEGER')],
+    'vacuum_cleaner': [_feature('online', 'BOOL', True), _feature('vacuum_cleaner_command', 'ENUM', True),
+                       _feature('vacuum_cleaner_status', 'ENUM'), _feature('battery_percentage', 'INTEGER')],
+}
+
+# (entity_id, атрибуты, состояния)
+DEVICES = [
+    ('light.kitchen', {'enabled': True, 'name': 'Кухня', 'default_name': 'Kitchen', 'room': 'Кухня',
+                       'category': 'light', 'hw_version': 'hw1', 'sw_version': 'sw1'},
+     {'on_off': True, 'light_brightness': 500, 'light_colour': {'red': 255, 'green': 10, 'blue': 20},
+      'light_mode': 'colour'}),
+    ('switch.fan', {'enabled': True, 'name': 'Вентилятор', 'category': 'relay'}, {'on_off': False}),
+    ('switch.legacy', {'enabled': True, 'name': 'Без категории'}, {'on_off': True}),
+    ('sensor.hall', {'enabled': True, 'name': 'Датчик', 'home': 'Дача', 'category': 'sensor_temp'},
+     {'temperature': 21.5, 'online': True}),
+    ('vacuum.robot', {'enabled': True, 'name': 'Пылесос', 'category': 'vacuum_cleaner'},
+     {'vacuum_cleaner_command': 'start', 'vacuum_cleaner_status': 'cleaning', 'battery_percentage': 87}),
+    ('light.disabled', {'enabled': False, 'name': 'Выключен', 'category': 'light'}, {'on_off': True}),
+]
+
+
+class SberSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        sber_api.Categories = CATEGORIES
+        sber_api.CategoriesVersion += 1
+        db_file_path = os.path.join(tempfile.mkdtemp(), 'devices.json')
+        with open(db_file_path, 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+        self.db = DevicesDB(db_file_path)
+        for entity_id, data, states in DEVICES:
+            self.db.update(entity_id, data)
+            for key, value in states.items():
+                self.db.change_state(entity_id, key, value)
+        self.serializer = SberMQTTSerializer(self.db)
+
+    def add_lights(self, count):
+        for index in range(count):
+            entity_id = f'light.l{index:03}'
+            self.db.update(entity_id, {'enabled': True, 'name': f'Light {index}', 'category': 'light'})
+            self.db.change_state(entity_id, 'on_off', index % 2 == 0)
+            self.db.change_state(entity_id, 'light_brightness', 100 + index)
+
+    def test_payloads_match_baseline(self):
+        """Конфигурация и статус побайтно совпадают с выводом исходной реализации."""
+        with open(os.path.join(TESTS_DIR, 'serializer_baseline.json'), 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        self.assertEqual(self.serializer.build_mqtt_devices_payload(), baseline['config'].replace('{version}', VERSION))
+        self.assertEqual(self.serializer.build_mqtt_states_payload(), baseline['states_all'])
+        self.assertEqual(
+            self.serializer.build_mqtt_states_payload(['sensor.hall', 'light.disabled', 'light.kitchen', 'sensor.missing']),
+            baseline['states_some'])
+
+    def test_chunks_within_limit_and_complete(self):
+        """Каждая часть — самостоятельный JSON не больше max_size, вместе части дают тот же статус."""
+        self.add_lights(60)
+        whole = json.loads(self.serializer.render_states().chunks[0])['devices']
+        max_size = 1000
+        rendered = self.serializer.render_states(max_size=max_size)
+        self.assertGreater(len(rendered.chunks), 1)
+        merged = {}
+        for chunk in rendered.chunks:
+            self.assertLessEqual(len(chunk.encode('utf-8')), max_size)
+            devices = json.loads(chunk)['devices']
+            self.assertFalse(set(devices) & set(merged), 'устройство попало в две части')
+            merged.update(devices)
+        self.assertEqual(list(merged), list(whole))
+        self.assertEqual(merged, whole)
+        self.assertEqual(rendered.oversize, 0)
+
+    def test_oversize_device_sent_alone(self):
+        """Устройство больше max_size не делится, а отправляется отдельным сообщением."""
+        rendered = self.serializer.render_states(['switch.fan', 'light.kitchen', 'sensor.hall'], max_size=200)
+        self.assertEqual([list(json.loads(chunk)['devices']) for chunk in rendered.chunks],
+                         [['switch.fan'], ['light.kitchen'], ['sensor.hall']])
+        self.assertEqual(rendered.oversize, 1)
+
+    def test_delta_after_publish(self):
+        """После публикации дельта содержит только изменившиеся функции; без изменений публиковать нечего."""
+        self.serializer.build_mqtt_states_chunks()
+        self.assertIsNone(self.serializer.build_mqtt_states_payload(delta=True))
+        self.db.change_state('light.kitchen', 'light_brightness', 700)
+        payload = json.loads(self.serializer.build_mqtt_states_payload(delta=True))
+        self.assertEqual(payload, {'devices': {'light.kitchen': {'states': [
+            {'key': 'light_brightness', 'value': {'type': 'INTEGER', 'integer_value': 700}}]}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
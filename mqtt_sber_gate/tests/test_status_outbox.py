@@ -0,0 +1,96 @@
+"""
+Проверка исходящего буфера состояний (StatusOutbox).
+
+Запуск: python -m unittest discover -s mqtt_sber_gate/tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app'))
+os.chdir(tempfile.mkdtemp())  # журнал SberGate.log пишется в текущий каталог
+
+import logger  # noqa: E402
+logger.log_level = logger.LOG_LEVEL_LIST['fatal']
+from status_outbox import StatusOutbox  # noqa: E402
+
+
+class StatusOutboxTest(unittest.TestCase):
+
+    def take_all(self, outbox, batch_size=100):
+        """Все порции буфера до его опустошения."""
+        batches = []
+        while True:
+            batch, delta = outbox.take(batch_size)
+            if batch == []:
+                return batches
+            batches.append((batch, delta))
+
+    def test_offer_only_while_active(self):
+        """До первого подключения и после hold() буфер принимает устройства, после release() — нет."""
+        outbox = StatusOutbox()
+        self.assertTrue(outbox.offer(['light.a']))
+        outbox.release()
+        self.assertFalse(outbox.offer(['light.b']))
+        outbox.hold()
+        self.assertTrue(outbox.offer(['light.c']))
+        self.assertEqual(self.take_all(outbox), [(['light.a', 'light.c'], False)])
+
+    def test_full_absorbs_delta(self):
+        """Полное состояние поглощает дельту того же устройства, повторы не дублируются."""
+        outbox = StatusOutbox()
+        outbox.offer(['light.a', 'light.b'], delta=True)
+        outbox.offer(['light.a'])
+        outbox.offer(['light.a', 'light.b'], delta=True)
+        outbox.offer(['light.c'], delta=True)
+        self.assertEqual(self.take_all(outbox), [(['light.a'], False), (['light.b', 'light.c'], True)])
+        self.assertEqual(outbox.get_stats()['merged_count'], 3)
+
+    def test_all_devices(self):
+        """Отметка «все устройства» поглощает отдельные устройства; дельта всех не отменяет полных."""
+        outbox = StatusOutbox()
+        outbox.offer(['light.a'], delta=True)
+        outbox.offer(['light.b'])
+        outbox.offer(None, delta=True)
+        outbox.offer(['light.c'], delta=True)
+        self.assertEqual(self.take_all(outbox), [(None, True), (['light.b'], False)])
+
+        outbox.hold()
+        outbox.offer(None)
+        outbox.offer(None, delta=True)
+        outbox.offer(['light.a'])
+        self.assertEqual(self.take_all(outbox), [(None, False)])
+
+    def test_overflow_becomes_all(self):
+        """При переполнении буфер заменяется отметкой «статус всех устройств»."""
+        outbox = StatusOutbox(max_size=3)
+        outbox.offer(['light.a', 'light.b'])
+        outbox.offer(['light.c', 'light.d'], delta=True)
+        self.assertEqual(outbox.get_stats()['size'], 'all')
+        self.assertEqual(outbox.get_stats()['overflow_count'], 1)
+        self.assertEqual(self.take_all(outbox), [(None, False)])
+
+    def test_take_in_batches_then_deactivate(self):
+        """Порции не больше batch_size, пустой буфер деактивируется."""
+        outbox = StatusOutbox()
+        outbox.offer([f'light.l{index}' for index in range(5)])
+        self.assertEqual(outbox.take(2), (['light.l0', 'light.l1'], False))
+        self.assertTrue(outbox.active)
+        self.assertEqual([batch for batch, _ in self.take_all(outbox, 2)], [['light.l2', 'light.l3'], ['light.l4']])
+        self.assertFalse(outbox.active)
+        self.assertFalse(outbox.offer(['light.l0']))
+
+    def test_persisted_contents_restored(self):
+        """to_dict() и load() сохраняют вид отправки каждого устройства."""
+        outbox = StatusOutbox()
+        outbox.offer(None, delta=True)
+        outbox.offer(['light.a'])
+        outbox.offer(['light.b'], delta=True)
+        restored = StatusOutbox()
+        restored.load(outbox.to_dict())
+        self.assertEqual(self.take_all(restored), self.take_all(outbox))
+
+
+if __name__ == '__main__':
+    unittest.main()